@@ -5,7 +5,6 @@ Sorry for the one-file mess, but it's just a simple example.
 
 import sys
 import json
-from datetime import datetime
 import requests
 from PySide6.QtCore import Qt
 from PySide6.QtWidgets import (
@@ -101,8 +100,9 @@ class MainWindow(QMainWindow):
         self.delete_order_button.clicked.connect(self.delete_order)
         # Orders table
         self.orders_dict = {}
-        self.orders_table = QTableWidget(0, 3)
-        self.orders_table.setHorizontalHeaderLabels(["Order number", "Customer ID", "Created at"])
+        self.orders_table = QTableWidget(0, 5)
+        self.orders_table.setHorizontalHeaderLabels(
+            ["Order number", "Customer ID", "Created at", "Items", "Total"])
         self.orders_table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeToContents)
         self.order_layout.addWidget(self.order_buttons)
         self.order_layout.addWidget(self.orders_table)
@@ -189,9 +189,8 @@ class MainWindow(QMainWindow):
             "href": "/api/customers/"
         }
         try:
-            r = self.send_request(s, ctrl, None)
-            self.customers_dict = r.json()
-            customers = r.json()["customers"]
+            self.customers_dict = self.get_all_pages(s, ctrl, "customers")
+            customers = self.customers_dict["customers"]
             self.show_customers(customers)
             self.statusBar().showMessage("Customers retrieved successfully")
         except Exception as e:
@@ -318,9 +317,8 @@ class MainWindow(QMainWindow):
             "href": "/api/orders/"
         }
         try:
-            r = self.send_request(s, ctrl, None)
-            self.orders_dict = r.json()
-            orders = r.json()["orders"]
+            self.orders_dict = self.get_all_pages(s, ctrl, "orders")
+            orders = self.orders_dict["orders"]
             # print(orders)
             self.show_orders(orders)
             self.statusBar().showMessage("orders retrieved successfully")
@@ -334,7 +332,7 @@ class MainWindow(QMainWindow):
         for o in orders:
             row = self.orders_table.rowCount()
             self.orders_table.insertRow(row)
-            for i, key in enumerate(["id", "customerId", "createdAt"]):
+            for i, key in enumerate(["id", "customerId", "createdAt", "itemCount", "total"]):
                 item = QTableWidgetItem(str(o[key]))
                 item.setFlags(item.flags() & ~Qt.ItemIsEditable)
                 self.orders_table.setItem(row, i, item)
@@ -352,11 +350,10 @@ class MainWindow(QMainWindow):
 
         self.statusBar().showMessage(f"Opening order {order_id}...")
 
-        # list of product orders comes with orderitem get
-        # check which ones match order id
+        # product orders and their products are embedded in the order
         with requests.Session() as s:
             href = self.orders_dict["@controls"]["self"]["href"]
-            r = s.get(f"{self.API_URL}{href}{order_id}/")
+            r = s.get(f"{self.API_URL}{href}{order_id}/", params={"embed": "products"})
             data = r.json()
             product_order_list = data["productorders"]
 
@@ -372,23 +369,18 @@ class MainWindow(QMainWindow):
         sum_display = QHBoxLayout()
         sum_display.addWidget(QLabel("Total:"))
 
-        total_sum = 0
-
-        # list of products in matching product orders
-        with requests.Session() as s:
-            for po in product_order_list:
-                row = products_table.rowCount()
-                products_table.insertRow(row)
-                href = "/api/products/" + str(po["productId"]) + "/"
-                r = s.get(f"{self.API_URL}{href}")
-                product_data = r.json()
-                products_table.setItem(row, 0, QTableWidgetItem(product_data["name"]))
-                products_table.setItem(row, 1, QTableWidgetItem(str(po["quantity"])))
-                products_table.setItem(row, 2, QTableWidgetItem(
-                    str(product_data["price"] * po["quantity"])))
-                total_sum += product_data["price"] * po["quantity"]
-
-        sum_display.addWidget(QLabel(str(total_sum)))
+        # Lines keep the price the product had when it was ordered
+        for po in product_order_list:
+            product_data = po["product"]
+            row = products_table.rowCount()
+            products_table.insertRow(row)
+            name = product_data["name"] if product_data else "(deleted product)"
+            products_table.setItem(row, 0, QTableWidgetItem(name))
+            products_table.setItem(row, 1, QTableWidgetItem(str(po["quantity"])))
+            products_table.setItem(row, 2, QTableWidgetItem(
+                str(po["unitPrice"] * po["quantity"])))
+
+        sum_display.addWidget(QLabel(str(data["total"])))
         dialog_layout.addLayout(sum_display)
 
         # maybe get customer info too
@@ -455,130 +447,83 @@ class MainWindow(QMainWindow):
         row = selected_indexes[0].row()
         customer_uuid = self.customers_table.item(row, 0).text()
 
-        ctrl = {
-            "method": "post",
-            "href": "/api/orders/"
-        }
-        data = {
-            "customerId": customer_uuid,
-            "createdAt": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        }
-        try:
-            # Create order
-            s = requests.Session()
-            r = self.send_request(s, ctrl, data)
-            if r.status_code == 201:
-                # Save orderId from response
-                order_id = r.headers["Location"].rstrip('/').split('/')[-1]
-                print(f"Order created successfully: {order_id}")
-                self.statusBar().showMessage(f"Order created successfully: {order_id}")
-
-                def select_products_for_order():
-                    dialog = QDialog(self)
-                    dialog.setWindowTitle("Select products for order")
-                    dialog_layout = QVBoxLayout(dialog)
-
-                    # Get products
-                    self.get_products()
-                    products = self.products_dict["products"]
-
-                    # Create table for products and quantities
-                    products_table = QTableWidget(0, 2)
-                    products_table.setHorizontalHeaderLabels(["Product", "Quantity"])
-                    dialog_layout.addWidget(products_table)
-
-                    # List products in the table
-                    for prod in products:
-                        row = products_table.rowCount()
-                        products_table.insertRow(row)
-                        # Add product name
-                        name_item = QTableWidgetItem(prod["name"])
-                        name_item.setFlags(name_item.flags() & ~Qt.ItemIsEditable)
-                        products_table.setItem(row, 0, name_item)
-                        # Add quantity input field
-                        quantity_item = QTableWidgetItem("0")
-                        products_table.setItem(row, 1, quantity_item)
-
-                    save_button = QPushButton("Save")
-                    dialog_layout.addWidget(save_button)
-                    save_button.clicked.connect(lambda: save_product_order(products_table, dialog))
-
-                    dialog.exec()
-
-                def save_product_order(products_table, dialog):
-                    ctrl = {
-                        "method": "post",
-                        "href": "/api/productorders/"
-                    }
-                    product_orders = []
-                    for i in range(products_table.rowCount()):
-                        if int(products_table.item(i, 1).text()) > 0:
-                            for prod in self.products_dict["products"]:
-                                if prod["name"] == products_table.item(i, 0).text():
-                                    product_id = int(prod["@controls"]["self"]
-                                                     ["href"].split("/")[-2])
-                                    break
-                            quantity = int(products_table.item(i, 1).text())
-                            if check_stock_for_product(product_id) < quantity:
-                                msg = "Insufficient stock for product: "
-                                msg += f"{products_table.item(i, 0).text()}"
-                                QMessageBox.warning(dialog, "Invalid quantity",msg)
-                                return
-                            product_orders.append({
-                                "productId": product_id,
-                                "orderId": int(order_id),
-                                "quantity": quantity
-                            })
-                    with requests.Session() as s:
-                        for po in product_orders:
-                            r = self.send_request(s, ctrl, po)
-                            if r.status_code == 201:
-                                print(f"Product order created successfully: {po}")
-                                reduce_stock(s, po)
-                            else:
-                                print(f"Failed to create product order: {r.text}")
+        def select_products_for_order():
+            dialog = QDialog(self)
+            dialog.setWindowTitle("Select products for order")
+            dialog_layout = QVBoxLayout(dialog)
 
-                    dialog.accept()
-                    self.get_orders()
-                    self.get_stock()
-                    QMessageBox.information(dialog, "Success", f"Order created successfully: {po}")
-
-                def reduce_stock(s, po):
-                    pid = po["productId"]
-                    ctrl = {
-                        "method": "put",
-                        "href": f"/api/stock/{pid}/"
-                    }
-                    r = s.get(f"{self.API_URL}{ctrl['href']}")
-                    stock = r.json()
-                    data = {
-                        "productId": pid,
-                        "quantity": stock["quantity"] - po["quantity"]
-                    }
-
-                    r = self.send_request(s, ctrl, data)
-
-                    if r.status_code == 204:
-                        print(f"Stock updated successfully: {po}")
-                    else:
-                        print(f"Failed to update stock: {r.text}")
-
-                def check_stock_for_product(product_id):
-                    ctrl = {
-                        "method": "get",
-                        "href": f"/api/stock/{product_id}/"
-                    }
-                    with requests.Session() as s:
-                        r = self.send_request(s, ctrl, None)
-                        stock = r.json()
-                        return stock["quantity"]
-
-                # Call the damn thing
-                select_products_for_order()
-            else:
+            # Get products
+            self.get_products()
+            products = self.products_dict["products"]
+
+            # Create table for products and quantities
+            products_table = QTableWidget(0, 2)
+            products_table.setHorizontalHeaderLabels(["Product", "Quantity"])
+            dialog_layout.addWidget(products_table)
+
+            # List products in the table
+            for prod in products:
+                row = products_table.rowCount()
+                products_table.insertRow(row)
+                # Add product name
+                name_item = QTableWidgetItem(prod["name"])
+                name_item.setFlags(name_item.flags() & ~Qt.ItemIsEditable)
+                products_table.setItem(row, 0, name_item)
+                # Add quantity input field
+                quantity_item = QTableWidgetItem("0")
+                products_table.setItem(row, 1, quantity_item)
+
+            save_button = QPushButton("Save")
+            dialog_layout.addWidget(save_button)
+            save_button.clicked.connect(lambda: place_order(products_table, dialog))
+
+            dialog.exec()
+
+        def place_order(products_table, dialog):
+            # Product names are unique, map them to product ids
+            product_ids = {
+                prod["name"]: int(prod["@controls"]["self"]["href"].split("/")[-2])
+                for prod in self.products_dict["products"]
+            }
+            product_orders = []
+            for i in range(products_table.rowCount()):
+                quantity = int(products_table.item(i, 1).text())
+                if quantity > 0:
+                    product_orders.append({
+                        "productId": product_ids[products_table.item(i, 0).text()],
+                        "quantity": quantity
+                    })
+            if not product_orders:
+                QMessageBox.warning(dialog, "Invalid quantity", "Select at least one product")
+                return
+
+            # The API checks and reduces stock and creates the order in one request
+            ctrl = {
+                "method": "post",
+                "href": "/api/orders/place/"
+            }
+            data = {
+                "customerId": customer_uuid,
+                "productOrders": product_orders
+            }
+            with requests.Session() as s:
+                r = self.send_request(s, ctrl, data)
+            if r.status_code != 201:
                 print(f"Failed to create order: {r.text}")
                 message = r.json()["@error"]["@messages"][0]
-                self.statusBar().showMessage(f"Error: {message}")
+                QMessageBox.warning(dialog, "Order failed", message)
+                return
+
+            order_id = r.headers["Location"].rstrip('/').split('/')[-1]
+            print(f"Order created successfully: {order_id}")
+            self.statusBar().showMessage(f"Order created successfully: {order_id}")
+            dialog.accept()
+            self.get_orders()
+            self.get_stock()
+            QMessageBox.information(dialog, "Success", f"Order created successfully: {order_id}")
+
+        try:
+            select_products_for_order()
         except Exception as e:
             print(f"Error occurred: {e}")
             self.statusBar().showMessage(f"Error occurred: {e}")
@@ -654,9 +599,8 @@ class MainWindow(QMainWindow):
             "href": "/api/products/"
         }
         try:
-            r = self.send_request(s, ctrl, None)
-            self.products_dict = r.json()
-            products = r.json()["products"]
+            self.products_dict = self.get_all_pages(s, ctrl, "products")
+            products = self.products_dict["products"]
             self.show_products(products)
             self.statusBar().showMessage("Products retrieved successfully")
         except Exception as e:
@@ -873,9 +817,8 @@ class MainWindow(QMainWindow):
             "href": "/api/stock/"
         }
         try:
-            r = self.send_request(s, ctrl, None)
-            self.stock_dict = r.json()
-            stock = r.json()["items"]
+            self.stock_dict = self.get_all_pages(s, ctrl, "items")
+            stock = self.stock_dict["items"]
             self.show_stock(stock)
             self.statusBar().showMessage("Stock retrieved successfully")
         except Exception as e:
@@ -885,12 +828,17 @@ class MainWindow(QMainWindow):
     def show_stock(self, stock):
         ''' Show stock in the table'''
         self.stock_table.setRowCount(0)
+        # Map product ids to names once instead of relying on the row order
+        product_names = {
+            int(prod["@controls"]["self"]["href"].split("/")[-2]): prod["name"]
+            for prod in self.products_dict.get("products", [])
+        }
         for p in stock:
             row = self.stock_table.rowCount()
             self.stock_table.insertRow(row)
 
             # Set product name on 3rd column
-            product_name = self.products_dict["products"][row]["name"]
+            product_name = product_names.get(p["productId"], "")
             item = QTableWidgetItem(str(product_name))
             item.setFlags(item.flags() & ~Qt.ItemIsEditable)
             self.stock_table.setItem(row, 2, item)
@@ -963,6 +911,17 @@ class MainWindow(QMainWindow):
 
     # Utils:
 
+    def get_all_pages(self, s, ctrl, key):
+        ''' Get a collection from the API, following next controls until the last page '''
+        r = self.send_request(s, ctrl, None)
+        body = r.json()
+        page = body
+        while "next" in page["@controls"]:
+            r = self.send_request(s, page["@controls"]["next"], None)
+            page = r.json()
+            body[key].extend(page[key])
+        return body
+
     def send_request(self, s, ctrl, data):
         ''' Send a request to the API '''
         r = s.request(
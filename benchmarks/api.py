@@ -0,0 +1,487 @@
+'''
+Load test of every endpoint of the API. A SQLite database file is filled
+with SCALE customers, products and orders by onlinestore.datagen, then
+each endpoint is sent --requests requests from --concurrency threads,
+through the Flask test client and through a threaded WSGI server over
+HTTP. Prints the throughput, p50/p95/p99 latency and peak Python memory of
+every endpoint as JSON with sorted keys, so the results of two releases can
+be diffed. Run from the repository root:
+
+    python -m benchmarks.api --scale 10000 --output results.json
+
+Building a database with a million orders takes a while, --database keeps
+it in a file that is reused by the next runs. The endpoints change the
+data (orders are placed, stock adjusted), but the rows they delete and the
+products they add stock to are generated for them before each driver
+runs, untimed, so the item URLs of the other endpoints stay valid. The
+batch POSTs send BATCH_ITEMS items. The ?stream=1 exports send every row
+of their table, they get --export-requests requests.
+
+Only /metrics, /admin/profile/ and the API documentation are left out,
+they aren't part of the API.
+'''
+import argparse
+import http.client
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import deque
+
+from sqlalchemy import delete, func, select
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from onlinestore import create_app, db
+from onlinestore.datagen import generate
+from onlinestore.models import Customer, Order, Product, ProductOrder, Revision, Stock
+
+# Requests sent to each endpoint with tracemalloc on
+MEMORY_REQUESTS = 20
+# Customers kept for the URLs of the customer endpoints
+CUSTOMER_SAMPLE = 10000
+# Items in the body of a batch POST
+BATCH_ITEMS = 10
+
+
+class Dataset:
+    '''
+    Row counts and customers of the database, used to build the request
+    URLs, and the rows generated for the endpoints that use rows up
+    '''
+
+    def __init__(self, app):
+        self.app = app
+        with app.app_context():
+            self.products = db.session.scalar(select(func.max(Product.id)))
+            self.orders = db.session.scalar(select(func.max(Order.id)))
+            self.lines = db.session.scalar(select(func.max(ProductOrder.id)))
+            self.customers = db.session.scalars(
+                select(Customer.uuid).order_by(Customer.id).limit(CUSTOMER_SAMPLE)
+            ).all()
+        self._names = iter(range(10 ** 9))
+        self._lock = threading.Lock()
+        self._spare = {}
+
+    def _unique(self):
+        with self._lock:
+            return f"{next(self._names)}-{os.getpid()}"
+
+    def email(self):
+        ''' An email address no customer has '''
+        return f"bench{self._unique()}@example.org"
+
+    def name(self):
+        ''' A name no product has '''
+        return f"Bench product {self._unique()}"
+
+    def prepare(self, count, seed):
+        '''
+        Generate the rows for *count* requests of each endpoint that uses rows
+        up, with datagen and without the API: customers, products, stock,
+        orders and product orders to be deleted and products without stock
+        for the stock POSTs. The rows of each endpoint are its own, deleting
+        one doesn't delete the rows of another with ON DELETE.
+        '''
+        with self.app.app_context():
+            first = {
+                model: (db.session.scalar(select(func.max(model.id))) or 0)
+                for model in (Customer, Product, Order)
+            }
+            stockless = count + count * BATCH_ITEMS
+            generate(db.engine, count, 2 * count + stockless, 2 * count, seed, stock=10 ** 9)
+
+            def new_rows(column, *where):
+                return deque(db.session.scalars(select(column).where(*where).order_by(column)))
+
+            customers = new_rows(Customer.uuid, Customer.id > first[Customer])
+            products = list(new_rows(Product.id, Product.id > first[Product]))
+            orders = list(new_rows(Order.id, Order.id > first[Order]))
+            # The product orders of the orders that aren't deleted
+            lines = new_rows(ProductOrder.id, ProductOrder.orderId > orders[count - 1])
+            with db.engine.begin() as connection:
+                connection.execute(delete(Stock).where(Stock.productId > products[2 * count - 1]))
+                Revision.bump(connection, {Stock.__tablename__})
+        self._spare = {
+            "customer": customers,
+            "product": deque(products[:count]),
+            "stock": deque(products[count:2 * count]),
+            "stockless": deque(products[2 * count:]),
+            "order": deque(orders[:count]),
+            "productorder": lines,
+        }
+
+    def take(self, kind):
+        ''' A generated row of *kind* no request has used yet '''
+        return self._spare[kind].popleft()
+
+
+def _product_body(rng, data):
+    return {"name": data.name(), "desc": "Added by the benchmark",
+            "price": round(rng.uniform(1, 500), 2)}
+
+
+def _customer_body(rng, data):
+    return {"firstName": "Bench", "lastName": "Mark", "email": data.email()}
+
+
+def _productorder_body(rng, data):
+    return {"orderId": rng.randint(1, data.orders), "productId": rng.randint(1, data.products),
+            "quantity": rng.randint(1, 3)}
+
+
+def _stock_body(rng, data):
+    return {"productId": data.take("stockless"), "quantity": 1000}
+
+
+def _batch(make_body):
+    return lambda rng, data: [make_body(rng, data) for _ in range(BATCH_ITEMS)]
+
+
+def _product_put(rng, data):
+    product = rng.randint(1, data.products)
+    return ("PUT", f"/api/products/{product}/", {
+        "name": f"Product {product}", "desc": "Updated by the benchmark",
+        "price": round(rng.uniform(1, 500), 2),
+    })
+
+
+def _stock_put(rng, data):
+    product = rng.randint(1, data.products)
+    return ("PUT", f"/api/stock/{product}/", {"productId": product, "quantity": 10 ** 9})
+
+
+def _place_order(rng, data):
+    return ("POST", "/api/orders/place/", {
+        "customerId": rng.choice(data.customers),
+        "productOrders": [
+            {"productId": rng.randint(1, data.products), "quantity": rng.randint(1, 3)}
+            for _ in range(rng.randint(1, 5))
+        ],
+    })
+
+
+# Requests of every endpoint as functions of a random generator and the dataset
+ENDPOINTS = {
+    "GET products": lambda rng, data: ("GET", "/api/products/?limit=100", None),
+    "GET products sorted": lambda rng, data: ("GET", "/api/products/?limit=100&sort=-name", None),
+    "GET products filtered": lambda rng, data: (
+        "GET", "/api/products/?limit=100&price[gte]=100&price[lt]=200", None),
+    "GET products search": lambda rng, data: (
+        "GET", f"/api/products/search/?q=product+{rng.randint(1, 99)}", None),
+    "POST product": lambda rng, data: ("POST", "/api/products/", _product_body(rng, data)),
+    "POST products batch": lambda rng, data: (
+        "POST", "/api/products/", _batch(_product_body)(rng, data)),
+    "GET product": lambda rng, data: ("GET", f"/api/products/{rng.randint(1, data.products)}/", None),
+    "PUT product": _product_put,
+    "DELETE product": lambda rng, data: ("DELETE", f"/api/products/{data.take('product')}/", None),
+    "GET product productorders": lambda rng, data: (
+        "GET", f"/api/products/{rng.randint(1, data.products)}/productorders/", None),
+    "GET customers": lambda rng, data: ("GET", "/api/customers/?limit=100", None),
+    "POST customer": lambda rng, data: ("POST", "/api/customers/", _customer_body(rng, data)),
+    "POST customers batch": lambda rng, data: (
+        "POST", "/api/customers/", _batch(_customer_body)(rng, data)),
+    "GET customer": lambda rng, data: ("GET", f"/api/customers/{rng.choice(data.customers)}/", None),
+    "PUT customer": lambda rng, data: (
+        "PUT", f"/api/customers/{rng.choice(data.customers)}/", _customer_body(rng, data)),
+    "DELETE customer": lambda rng, data: (
+        "DELETE", f"/api/customers/{data.take('customer')}/", None),
+    "GET customer orders": lambda rng, data: (
+        "GET", f"/api/customers/{rng.choice(data.customers)}/orders/", None),
+    "GET orders": lambda rng, data: ("GET", "/api/orders/?limit=100", None),
+    "POST order": lambda rng, data: (
+        "POST", "/api/orders/", {"customerId": rng.choice(data.customers)}),
+    "GET order": lambda rng, data: ("GET", f"/api/orders/{rng.randint(1, data.orders)}/", None),
+    "PUT order": lambda rng, data: (
+        "PUT", f"/api/orders/{rng.randint(1, data.orders)}/",
+        {"customerId": rng.choice(data.customers)}),
+    "DELETE order": lambda rng, data: ("DELETE", f"/api/orders/{data.take('order')}/", None),
+    "POST order place": _place_order,
+    "GET productorders": lambda rng, data: ("GET", "/api/productorders/?limit=100", None),
+    "POST productorder": lambda rng, data: (
+        "POST", "/api/productorders/", _productorder_body(rng, data)),
+    "POST productorders batch": lambda rng, data: (
+        "POST", "/api/productorders/", _batch(_productorder_body)(rng, data)),
+    "GET productorder": lambda rng, data: (
+        "GET", f"/api/productorders/{rng.randint(1, data.lines)}/", None),
+    "PUT productorder": lambda rng, data: (
+        "PUT", f"/api/productorders/{rng.randint(1, data.lines)}/",
+        _productorder_body(rng, data)),
+    "DELETE productorder": lambda rng, data: (
+        "DELETE", f"/api/productorders/{data.take('productorder')}/", None),
+    "GET stock": lambda rng, data: ("GET", "/api/stock/?limit=100", None),
+    "POST stock": lambda rng, data: ("POST", "/api/stock/", _stock_body(rng, data)),
+    "POST stock batch": lambda rng, data: ("POST", "/api/stock/", _batch(_stock_body)(rng, data)),
+    "GET stock item": lambda rng, data: ("GET", f"/api/stock/{rng.randint(1, data.products)}/", None),
+    "PUT stock": _stock_put,
+    "PATCH stock": lambda rng, data: (
+        "PATCH", f"/api/stock/{rng.randint(1, data.products)}/", {"delta": 1}),
+    "DELETE stock": lambda rng, data: ("DELETE", f"/api/stock/{data.take('stock')}/", None),
+    "GET reports": lambda rng, data: ("GET", "/api/reports/", None),
+    "GET report products": lambda rng, data: ("GET", "/api/reports/products/", None),
+    "GET report daily": lambda rng, data: ("GET", "/api/reports/daily/", None),
+    "GET report customers": lambda rng, data: ("GET", "/api/reports/customers/", None),
+    "GET report stock turnover": lambda rng, data: ("GET", "/api/reports/stock-turnover/", None),
+}
+
+# Endpoints that use up rows generated for them by Dataset.prepare
+USES_ROWS = {
+    "DELETE product", "DELETE customer", "DELETE order", "DELETE productorder", "DELETE stock",
+    "POST stock", "POST stock batch",
+}
+
+
+def _export(name):
+    return lambda rng, data: ("GET", f"/api/{name}/?stream=1", None)
+
+
+# Streamed exports of whole collections, sent --export-requests requests
+EXPORTS = {
+    f"GET {name} export": _export(name)
+    for name in ("products", "customers", "orders", "productorders", "stock")
+}
+
+
+class TestClientDriver:
+    ''' Sends requests through the Flask test client, one client per thread '''
+
+    name = "client"
+
+    def __init__(self, app):
+        self.app = app
+        self._local = threading.local()
+
+    def request(self, method, path, body):
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        resp = client.open(path, method=method, json=body)
+        return resp.status_code, len(resp.data)
+
+    def close(self):
+        pass
+
+
+class _KeepAliveHandler(WSGIRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class ServerDriver:
+    ''' Sends HTTP requests to a threaded WSGI server, one connection per thread '''
+
+    name = "server"
+
+    def __init__(self, app):
+        self.server = make_server(
+            "127.0.0.1", 0, app, threaded=True, request_handler=_KeepAliveHandler
+        )
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self._local = threading.local()
+
+    def request(self, method, path, body):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = http.client.HTTPConnection(
+                "127.0.0.1", self.server.port
+            )
+        headers = {}
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode()
+            headers["Content-Type"] = "application/json"
+        try:
+            connection.request(method, path, body=data, headers=headers)
+            resp = connection.getresponse()
+            content = resp.read()
+        except (http.client.HTTPException, OSError):
+            connection.close()
+            self._local.connection = None
+            raise
+        return resp.status, len(content)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def _percentile(quantiles, n):
+    return round(quantiles[n - 1] * 1000, 3)
+
+
+def run_endpoint(driver, make_request, data, requests, concurrency, seed):
+    '''
+    Send *requests* requests from *concurrency* threads and measure every
+    one. Responses with status 400 or above count as errors.
+    '''
+    latencies = [[] for _ in range(concurrency)]
+    errors = [0] * concurrency
+
+    def work(worker):
+        rng = random.Random(seed * 1000 + worker)
+        for _ in range(requests // concurrency + (worker < requests % concurrency)):
+            method, path, body = make_request(rng, data)
+            start = time.perf_counter()
+            try:
+                status, _ = driver.request(method, path, body)
+            except (http.client.HTTPException, OSError):
+                status = 599
+            latencies[worker].append(time.perf_counter() - start)
+            errors[worker] += status >= 400
+
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies = [latency for worker in latencies for latency in worker]
+    quantiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {
+        "requests": len(latencies),
+        "errors": sum(errors),
+        "throughput": round(len(latencies) / elapsed, 1),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 3),
+        "p50_ms": _percentile(quantiles, 50),
+        "p95_ms": _percentile(quantiles, 95),
+        "p99_ms": _percentile(quantiles, 99),
+    }
+
+
+def peak_memory(driver, make_request, data, seed, requests=MEMORY_REQUESTS):
+    ''' Largest Python memory allocated while handling one request, in bytes '''
+    rng = random.Random(seed)
+    peak = 0
+    tracemalloc.start()
+    try:
+        for _ in range(requests):
+            method, path, body = make_request(rng, data)
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            driver.request(method, path, body)
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - base)
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def _arguments(argv):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.api", description=__doc__.split("\n\n")[0])
+    parser.add_argument("--scale", type=int, default=1000,
+                        help="customers, products and orders in the database")
+    parser.add_argument("--requests", type=int, default=200, help="requests per endpoint")
+    parser.add_argument("--export-requests", type=int, default=10,
+                        help="requests per streamed export of a whole collection")
+    parser.add_argument("--concurrency", type=int, default=4, help="threads sending requests")
+    parser.add_argument("--drivers", default="client,server",
+                        help="comma separated: client (test client), server (HTTP)")
+    parser.add_argument("--endpoints", default="",
+                        help="only the endpoints whose names contain this text")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--database", help="database file, created if it doesn't exist")
+    parser.add_argument("--output", help="file for the JSON results instead of stdout")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    ''' Run the benchmark and write the results '''
+    args = _arguments(argv)
+    path = args.database
+    if path is None:
+        fd, path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        os.remove(path)
+    path = os.path.abspath(path)
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{path}",
+        "SQLITE_PROFILE": "production",
+        "ENTITY_CACHE_SIZE": 1024,
+    })
+    # The N+1 warnings of the query stats would drown the progress
+    app.logger.setLevel(logging.ERROR)
+    results = {}
+    try:
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            start = time.perf_counter()
+            with app.app_context():
+                db.create_all()
+                # Plenty of stock, so placing orders never fails
+                generate(db.engine, args.scale, args.scale, args.scale, args.seed, stock=10 ** 9)
+            print(f"Populated {args.scale} rows in {time.perf_counter() - start:.1f} s",
+                  file=sys.stderr)
+        data = Dataset(app)
+        endpoints = [
+            (endpoint, make_request, args.requests) for endpoint, make_request in ENDPOINTS.items()
+        ] + [
+            (endpoint, make_request, args.export_requests)
+            for endpoint, make_request in EXPORTS.items()
+        ]
+        endpoints = [endpoint for endpoint in endpoints if args.endpoints in endpoint[0]]
+        drivers = {"client": TestClientDriver, "server": ServerDriver}
+        for name in args.drivers.split(","):
+            if any(endpoint in USES_ROWS for endpoint, _, _ in endpoints):
+                # A random seed, rows left by earlier runs in the database can't collide
+                seed = random.SystemRandom().randrange(2 ** 32)
+                data.prepare(args.requests + 1 + MEMORY_REQUESTS, seed)
+            driver = drivers[name](app)
+            try:
+                results[name] = {}
+                for endpoint, make_request, requests in endpoints:
+                    # Warm up the caches of the app and the database
+                    driver.request(*make_request(random.Random(args.seed), data))
+                    result = run_endpoint(
+                        driver, make_request, data, requests, args.concurrency, args.seed
+                    )
+                    result["peak_memory_bytes"] = peak_memory(
+                        driver, make_request, data, args.seed, min(requests, MEMORY_REQUESTS)
+                    )
+                    results[name][endpoint] = result
+                    print(f"{name:<8}{endpoint:<28}{result['throughput']:>10} req/s"
+                          f"{result['p99_ms']:>10} ms p99", file=sys.stderr)
+            finally:
+                driver.close()
+    finally:
+        with app.app_context():
+            db.engine.dispose()
+        if args.database is None:
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+
+    report = json.dumps({
+        "meta": {
+            "scale": args.scale,
+            "requests": args.requests,
+            "export_requests": args.export_requests,
+            "batch_items": BATCH_ITEMS,
+            "concurrency": args.concurrency,
+            "seed": args.seed,
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            # Kilobytes on Linux
+            "max_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        },
+        "results": results,
+    }, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+'''
+Benchmark of parallel readers and writers on a SQLite database file with each
+SQLite profile. Reader threads get pages of the product collection and items,
+writer threads place orders and restock, all through the test client for
+DURATION seconds. Prints the requests per second and the failed requests of
+both kinds. Run from the repository root:
+
+    python -m benchmarks.concurrency [readers] [writers]
+'''
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+from onlinestore import create_app, db
+from onlinestore.models import Customer, Product, Stock
+
+DURATION = 5
+PRODUCTS = 1000
+
+
+def _populate(app):
+    ''' Add the products with plenty of stock and a customer '''
+    with app.app_context():
+        db.create_all()
+        customer = Customer(firstName="Bench", lastName="Mark", email="b@example.com")
+        db.session.add(customer)
+        for i in range(1, PRODUCTS + 1):
+            product = Product(name=f"Product {i}", desc="A product for the benchmark", price=i)
+            db.session.add_all([product, Stock(stockProduct=product, quantity=10 ** 9)])
+        db.session.commit()
+        return customer.uuid
+
+
+def _reader(client, stop, counts):
+    while not stop.is_set():
+        if random.random() < 0.5:
+            resp = client.get("/api/products/?limit=100")
+        else:
+            resp = client.get(f"/api/products/{random.randint(1, PRODUCTS)}/")
+        counts.append(resp.status_code == 200)
+
+
+def _writer(client, customer, stop, counts):
+    while not stop.is_set():
+        if random.random() < 0.8:
+            resp = client.post("/api/orders/place/", json={
+                "customerId": customer,
+                "productOrders": [
+                    {"productId": random.randint(1, PRODUCTS), "quantity": 1}
+                    for _ in range(3)
+                ]
+            })
+            counts.append(resp.status_code == 201)
+        else:
+            product = random.randint(1, PRODUCTS)
+            resp = client.patch(f"/api/stock/{product}/", json={"delta": 10})
+            counts.append(resp.status_code == 200)
+
+
+def run(profile, readers, writers):
+    ''' Run the benchmark with a profile, return (reads/s, failed reads, writes/s, failed writes) '''
+    fd, path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{path}",
+        "SQLITE_PROFILE": profile,
+        "ENTITY_CACHE_SIZE": 0,
+    })
+    try:
+        customer = _populate(app)
+        stop = threading.Event()
+        reads = [[] for _ in range(readers)]
+        writes = [[] for _ in range(writers)]
+        threads = [
+            threading.Thread(target=_reader, args=(app.test_client(), stop, counts))
+            for counts in reads
+        ] + [
+            threading.Thread(target=_writer, args=(app.test_client(), customer, stop, counts))
+            for counts in writes
+        ]
+        for thread in threads:
+            thread.start()
+        time.sleep(DURATION)
+        stop.set()
+        for thread in threads:
+            thread.join()
+    finally:
+        with app.app_context():
+            db.engine.dispose()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+    reads = [ok for counts in reads for ok in counts]
+    writes = [ok for counts in writes for ok in counts]
+    return (
+        sum(reads) / DURATION, reads.count(False),
+        sum(writes) / DURATION, writes.count(False),
+    )
+
+
+def main():
+    ''' Print the throughput of every profile '''
+    readers = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    writers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    print(f"{readers} readers, {writers} writers, {DURATION} s")
+    print(f"{'profile':<12}{'reads/s':>10}{'failed':>8}{'writes/s':>10}{'failed':>8}")
+    for profile in ("default", "production"):
+        reads, failed_reads, writes, failed_writes = run(profile, readers, writers)
+        print(f"{profile:<12}{reads:>10.0f}{failed_reads:>8}{writes:>10.0f}{failed_writes:>8}")
+
+
+if __name__ == "__main__":
+    main()
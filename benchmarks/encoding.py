@@ -0,0 +1,88 @@
+'''
+Micro-benchmark of encoding a product collection document. Compares building
+an InventoryBuilder with url_for for every item and json.dumps on the whole
+tree against the ItemEncoder and cached fragments with both JSON encoders.
+Run from the repository root:
+
+    python -m benchmarks.encoding
+'''
+import json
+import timeit
+
+from flask import url_for
+
+from onlinestore import create_app
+from onlinestore.constants import LINK_RELATIONS_URL, PRODUCT_PROFILE
+from onlinestore.encoding import ENCODERS, encode
+from onlinestore.models import Product
+from onlinestore.utils import InventoryBuilder, ItemEncoder, MasonBuilder
+
+ITEMS = 10000
+NUMBER = 5
+
+
+def _head():
+    body = InventoryBuilder()
+    body.add_namespace("store", LINK_RELATIONS_URL)
+    body.add_control("self", href=url_for("api.productcollection"))
+    body.add_control_all_products()
+    body.add_control_add_product()
+    return body
+
+
+def build_dict(products):
+    ''' The collection as built before the encoder layer '''
+    body = MasonBuilder()
+    body.add_namespace("store", LINK_RELATIONS_URL)
+    body.add_control("self", href=url_for("api.productcollection"))
+    body.add_control("product:get-products", href=url_for("api.productcollection"),
+                     method="GET", title="Get all products")
+    body.add_control_post("product:add-product", "Add a new product",
+                          url_for("api.productcollection"), Product.json_schema())
+    items = []
+    for product in products:
+        item = MasonBuilder(product.serialize())
+        item.add_control("self", href=url_for("api.productitem", product=product.id))
+        item.add_control("profile", PRODUCT_PROFILE)
+        items.append(item)
+    body["products"] = items
+    return json.dumps(body).encode()
+
+
+def build_fragments(products):
+    ''' The collection built with ItemEncoder and cached fragments '''
+    body = _head()
+    encode_item = ItemEncoder("api.productitem", "product", "id", PRODUCT_PROFILE)
+    body["products"] = [encode_item(product) for product in products]
+    return encode(body)
+
+
+def main():
+    ''' Print the time to encode a collection of ITEMS products '''
+    app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite://"})
+    products = [
+        Product(id=i, name=f"Product {i}", desc="A product for the benchmark", price=i / 100)
+        for i in range(1, ITEMS + 1)
+    ]
+    with app.test_request_context("/api/products/"):
+        print(f"{'method':<32}{'ms':>10}{'bytes':>12}")
+        size = len(build_dict(products))
+        seconds = timeit.timeit(lambda: build_dict(products), number=NUMBER) / NUMBER
+        print(f"{'InventoryBuilder + json.dumps':<32}{seconds * 1000:>10.1f}{size:>12}")
+        for name, dumps in ENCODERS.items():
+            app.extensions["json_encoder"] = dumps
+            app.extensions["json_fragments"].clear()
+            size = len(build_fragments(products))
+            seconds = timeit.timeit(lambda: build_fragments(products), number=NUMBER) / NUMBER
+            label = f"ItemEncoder + {name}"
+            print(f"{label:<32}{seconds * 1000:>10.1f}{size:>12}")
+        # Serializing and encoding the row data alone is the lower bound
+        dumps = ENCODERS[name]
+        seconds = timeit.timeit(
+            lambda: [dumps(product.serialize()) for product in products], number=NUMBER
+        ) / NUMBER
+        print(f"{'row data only (' + name + ')':<32}{seconds * 1000:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+'''
+Micro-benchmark of validating request bodies with jsonschema.validate against
+the compiled validators of onlinestore.validation. Run from the repository root:
+
+    python -m benchmarks.validation
+'''
+import timeit
+
+from jsonschema import validate
+
+from onlinestore.models import Product, Customer, Order, Stock
+from onlinestore.validation import validate_json
+
+NUMBER = 2000
+
+BODIES = [
+    (Product, "json_schema", {"name": "Sateenvarjo", "desc": "Musta", "price": 9.99}),
+    (Customer, "json_schema", {
+        "firstName": "Matti", "lastName": "Meikäläinen",
+        "email": "matti@example.com", "phone": "0401234567"
+    }),
+    (Order, "place_schema", {
+        "customerId": "f5a8b2d1-0c3e-4a7b-9d6f-2e1c8b7a5d4e",
+        "productOrders": [{"productId": 1, "quantity": 2}, {"productId": 2, "quantity": 1}]
+    }),
+    (Stock, "adjust_schema", {"delta": -3}),
+]
+
+
+def main():
+    ''' Print the cost of one validation per schema before and after the registry '''
+    print(f"{'schema':<28}{'validate (us)':>15}{'validate_json (us)':>20}{'speedup':>10}")
+    for model, schema, body in BODIES:
+        before = timeit.timeit(
+            lambda: validate(body, getattr(model, schema)()), number=NUMBER
+        ) / NUMBER * 1e6
+        validate_json(body, model, schema)
+        after = timeit.timeit(
+            lambda: validate_json(body, model, schema), number=NUMBER
+        ) / NUMBER * 1e6
+        name = f"{model.__name__}.{schema}"
+        print(f"{name:<28}{before:>15.1f}{after:>20.1f}{before / after:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
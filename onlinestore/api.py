@@ -6,27 +6,46 @@ from flask_restful import Api
 
 # import collections
 from onlinestore.resources.customer import CustomerCollection, CustomerItem
-from onlinestore.resources.order import OrderCollection, OrderItem
-from onlinestore.resources.product import ProductCollection, ProductItem
-from onlinestore.resources.productorder import ProductOrderCollection, ProductOrderItem
+from onlinestore.resources.order import (
+    OrderCollection, OrderItem, OrderPlacement, CustomerOrderCollection
+)
+from onlinestore.resources.product import ProductCollection, ProductItem, ProductSearch
+from onlinestore.resources.productorder import (
+    ProductOrderCollection, ProductOrderItem, ProductProductOrderCollection
+)
 from onlinestore.resources.stock import StockCollection, StockItem
+from onlinestore.resources.report import (
+    ReportIndex, ProductSalesReport, DailySalesReport, CustomerSalesReport, StockTurnoverReport
+)
 
 api_bp = Blueprint('api', __name__, url_prefix='/api')
 api = Api(api_bp)
 
 # Add resources
 api.add_resource(ProductCollection, '/products/', methods=['GET', 'POST'])
+api.add_resource(ProductSearch, '/products/search/', methods=['GET'])
 api.add_resource(ProductItem, '/products/<product:product>/', methods=['GET', 'PUT', 'DELETE'])
+api.add_resource(ProductProductOrderCollection, '/products/<product:product>/productorders/',
+                 methods=['GET'])
 
 api.add_resource(CustomerCollection, '/customers/', methods=['GET', 'POST'])
 api.add_resource(CustomerItem, '/customers/<customer:customer>/', methods=['GET', 'PUT', 'DELETE'])
+api.add_resource(CustomerOrderCollection, '/customers/<customer:customer>/orders/',
+                 methods=['GET'])
 
 api.add_resource(OrderCollection, '/orders/', methods=['GET', 'POST'])
 api.add_resource(OrderItem, '/orders/<order:order>/', methods=['GET', 'PUT', 'DELETE'])
+api.add_resource(OrderPlacement, '/orders/place/', methods=['POST'])
 
 api.add_resource(ProductOrderCollection, '/productorders/', methods=['GET', 'POST'])
 api.add_resource(ProductOrderItem, '/productorders/<productorder:productorder>/',
                  methods=['GET', 'PUT', 'DELETE'])
 
 api.add_resource(StockCollection, '/stock/', methods=['GET', 'POST'])
-api.add_resource(StockItem, '/stock/<stock:product>/', methods=['GET', 'PUT', 'DELETE'])
+api.add_resource(StockItem, '/stock/<stock:product>/', methods=['GET', 'PUT', 'PATCH', 'DELETE'])
+
+api.add_resource(ReportIndex, '/reports/', methods=['GET'])
+api.add_resource(ProductSalesReport, '/reports/products/', methods=['GET'])
+api.add_resource(DailySalesReport, '/reports/daily/', methods=['GET'])
+api.add_resource(CustomerSalesReport, '/reports/customers/', methods=['GET'])
+api.add_resource(StockTurnoverReport, '/reports/stock-turnover/', methods=['GET'])
@@ -0,0 +1,195 @@
+'''
+Read-through entity cache for the URL converters of onlinestore API
+'''
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, has_app_context, has_request_context, request
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, make_transient_to_detached
+
+from onlinestore import db
+from onlinestore.models import Product, Customer, Order, ProductOrder, Stock, referencing_keys
+
+# Requests whose rows may come from the cache, writes always read the row
+SAFE_METHODS = ("GET", "HEAD")
+
+# The column each URL converter looks its model up by
+LOOKUP_COLUMNS = {
+    Product: "id",
+    Customer: "uuid",
+    Order: "id",
+    ProductOrder: "id",
+    Stock: "productId",
+}
+
+
+class EntityCache:
+    """
+    A bounded LRU cache with TTL for the rows looked up by the URL converters.
+    Rows are stored as dictionaries of column values instead of ORM objects,
+    because objects can't be shared between sessions. A cache hit is turned
+    back into a persistent object of the current session without emitting
+    any SQL. Relationships are loaded lazily as usual when they are accessed.
+
+    Entries are invalidated when a transaction that changed the row commits.
+    Other workers may serve a stale row until the TTL expires, so only reads
+    use the cache.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self._rows = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, model, key):
+        ''' Get a cached object attached to the current session, or None '''
+        with self._lock:
+            entry = self._rows.get((model, str(key)))
+            if entry is None:
+                return None
+            expires, values = entry
+            if expires < time.monotonic():
+                del self._rows[(model, str(key))]
+                return None
+            self._rows.move_to_end((model, str(key)))
+
+        obj = model()
+        for name, value in values.items():
+            setattr(obj, name, value)
+        make_transient_to_detached(obj)
+        return db.session.merge(obj, load=False)
+
+    def put(self, model, key, obj):
+        ''' Store the column values of a loaded object '''
+        values = {attr.key: getattr(obj, attr.key) for attr in inspect(model).column_attrs}
+        with self._lock:
+            self._rows[(model, str(key))] = (time.monotonic() + self.ttl, values)
+            self._rows.move_to_end((model, str(key)))
+            while len(self._rows) > self.size:
+                self._rows.popitem(last=False)
+
+    def invalidate(self, model, key):
+        ''' Remove an entry from the cache '''
+        with self._lock:
+            self._rows.pop((model, str(key)), None)
+
+    def invalidate_references(self, model, column, values):
+        ''' Remove the entries of *model* whose *column* has one of *values* '''
+        with self._lock:
+            stale = [
+                key for key, (_, row) in self._rows.items()
+                if key[0] is model and str(row[column]) in values
+            ]
+            for key in stale:
+                del self._rows[key]
+
+    def clear(self):
+        ''' Remove every entry from the cache '''
+        with self._lock:
+            self._rows.clear()
+
+
+def init_app(app):
+    '''
+    Create the entity cache of the app if ENTITY_CACHE_SIZE is set. The
+    lifetime of the entries is ENTITY_CACHE_TTL seconds.
+    '''
+    size = app.config.get("ENTITY_CACHE_SIZE", 0)
+    if size:
+        app.extensions["entity_cache"] = EntityCache(size, app.config.get("ENTITY_CACHE_TTL", 5))
+
+
+def _get_cache():
+    if not has_app_context():
+        return None
+    return current_app.extensions.get("entity_cache")
+
+
+def _cacheable():
+    ''' Whether the row of the current request may come from the cache '''
+    return has_request_context() and request.method in SAFE_METHODS
+
+
+def lookup(model, value):
+    '''
+    Look up a model by the column its URL converter uses, reading through the
+    entity cache when it is enabled and the request is a read. Writes load a
+    fresh row, a stale one could be changed or deleted twice. Returns None if
+    there is no such row.
+    '''
+    cache = _get_cache() if _cacheable() else None
+    if cache is not None:
+        obj = cache.get(model, value)
+        if obj is not None:
+            return obj
+
+    obj = model.query.filter_by(**{LOOKUP_COLUMNS[model]: value}).first()
+    if obj is not None and cache is not None:
+        cache.put(model, value, obj)
+    return obj
+
+
+def invalidate_on_commit(model, key):
+    '''
+    Invalidate a cached row when the current transaction commits. Changes made
+    through the ORM are tracked automatically, this is needed for UPDATE and
+    DELETE statements that bypass the session (e.g. Stock.adjust).
+    '''
+    db.session.info.setdefault("stale_entities", set()).add((model, str(key)))
+
+
+def _cascades(model):
+    '''
+    (cached model, its column, column of *model*) of the foreign keys whose
+    rows the database changes when a row of *model* is deleted
+    '''
+    children = {cached.__table__: cached for cached in LOOKUP_COLUMNS}
+    return [
+        (children[key.parent.table], key.parent.key, key.column.key)
+        for key in referencing_keys(model.__table__) if key.parent.table in children
+    ]
+
+
+@event.listens_for(Session, "after_flush")
+def _track_changes(session, flush_context):
+    '''
+    Remember the cached models changed or deleted by the flush. The rows the
+    database deletes or nulls for deleted rows (ON DELETE) aren't loaded, they
+    are found in the cache by the key of their deleted parent on commit.
+    '''
+    stale = session.info.setdefault("stale_entities", set())
+    references = session.info.setdefault("stale_references", set())
+    for obj in session.dirty | session.deleted:
+        column = LOOKUP_COLUMNS.get(type(obj))
+        if column is not None:
+            stale.add((type(obj), str(getattr(obj, column))))
+    for obj in session.deleted:
+        for model, column, parent_column in _cascades(type(obj)):
+            references.add((model, column, str(getattr(obj, parent_column))))
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_changes(session):
+    ''' Invalidate the rows changed by the committed transaction '''
+    stale = session.info.pop("stale_entities", None)
+    references = session.info.pop("stale_references", None)
+    cache = _get_cache()
+    if stale and cache is not None:
+        for model, key in stale:
+            cache.invalidate(model, key)
+    if references and cache is not None:
+        values = {}
+        for model, column, value in references:
+            values.setdefault((model, column), set()).add(value)
+        for (model, column), keys in values.items():
+            cache.invalidate_references(model, column, keys)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_changes(session):
+    ''' Rolled back changes never reached the database '''
+    session.info.pop("stale_entities", None)
+    session.info.pop("stale_references", None)
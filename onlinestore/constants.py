@@ -9,3 +9,18 @@ CUSTOMER_PROFILE = "/profiles/customer/"
 ORDER_PROFILE = "/profiles/order/"
 PRODUCTORDER_PROFILE = "/profiles/productorder/"
 STOCK_PROFILE = "/profiles/stock/"
+REPORT_PROFILE = "/profiles/report/"
+
+# Keyset pagination of collection resources
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Streamed collection exports
+NDJSON = "application/x-ndjson"
+STREAM_BATCH_SIZE = 1000
+
+# Largest array accepted by the batch create endpoints
+MAX_BATCH_SIZE = 1000
+
+# Largest stock quantity and stock adjustment, fits the 32-bit integer columns
+MAX_QUANTITY = 2 ** 31 - 1
@@ -0,0 +1,241 @@
+'''
+Synthetic data generator for capacity testing of onlinestore API
+'''
+import contextlib
+import datetime
+import itertools
+import random
+import time
+import uuid
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import func, insert, select, text
+
+from onlinestore import db
+from onlinestore.models import (
+    REPORTS, Customer, CustomerSales, DailySales, Order, Product, ProductOrder, ProductSales,
+    Revision, Stock, rebuild_reports
+)
+
+# Rows per executemany and orders per transaction
+BATCH_SIZE = 10000
+TRANSACTION_SIZE = 100000
+
+# Share of orders by number of product orders and of product orders by quantity
+ORDER_SIZES = {1: 30, 2: 25, 3: 17, 4: 10, 5: 7, 6: 4, 7: 3, 8: 2, 10: 1, 15: 1}
+QUANTITIES = {1: 70, 2: 18, 3: 7, 5: 3, 10: 2}
+
+
+def zipf_weights(count, exponent):
+    ''' Cumulative weights of *count* values, the k-th has weight 1 / k ** exponent '''
+    return list(itertools.accumulate(1 / rank ** exponent for rank in range(1, count + 1)))
+
+
+def _next_id(connection, model):
+    return (connection.scalar(select(func.max(model.id))) or 0) + 1
+
+
+def _insert(connection, model, columns, rows):
+    '''
+    Insert rows given as tuples of *columns* with one executemany per batch.
+    The statement is compiled once and only the bind processors of the
+    column types are applied, the parameter handling of Core for every row
+    costs more than the inserts.
+    '''
+    table = model.__table__
+    dialect = connection.dialect
+    compiled = insert(table).compile(dialect=dialect, column_keys=columns)
+    processors = [
+        (i, processor) for i, processor in enumerate(
+            table.c[name].type.bind_processor(dialect) for name in columns
+        ) if processor is not None
+    ]
+    order = None
+    if compiled.positional and list(compiled.positiontup) != list(columns):
+        order = [columns.index(name) for name in compiled.positiontup]
+
+    def parameters(row):
+        if processors:
+            row = list(row)
+            for i, processor in processors:
+                row[i] = processor(row[i])
+        if not compiled.positional:
+            return dict(zip(columns, row))
+        if order is not None:
+            return tuple(row[i] for i in order)
+        return tuple(row)
+
+    rows = iter(rows)
+    while True:
+        batch = [parameters(row) for row in itertools.islice(rows, BATCH_SIZE)]
+        if not batch:
+            return
+        connection.exec_driver_sql(compiled.string, batch)
+
+
+def _reset_sequences(connection, models):
+    ''' Move the sequences of the IDs past the inserted rows on PostgreSQL '''
+    if connection.dialect.name != "postgresql":
+        return
+    for model in models:
+        table = model.__table__.name
+        connection.execute(text(
+            f"SELECT setval(pg_get_serial_sequence('\"{table}\"', 'id'), "
+            f"(SELECT max(id) FROM \"{table}\"))"
+        ))
+
+
+@contextlib.contextmanager
+def _without_indexes(engine, models):
+    '''
+    Drop the secondary indexes of the tables of *models* and build them again
+    at the end. Sorting the rows once costs less than updating the indexes
+    with every row for tables that start empty.
+    '''
+    indexes = [index for model in models for index in model.__table__.indexes]
+    with engine.begin() as connection:
+        for index in indexes:
+            index.drop(connection)
+    try:
+        yield
+    finally:
+        with engine.begin() as connection:
+            for index in indexes:
+                index.create(connection)
+
+
+def _add(sums, key, quantity, revenue):
+    units, total = sums.get(key, (0, 0.0))
+    sums[key] = (units + quantity, total + revenue)
+
+
+def generate(engine, customers, products, orders, seed=0, exponent=1.1, days=365, stock=None,
+             end=None):
+    '''
+    Add *customers* customers, *products* products with their stock and
+    *orders* orders to a database. The same seed generates the same rows.
+    Products are ordered with Zipf popularity of *exponent*, orders have
+    the sizes of ORDER_SIZES and are spread over the *days* days before
+    *end*, by default the start of the current day in UTC. The stock of
+    every product is *stock* or random up to 1000 units. Orders reference
+    only the customers and products generated with them.
+
+    The rows are inserted with executemany in transactions of
+    TRANSACTION_SIZE orders, bypassing the ORM, so the order totals and the
+    reports are computed here. Into a database without orders, the orders
+    are inserted without indexes, which are built at the end. Returns the
+    number of product orders.
+    '''
+    rng = random.Random(seed)
+    with engine.begin() as connection:
+        first_customer = _next_id(connection, Customer)
+        first_product = _next_id(connection, Product)
+        first_order = _next_id(connection, Order)
+        first_line = _next_id(connection, ProductOrder)
+
+        uuids = [str(uuid.UUID(int=rng.getrandbits(128), version=4)) for _ in range(customers)]
+        prices = [round(rng.lognormvariate(3, 1), 2) or 0.01 for _ in range(products)]
+        _insert(connection, Customer, ["id", "uuid", "firstName", "lastName", "email", "phone"], (
+            (first_customer + i, uuids[i], f"First{first_customer + i}",
+             f"Last{first_customer + i}", f"customer{first_customer + i}@example.com",
+             f"040{first_customer + i:07d}")
+            for i in range(customers)
+        ))
+        _insert(connection, Product, ["id", "name", "desc", "price"], (
+            (first_product + i, f"Product {first_product + i}",
+             f"Description of product {first_product + i}", prices[i])
+            for i in range(products)
+        ))
+        _insert(connection, Stock, ["productId", "quantity"], (
+            (first_product + i, rng.randint(0, 1000) if stock is None else stock)
+            for i in range(products)
+        ))
+
+    reports = {ProductSales: {}, DailySales: {}, CustomerSales: {}}
+    line_id = first_line
+    if not (orders and customers and products):
+        orders = 0
+    # The app can't be serving a database without orders, so their indexes can be dropped
+    indexes = contextlib.nullcontext()
+    if first_order == first_line == 1 and orders >= TRANSACTION_SIZE:
+        indexes = _without_indexes(engine, [Order, ProductOrder])
+    with indexes:
+        # Products by popularity
+        popular = list(range(products))
+        rng.shuffle(popular)
+        popularity = zipf_weights(products, exponent)
+        sizes = list(itertools.accumulate(ORDER_SIZES.values()))
+        quantities = list(itertools.accumulate(QUANTITIES.values()))
+        if end is None:
+            end = datetime.datetime.combine(
+                datetime.datetime.now(datetime.timezone.utc).date(), datetime.time()
+            )
+        # The IDs of the orders follow their creation times
+        seconds = sorted(rng.randrange(days * 86400) for _ in range(orders))
+        for start in range(0, orders, TRANSACTION_SIZE):
+            count = min(orders - start, TRANSACTION_SIZE)
+            order_sizes = rng.choices(list(ORDER_SIZES), cum_weights=sizes, k=count)
+            lines = sum(order_sizes)
+            picks = rng.choices(popular, cum_weights=popularity, k=lines)
+            units = rng.choices(list(QUANTITIES), cum_weights=quantities, k=lines)
+            buyers = rng.choices(uuids, k=count)
+
+            order_rows, line_rows = [], []
+            line = 0
+            for n, size in enumerate(order_sizes):
+                order_id = first_order + start + n
+                total, items = 0.0, 0
+                for i, quantity in zip(picks[line:line + size], units[line:line + size]):
+                    revenue = quantity * prices[i]
+                    line_rows.append((line_id, order_id, first_product + i, quantity, prices[i]))
+                    _add(reports[ProductSales], first_product + i, quantity, revenue)
+                    line_id += 1
+                    total += revenue
+                    items += quantity
+                line += size
+                created = end - datetime.timedelta(seconds=days * 86400 - seconds[start + n])
+                order_rows.append((order_id, buyers[n], created, round(total, 2), items))
+                _add(reports[DailySales], created.date(), items, total)
+                _add(reports[CustomerSales], buyers[n], items, total)
+            with engine.begin() as connection:
+                _insert(connection, Order,
+                        ["id", "customerId", "createdAt", "total", "itemCount"], order_rows)
+                _insert(connection, ProductOrder,
+                        ["id", "orderId", "productId", "quantity", "unitPrice"], line_rows)
+
+    with engine.begin() as connection:
+        _reset_sequences(connection, [Customer, Product, Order, ProductOrder])
+        if first_line > 1:
+            # The sums would have to be added to those of the existing orders
+            rebuild_reports(connection)
+        elif line_id > first_line:
+            for model, key_column in REPORTS.items():
+                _insert(connection, model, [key_column.key, "quantity", "revenue"], (
+                    (key, quantity, round(revenue, 2))
+                    for key, (quantity, revenue) in reports[model].items()
+                ))
+        Revision.bump(connection, {model.__tablename__ for model in (
+            Customer, Product, Stock, Order, ProductOrder, ProductSales, DailySales, CustomerSales
+        )})
+    return line_id - first_line
+
+
+@click.command("generate-data")
+@click.option("--customers", default=1000, show_default=True)
+@click.option("--products", default=1000, show_default=True)
+@click.option("--orders", default=10000, show_default=True)
+@click.option("--seed", default=0, show_default=True, help="Same seed, same data")
+@click.option("--zipf", "exponent", default=1.1, show_default=True,
+              help="Exponent of the Zipf popularity of the products")
+@click.option("--days", default=365, show_default=True, help="Days the orders are spread over")
+@with_appcontext
+def generate_data_command(customers, products, orders, seed, exponent, days):
+    ''' Add generated customers, products, stock and orders to the database '''
+    db.create_all()
+    start = time.perf_counter()
+    lines = generate(db.engine, customers, products, orders, seed, exponent, days)
+    click.echo(
+        f"Generated {customers} customers, {products} products, {orders} orders and "
+        f"{lines} product orders in {time.perf_counter() - start:.1f} s"
+    )
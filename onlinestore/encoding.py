@@ -0,0 +1,95 @@
+'''
+JSON encoding of onlinestore API responses
+'''
+import json
+from flask import current_app, has_app_context
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _json_dumps(obj):
+    return json.dumps(obj).encode()
+
+
+def _orjson_dumps(obj):
+    return orjson.dumps(obj)
+
+
+# Available encoders by the name used in the JSON_ENCODER setting
+ENCODERS = {"json": _json_dumps}
+if orjson is not None:
+    ENCODERS["orjson"] = _orjson_dumps
+
+
+def init_app(app):
+    '''
+    Select the JSON encoder of the app with the JSON_ENCODER setting. The
+    default "auto" uses orjson if it is installed and the json module of the
+    standard library otherwise.
+    '''
+    name = app.config.get("JSON_ENCODER", "auto")
+    if name == "auto":
+        name = "orjson" if orjson is not None else "json"
+    if name not in ENCODERS:
+        raise ValueError(f"JSON encoder '{name}' is not available")
+    app.extensions["json_encoder"] = ENCODERS[name]
+    app.extensions["json_fragments"] = {}
+
+
+def get_dumps():
+    ''' Get the function that encodes objects to JSON bytes in the current app '''
+    if has_app_context():
+        return current_app.extensions.get("json_encoder", _json_dumps)
+    return _json_dumps
+
+
+def dumps(obj):
+    ''' Encode an object to JSON bytes with the encoder of the current app '''
+    return get_dumps()(obj)
+
+
+def splice(raw, members):
+    '''
+    Add members to an encoded JSON object.
+
+    : param bytes raw: the encoded object
+    : param list members: (encoded name, encoded value) pairs
+    '''
+    if not members:
+        return raw
+    tail = b", ".join(name + b": " + value for name, value in members)
+    if raw == b"{}":
+        return b"{" + tail + b"}"
+    return raw[:-1] + b", " + tail + b"}"
+
+
+def _is_fragment(value):
+    if isinstance(value, bytes):
+        return True
+    return isinstance(value, list) and bool(value) and isinstance(value[0], bytes)
+
+
+def encode(document):
+    '''
+    Encode a document to JSON bytes. Values of the document that are bytes are
+    fragments of already encoded JSON. Fragments, lists of fragments and the
+    dictionaries directly containing them are spliced into the result, the
+    rest of the document is encoded with a single call to the encoder. Neither
+    encoder accepts bytes otherwise, so fragments can't be confused with data.
+    '''
+    plain, members = {}, []
+    for name, value in document.items():
+        if isinstance(value, bytes):
+            members.append((_json_dumps(name), value))
+        elif _is_fragment(value):
+            members.append((_json_dumps(name), b"[" + b", ".join(value) + b"]"))
+        elif isinstance(value, dict) and any(_is_fragment(v) for v in value.values()):
+            members.append((_json_dumps(name), encode(value)))
+        else:
+            plain[name] = value
+    if not members:
+        return dumps(document)
+    return splice(dumps(plain), members)
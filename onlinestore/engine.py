@@ -0,0 +1,136 @@
+'''
+Database engine configuration of onlinestore API
+'''
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+from onlinestore import db
+
+# Pragmas set on every new SQLite connection by profile. The values taken from
+# the settings are filled in by _pragmas.
+PROFILES = {
+    # The SQLite defaults apart from foreign keys: rollback journal, a full
+    # fsync on every commit and writers failing at once with "database is locked"
+    "default": {},
+    # Readers don't block the writer and the writer doesn't block readers in
+    # WAL mode. With synchronous=NORMAL a commit only appends to the WAL, which
+    # is synced at checkpoints; a power loss can lose the last commits but
+    # never corrupts the database.
+    "production": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "temp_store": "MEMORY",
+    },
+}
+
+# Pool of the production profile. SQLite connections are cheap, the pool
+# keeps one per worker thread and waits for a free one instead of failing.
+POOL_OPTIONS = {
+    "pool_size": 8,
+    "max_overflow": 8,
+    "pool_timeout": 30,
+}
+
+# Engine options of client/server databases by setting, with their defaults.
+# Connections are checked before use, so workers survive database restarts
+# and connections closed by the server or a proxy.
+SERVER_OPTIONS = {
+    "pool_size": ("DATABASE_POOL_SIZE", 10),
+    "max_overflow": ("DATABASE_MAX_OVERFLOW", 20),
+    "pool_timeout": ("DATABASE_POOL_TIMEOUT", 30),
+    "pool_recycle": ("DATABASE_POOL_RECYCLE", 1800),
+    "pool_pre_ping": ("DATABASE_POOL_PRE_PING", True),
+}
+
+
+def _is_sqlite_file(uri):
+    ''' Whether a database URI is a SQLite database in a file '''
+    url = make_url(uri)
+    if url.get_backend_name() != "sqlite":
+        return False
+    return url.database not in (None, "", ":memory:") and url.query.get("mode") != "memory"
+
+
+def _profile(app):
+    ''' Name of the SQLite profile selected with the SQLITE_PROFILE setting '''
+    name = app.config.get("SQLITE_PROFILE", "default")
+    if name not in PROFILES:
+        raise ValueError(f"SQLite profile '{name}' doesn't exist")
+    return name
+
+
+def _pragmas(app):
+    ''' Pragmas of the SQLite profile of the app '''
+    name = _profile(app)
+    # Foreign keys are enforced with every profile, the models rely on the
+    # ON DELETE actions of the database
+    pragmas = {"foreign_keys": "ON", **PROFILES[name]}
+    if name != "default":
+        pragmas["busy_timeout"] = app.config.get("SQLITE_BUSY_TIMEOUT", 5000)
+        pragmas["mmap_size"] = app.config.get("SQLITE_MMAP_SIZE", 256 * 1024 * 1024)
+        # Negative sizes are in KiB instead of pages
+        pragmas["cache_size"] = -app.config.get("SQLITE_CACHE_SIZE", 16 * 1024)
+    return pragmas
+
+
+def database_uri(url):
+    ''' SQLAlchemy URI of a database URL, postgres:// is the old name of postgresql:// '''
+    if url.startswith("postgres://"):
+        return "postgresql://" + url[len("postgres://"):]
+    return url
+
+
+def _engine_options(app, uri):
+    ''' Engine options of the backend of a database URI '''
+    options = {}
+    if make_url(uri).get_backend_name() != "sqlite":
+        options = {
+            option: app.config.get(name, default)
+            for option, (name, default) in SERVER_OPTIONS.items()
+        }
+        options["isolation_level"] = app.config.get("DATABASE_ISOLATION_LEVEL", "READ COMMITTED")
+        return options
+    if _is_sqlite_file(uri) and _profile(app) != "default":
+        options.update(POOL_OPTIONS)
+    if app.config.get("DATABASE_ISOLATION_LEVEL"):
+        options["isolation_level"] = app.config["DATABASE_ISOLATION_LEVEL"]
+    return options
+
+
+def configure(app):
+    '''
+    Select the database and add the options of its backend to the engine
+    options of the app. The DATABASE_URL setting overrides
+    SQLALCHEMY_DATABASE_URI. Client/server databases get a pool checked
+    before use and the isolation level of DATABASE_ISOLATION_LEVEL, SQLite
+    files the pool of their profile. Called before the engine is created,
+    options set in SQLALCHEMY_ENGINE_OPTIONS take precedence.
+    '''
+    if app.config.get("DATABASE_URL"):
+        app.config["SQLALCHEMY_DATABASE_URI"] = database_uri(app.config["DATABASE_URL"])
+    uri = app.config.get("SQLALCHEMY_DATABASE_URI")
+    if uri is None:
+        return
+    options = _engine_options(app, uri)
+    options.update(app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}))
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = options
+
+
+def init_app(app):
+    '''
+    Set the pragmas of the SQLite profile selected with the SQLITE_PROFILE
+    setting on every connection the engine of the app opens.
+    '''
+    pragmas = _pragmas(app)
+    with app.app_context():
+        engine = db.engine
+    if engine.dialect.name != "sqlite":
+        return
+
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+    event.listen(engine, "connect", set_pragmas)
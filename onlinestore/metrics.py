@@ -0,0 +1,328 @@
+'''
+Prometheus metrics of onlinestore API
+'''
+import glob
+import json
+import os
+import threading
+import time
+import weakref
+
+from flask import Response, current_app, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from onlinestore import db
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+# Exported metrics: (type, help, buckets of histograms)
+METRICS = {
+    "onlinestore_requests_total": (
+        "counter", "Requests by endpoint, method and status", None),
+    "onlinestore_requests_in_flight": (
+        "gauge", "Requests being handled", None),
+    "onlinestore_request_duration_seconds": (
+        "histogram", "Time to handle a request by endpoint and method", LATENCY_BUCKETS),
+    "onlinestore_response_size_bytes": (
+        "histogram", "Size of the response bodies by endpoint and method", SIZE_BUCKETS),
+    "onlinestore_db_commit_duration_seconds": (
+        "histogram", "Time to flush and commit a transaction", LATENCY_BUCKETS),
+    "onlinestore_db_pool_connections": (
+        "gauge", "Connections of the database pool by state", None),
+}
+
+
+class _Holder:
+    ''' Holds the store of a thread in its thread local, dropped when the thread exits '''
+    __slots__ = ("store", "__weakref__")
+
+
+class Metrics:
+    """
+    Counters and histograms of one worker process. Every thread updates its
+    own counters without locking, they are added up when the metrics are
+    read. The counters of threads that have exited are added to the retired
+    ones, so the servers starting a thread per request don't keep a store
+    for every request. With a directory, the process writes its counters to a file there
+    at most every *interval* seconds and reading the metrics adds up the
+    files of every process, so any worker can serve the metrics of all.
+    Counters of processes that have exited are kept, their gauges dropped.
+    """
+
+    def __init__(self, directory=None, interval=1.0, pid=None):
+        self.directory = directory
+        self.interval = interval
+        self._pid = pid
+        self._local = threading.local()
+        # Stores of the running threads by ID and the values of the exited ones
+        self._stores = {}
+        self._retired = {}
+        # Only taken when a thread starts or stops recording and to read the values
+        self._lock = threading.Lock()
+        self._flushed = 0.0
+        self.gauges = None
+
+    @property
+    def pid(self):
+        ''' ID of the process, read on use as workers may be forked after the app is created '''
+        return os.getpid() if self._pid is None else self._pid
+
+    def _store(self):
+        holder = getattr(self._local, "holder", None)
+        if holder is None:
+            holder = self._local.holder = _Holder()
+            holder.store = {}
+            with self._lock:
+                self._stores[id(holder.store)] = holder.store
+            # The thread local is cleared when the thread exits
+            weakref.finalize(holder, self._retire, holder.store)
+        return holder.store
+
+    def _retire(self, store):
+        ''' Add the values of an exited thread to the retired ones and drop its store '''
+        with self._lock:
+            del self._stores[id(store)]
+            for key, value in store.items():
+                _merge(self._retired, key, value)
+
+    def inc(self, name, labels=(), value=1):
+        ''' Add to a counter or gauge '''
+        store = self._store()
+        key = (name, labels)
+        store[key] = store.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        ''' Add a value to a histogram '''
+        buckets = METRICS[name][2]
+        store = self._store()
+        counts = store.get((name, labels))
+        if counts is None:
+            # A count per bucket, the +Inf bucket and the sum of the values
+            counts = store[(name, labels)] = [0] * (len(buckets) + 1) + [0.0]
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(buckets)
+        counts[i] += 1
+        counts[-1] += value
+
+    def snapshot(self):
+        ''' Values of this process as {(name, labels): value or histogram counts} '''
+        values = {}
+        with self._lock:
+            stores = list(self._stores.values())
+            for key, value in self._retired.items():
+                _merge(values, key, value)
+        for store in stores:
+            for key, value in list(store.items()):
+                _merge(values, key, value)
+        if self.gauges is not None:
+            for key, value in self.gauges().items():
+                _merge(values, key, value)
+        return values
+
+    def _path(self, pid):
+        return os.path.join(self.directory, f"metrics-{pid}.json")
+
+    def flush(self, force=False):
+        ''' Write the values of this process to its file in the directory '''
+        now = time.monotonic()
+        if not self.directory or (not force and now - self._flushed < self.interval):
+            return
+        self._flushed = now
+        data = [[name, labels, value] for (name, labels), value in self.snapshot().items()]
+        path = self._path(self.pid)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(path + ".tmp", path)
+
+    def collect(self):
+        ''' Values of every process '''
+        values = self.snapshot()
+        if not self.directory:
+            return values
+        for path in glob.glob(os.path.join(self.directory, "metrics-*.json")):
+            pid = int(os.path.basename(path)[len("metrics-"):-len(".json")])
+            if pid == self.pid:
+                continue
+            try:
+                with open(path, encoding="utf-8") as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            alive = _alive(pid)
+            for name, labels, value in data:
+                if alive or METRICS[name][0] != "gauge":
+                    _merge(values, (name, tuple(tuple(label) for label in labels)), value)
+        return values
+
+    def render(self):
+        ''' The values of every process in the Prometheus text format '''
+        values = self.collect()
+        lines = []
+        for name, (kind, description, buckets) in METRICS.items():
+            keys = sorted(key for key in values if key[0] == name)
+            if not keys:
+                continue
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key in keys:
+                labels = key[1]
+                if kind != "histogram":
+                    lines.append(f"{name}{_labels(labels)} {_number(values[key])}")
+                    continue
+                counts = values[key]
+                total = 0
+                for bound, count in zip(buckets + ("+Inf",), counts):
+                    total += count
+                    le = labels + (("le", _number(bound)),)
+                    lines.append(f"{name}_bucket{_labels(le)} {total}")
+                lines.append(f"{name}_sum{_labels(labels)} {_number(counts[-1])}")
+                lines.append(f"{name}_count{_labels(labels)} {total}")
+        return "\n".join(lines) + "\n"
+
+
+def _merge(values, key, value):
+    if isinstance(value, list):
+        counts = values.get(key)
+        values[key] = list(value) if counts is None else [a + b for a, b in zip(counts, value)]
+    else:
+        values[key] = values.get(key, 0) + value
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def _number(value):
+    if isinstance(value, str):
+        return value
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _get_metrics():
+    if not has_app_context():
+        return None
+    return current_app.extensions.get("metrics")
+
+
+def _pool_gauges():
+    ''' Connections of the pool of the engine of the app by state '''
+    pool = db.engine.pool
+    if not hasattr(pool, "checkedout"):
+        # SQLite memory databases and NullPool have no fixed pool
+        return {}
+    name = "onlinestore_db_pool_connections"
+    return {
+        (name, (("state", "size"),)): pool.size(),
+        (name, (("state", "checked_out"),)): pool.checkedout(),
+        (name, (("state", "idle"),)): pool.checkedin(),
+        (name, (("state", "overflow"),)): max(pool.overflow(), 0),
+    }
+
+
+def _start_request():
+    g._metrics_start = time.perf_counter()
+    current_app.extensions["metrics"].inc("onlinestore_requests_in_flight")
+
+
+def _record_response(response):
+    '''
+    Record the status and size of the response. The duration is recorded
+    when the request is torn down, after streamed bodies have been sent.
+    '''
+    g._metrics_status = response.status_code
+    labels = (("endpoint", request.endpoint or "unmatched"), ("method", request.method))
+    if response.content_length is not None:
+        current_app.extensions["metrics"].observe(
+            "onlinestore_response_size_bytes", labels, response.content_length
+        )
+    return response
+
+
+def _finish_request(exc):
+    start = g.pop("_metrics_start", None)
+    if start is None:
+        return
+    metrics = current_app.extensions["metrics"]
+    labels = (("endpoint", request.endpoint or "unmatched"), ("method", request.method))
+    metrics.inc("onlinestore_requests_in_flight", value=-1)
+    metrics.inc("onlinestore_requests_total", labels + (
+        ("status", str(g.pop("_metrics_status", 500))),
+    ))
+    metrics.observe("onlinestore_request_duration_seconds", labels, time.perf_counter() - start)
+    metrics.flush()
+
+
+@event.listens_for(Session, "before_commit")
+def _start_commit(session):
+    if _get_metrics() is not None:
+        session.info["metrics_commit_start"] = time.perf_counter()
+
+
+@event.listens_for(Session, "after_commit")
+def _finish_commit(session):
+    start = session.info.pop("metrics_commit_start", None)
+    metrics = _get_metrics()
+    if start is not None and metrics is not None:
+        metrics.observe("onlinestore_db_commit_duration_seconds", (), time.perf_counter() - start)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_commit(session):
+    session.info.pop("metrics_commit_start", None)
+
+
+def send_metrics():
+    ''' The metrics of every worker in the Prometheus text format '''
+    metrics = current_app.extensions["metrics"]
+    metrics.flush(force=True)
+    return Response(metrics.render(), 200, content_type=CONTENT_TYPE)
+
+
+def init_app(app):
+    '''
+    Record the metrics of the app if METRICS is set and serve them at
+    /metrics. Workers of the same deployment share them through the files
+    in METRICS_DIR, written at most every METRICS_FLUSH_INTERVAL seconds.
+    '''
+    if not app.config.get("METRICS", True):
+        return
+    directory = app.config.get("METRICS_DIR")
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    metrics = Metrics(directory, app.config.get("METRICS_FLUSH_INTERVAL", 1.0))
+    app.extensions["metrics"] = metrics
+
+    def gauges():
+        with app.app_context():
+            return _pool_gauges()
+
+    metrics.gauges = gauges
+    app.before_request(_start_request)
+    app.after_request(_record_response)
+    app.teardown_request(_finish_request)
+    app.add_url_rule("/metrics", "metrics", send_metrics)
@@ -1,14 +1,75 @@
 """
 Database models for onlinestore API
 """
+import re
 import uuid
+from datetime import datetime, timezone
 import click
+from flask import current_app
 from flask.cli import with_appcontext
+from sqlalchemy import delete, event, func, insert, inspect, select, text, type_coerce, update
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import Session, column_property
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateColumn, CreateTable
+from sqlalchemy.sql.functions import FunctionElement
 from onlinestore import db
+from onlinestore.constants import MAX_QUANTITY
+
+
+def utcnow():
+    ''' Current time as a naive UTC datetime, the way times are stored '''
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def format_datetime(moment):
+    ''' Format a stored naive UTC datetime as ISO 8601 with the UTC offset '''
+    if moment is None:
+        return None
+    return moment.replace(tzinfo=timezone.utc).isoformat()
+
+
+class round_money(FunctionElement):
+    '''
+    A price rounded to cents in SQL. ROUND of a float with a number of
+    decimals doesn't exist in PostgreSQL, it rounds a numeric instead.
+    '''
+    type = db.Float()
+    name = "round_money"
+    inherit_cache = True
+
+
+@compiles(round_money)
+def _compile_round_money(element, compiler, **kw):
+    return f"ROUND({compiler.process(element.clauses, **kw)}, 2)"
+
+
+@compiles(round_money, "postgresql")
+def _compile_round_money_postgresql(element, compiler, **kw):
+    return f"CAST(ROUND(CAST({compiler.process(element.clauses, **kw)} AS NUMERIC), 2) AS FLOAT)"
+
+
+def update_returning(connection, statement, key, *columns):
+    '''
+    Execute an UPDATE of one row and return the columns of the updated row,
+    or None if no row was updated. Backends without UPDATE ... RETURNING
+    (MySQL, MariaDB) read the row back by *key*, a condition selecting it,
+    in the same transaction. The UPDATE keeps the row locked until then.
+    '''
+    if connection.dialect.update_returning:
+        return connection.execute(statement.returning(*columns)).first()
+    if connection.execute(statement).rowcount == 0:
+        return None
+    return connection.execute(select(*columns).where(key)).first()
 
 
 class Customer(db.Model):
     """ Customer model """
+    # Columns the collection can be filtered and sorted by, see utils.query_collection.
+    # Only indexed, non-null columns can be sorted by.
+    FILTERS = ("uuid", "email", "firstName", "lastName", "phone")
+    SORTS = ("id", "uuid", "email")
+
     id = db.Column(db.Integer, primary_key=True, nullable=False)
     uuid = db.Column(db.String(36), default=lambda: str(uuid.uuid4()), unique=True, nullable=False)
     firstName = db.Column(db.String(50), nullable=False)
@@ -16,7 +77,9 @@ class Customer(db.Model):
     email = db.Column(db.String(50), nullable=False, unique=True)
     phone = db.Column(db.String(50), nullable=True)
 
-    orders = db.relationship('Order', back_populates="customer")
+    # The database sets customerId of the orders to null (ON DELETE SET NULL),
+    # deleting a customer doesn't load their orders
+    orders = db.relationship('Order', back_populates="customer", passive_deletes=True)
 
     def serialize(self):
         ''' Return customer data as a dictionary '''
@@ -52,28 +115,42 @@ class Customer(db.Model):
 
 class Order(db.Model):
     """ Order model """
+    FILTERS = ("customerId", "createdAt")
+    SORTS = ("id", "createdAt")
+
     id = db.Column(db.Integer, primary_key=True, nullable=False)
 
-    # Set foreign key to null if customer is deleted
-    customerId = db.Column(db.String(36), db.ForeignKey('customer.uuid', ondelete="SET NULL"))
-    createdAt = db.Column(db.String(50), nullable=False)
+    # Set foreign key to null if customer is deleted. The value before a change
+    # is loaded even if expired, onlinestore.reports moves the total with it
+    customerId = column_property(db.Column(
+        db.String(36), db.ForeignKey('customer.uuid', ondelete="SET NULL"), index=True),
+        active_history=True)
+    # Naive UTC time, assigned by the server when the order is inserted
+    createdAt = db.Column(db.DateTime, nullable=False, index=True, default=utcnow)
+    # Maintained from the product orders by onlinestore.totals
+    total = db.Column(db.Float, nullable=False, default=0, server_default="0")
+    itemCount = db.Column(db.Integer, nullable=False, default=0, server_default="0")
 
     customer = db.relationship('Customer', back_populates="orders")
+    # The database deletes the product orders of a deleted order (ON DELETE
+    # CASCADE), they aren't loaded to be deleted one by one
     productOrders = db.relationship(
-        'ProductOrder', cascade="all, delete-orphan", back_populates="order")
+        'ProductOrder', cascade="all, delete-orphan", back_populates="order",
+        order_by='ProductOrder.id', passive_deletes=True)
 
     def serialize(self):
         ''' Return order data as a dictionary '''
         return {
             'id': self.id,
             'customerId': self.customerId,
-            'createdAt': self.createdAt
+            'createdAt': format_datetime(self.createdAt),
+            'total': self.total,
+            'itemCount': self.itemCount
         }
 
     def deserialize(self, data):
-        ''' Update order data from a dictionary '''
+        ''' Update order data from a dictionary, the creation time can't be changed '''
         self.customerId = data['customerId']
-        self.createdAt = data['createdAt']
 
     @staticmethod
     def json_schema():
@@ -82,18 +159,64 @@ class Order(db.Model):
             "type": "object",
             "properties": {
                 "customerId": {"type": "string"},
-                "createdAt": {"type": "string"}
+                "createdAt": {"type": "string", "readOnly": True},
+                "total": {"type": "number", "readOnly": True},
+                "itemCount": {"type": "integer", "readOnly": True}
+            },
+            "required": ["customerId"]
+        }
+
+    @staticmethod
+    def place_schema():
+        ''' JSON schema for placing an order together with its product orders '''
+        # Every line must order at least one product
+        return {
+            "type": "object",
+            "properties": {
+                "customerId": {"type": "string"},
+                "createdAt": {"type": "string", "readOnly": True},
+                "productOrders": {
+                    "type": "array",
+                    "minItems": 1,
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "productId": {"type": "integer"},
+                            "quantity": {
+                                "type": "integer", "minimum": 1, "maximum": MAX_QUANTITY
+                            }
+                        },
+                        "required": ["productId", "quantity"]
+                    }
+                }
             },
-            "required": ["customerId", "createdAt"]
+            "required": ["customerId", "productOrders"]
         }
 
 
 class ProductOrder(db.Model):
     """ ProductOrder model """
+    FILTERS = ("orderId", "productId", "quantity")
+    SORTS = ("id",)
+
+    # The composite index also serves the lookups by orderId alone
+    __table_args__ = (
+        db.Index("ix_product_order_orderId_productId", "orderId", "productId"),
+    )
+
+    # Values before a change are loaded even if expired, the totals and the
+    # reports subtract them
     id = db.Column(db.Integer, primary_key=True, nullable=False)
-    orderId = db.Column(db.Integer, db.ForeignKey('order.id', ondelete="CASCADE"), nullable=False)
-    productId = db.Column(db.Integer, db.ForeignKey('product.id', ondelete="SET NULL"))
-    quantity = db.Column(db.Integer, nullable=False)
+    orderId = column_property(db.Column(
+        db.Integer, db.ForeignKey('order.id', ondelete="CASCADE"), nullable=False),
+        active_history=True)
+    productId = column_property(db.Column(
+        db.Integer, db.ForeignKey('product.id', ondelete="SET NULL"), index=True),
+        active_history=True)
+    quantity = column_property(db.Column(db.Integer, nullable=False), active_history=True)
+    # Price of the product when the line was added, later price changes don't affect the order
+    unitPrice = column_property(
+        db.Column(db.Float, nullable=False, default=0, server_default="0"), active_history=True)
 
     order = db.relationship('Order', back_populates="productOrders")
     product = db.relationship('Product', back_populates="productOrder")
@@ -104,7 +227,8 @@ class ProductOrder(db.Model):
             'id': self.id,
             'orderId': self.orderId,
             'productId': self.productId,
-            'quantity': self.quantity
+            'quantity': self.quantity,
+            'unitPrice': self.unitPrice
         }
 
     def deserialize(self, data):
@@ -122,7 +246,8 @@ class ProductOrder(db.Model):
             "properties": {
                 "orderId": {"type": "integer"},
                 "productId": {"type": "integer"},
-                "quantity": {"type": "integer", "minimum": 0}
+                "quantity": {"type": "integer", "minimum": 0, "maximum": MAX_QUANTITY},
+                "unitPrice": {"type": "number", "readOnly": True}
             },
             "required": ["orderId", "productId", "quantity"]
         }
@@ -130,13 +255,19 @@ class ProductOrder(db.Model):
 
 class Product(db.Model):
     """ Product model """
+    FILTERS = ("name", "price")
+    SORTS = ("id", "name")
+
     id = db.Column(db.Integer, primary_key=True, nullable=False)
     name = db.Column(db.String(64), nullable=False, unique=True)
     desc = db.Column(db.String(128), nullable=False)
     price = db.Column(db.Float, nullable=False)
 
-    productOrder = db.relationship('ProductOrder', back_populates="product")
-    stock = db.relationship('Stock', cascade="all, delete-orphan", back_populates="stockProduct")
+    # The database nulls productId of the product orders and deletes the stock
+    productOrder = db.relationship('ProductOrder', back_populates="product", passive_deletes=True)
+    stock = db.relationship(
+        'Stock', cascade="all, delete-orphan", back_populates="stockProduct",
+        passive_deletes=True)
 
     def serialize(self):
         ''' Return product data as a dictionary '''
@@ -168,6 +299,9 @@ class Product(db.Model):
 
 class Stock(db.Model):
     """ Stock model """
+    FILTERS = ("productId", "quantity")
+    SORTS = ("productId",)
+
     productId = db.Column(db.Integer, db.ForeignKey(
         'product.id', ondelete="CASCADE"), primary_key=True, nullable=False)
     quantity = db.Column(db.Integer)
@@ -194,14 +328,618 @@ class Stock(db.Model):
             "type": "object",
             "properties": {
                 "productId": {"type": "integer"},
-                "quantity": {"type": "integer", "minimum": 0}
+                "quantity": {"type": "integer", "minimum": 0, "maximum": MAX_QUANTITY}
             },
             "required": ["productId", "quantity"]
         }
 
+    @staticmethod
+    def adjust_schema():
+        ''' JSON schema for a relative stock adjustment '''
+        # Negative delta takes products from stock
+        return {
+            "type": "object",
+            "properties": {
+                "delta": {"type": "integer", "minimum": -MAX_QUANTITY, "maximum": MAX_QUANTITY}
+            },
+            "required": ["delta"]
+        }
+
+    @staticmethod
+    def adjust(product_id, delta):
+        '''
+        Add delta (negative to take products) to the stock quantity of a
+        product with a single conditional UPDATE, so there is no
+        read-modify-write race between concurrent requests. The quantity can
+        never go below zero or above MAX_QUANTITY. Returns the new quantity,
+        or None if the product has no stock entry or the quantity would leave
+        that range.
+        '''
+        if db.session.connection().dialect.update_returning:
+            statement = (
+                update(Stock)
+                .where(Stock.productId == product_id, Stock.quantity >= -delta,
+                       Stock.quantity <= MAX_QUANTITY - delta)
+                .values(quantity=Stock.quantity + delta)
+                .returning(Stock.quantity)
+            )
+            return db.session.execute(statement).scalar()
+
+        # Without RETURNING the row is locked with SELECT ... FOR UPDATE, so the
+        # quantity can't change between the check and the UPDATE
+        quantity = db.session.execute(
+            select(Stock.quantity).where(Stock.productId == product_id).with_for_update()
+        ).scalar()
+        if quantity is None or not 0 <= quantity + delta <= MAX_QUANTITY:
+            return None
+        db.session.execute(
+            update(Stock).where(Stock.productId == product_id)
+            .values(quantity=Stock.quantity + delta)
+        )
+        return quantity + delta
+
+
+class ProductSales(db.Model):
+    """
+    Units sold and revenue of a product. Maintained from the product orders
+    by onlinestore.reports, rebuilt with the rebuild-reports command.
+    """
+    FILTERS = ("productId", "quantity", "revenue")
+    SORTS = ("productId", "quantity", "revenue")
+
+    productId = db.Column(db.Integer, db.ForeignKey(
+        'product.id', ondelete="CASCADE"), primary_key=True, nullable=False)
+    quantity = db.Column(db.Integer, nullable=False, index=True)
+    revenue = db.Column(db.Float, nullable=False, index=True)
+
+    def serialize(self):
+        ''' Return product sales data as a dictionary '''
+        return {
+            "productId": self.productId,
+            "quantity": self.quantity,
+            "revenue": self.revenue
+        }
+
+
+class DailySales(db.Model):
+    """
+    Units sold and revenue of the orders created on a day (UTC). Maintained
+    from the product orders by onlinestore.reports.
+    """
+    FILTERS = ("day",)
+    SORTS = ("day",)
+
+    day = db.Column(db.Date, primary_key=True, nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    revenue = db.Column(db.Float, nullable=False)
+
+    def serialize(self):
+        ''' Return daily sales data as a dictionary '''
+        return {
+            "day": self.day.isoformat() if self.day else None,
+            "quantity": self.quantity,
+            "revenue": self.revenue
+        }
+
+
+class CustomerSales(db.Model):
+    """
+    Units bought and money spent by a customer. Maintained from the product
+    orders and the customers of the orders by onlinestore.reports.
+    """
+    FILTERS = ("customerId", "quantity", "revenue")
+    SORTS = ("quantity", "revenue")
+
+    customerId = db.Column(db.String(36), db.ForeignKey(
+        'customer.uuid', ondelete="CASCADE"), primary_key=True, nullable=False)
+    quantity = db.Column(db.Integer, nullable=False, index=True)
+    revenue = db.Column(db.Float, nullable=False, index=True)
+
+    def serialize(self):
+        ''' Return customer sales data as a dictionary '''
+        return {
+            "customerId": self.customerId,
+            "quantity": self.quantity,
+            "revenue": self.revenue
+        }
+
+
+# Summary tables of the reports and the columns they are keyed by
+REPORTS = {
+    ProductSales: ProductSales.productId,
+    DailySales: DailySales.day,
+    CustomerSales: CustomerSales.customerId,
+}
+
+
+class Revision(db.Model):
+    """
+    Revision of a table. The version is increased and the modification time
+    updated by every transaction and every bulk statement outside the session
+    that changes the table, which gives the collections cheap validators for
+    conditional requests.
+    """
+    name = db.Column(db.String(64), primary_key=True, nullable=False)
+    version = db.Column(db.Integer, nullable=False)
+    modifiedAt = db.Column(db.DateTime, nullable=False)
+
+    @staticmethod
+    def bump(connection, names):
+        '''
+        Increase the revisions of the named tables with one UPDATE (in the
+        current transaction). The revisions of tables that have none yet are
+        inserted.
+        '''
+        names = sorted(names)
+        if not names:
+            return
+        table = Revision.__table__
+        now = utcnow()
+        result = connection.execute(
+            update(table).where(table.c.name.in_(names))
+            .values(version=table.c.version + 1, modifiedAt=now)
+        )
+        if result.rowcount == len(names):
+            return
+        existing = set(connection.scalars(select(table.c.name).where(table.c.name.in_(names))))
+        connection.execute(insert(table), [
+            {"name": name, "version": 1, "modifiedAt": now}
+            for name in names if name not in existing
+        ])
+
+    @staticmethod
+    def touch(session, names):
+        ''' Bump the revisions of the named tables when the session commits '''
+        session.info.setdefault("touched_tables", set()).update(names)
+
+
+def referencing_keys(table):
+    '''
+    Foreign keys to *table* with an ON DELETE action, the rows of their tables
+    are changed by the database when rows of *table* are deleted.
+    '''
+    return [
+        key for other in db.metadata.sorted_tables for key in other.foreign_keys
+        if key.ondelete and key.column.table is table
+    ]
+
+
+def cascaded_tables(table):
+    ''' Names of the tables changed by the database when rows of *table* are deleted '''
+    names = set()
+    for key in referencing_keys(table):
+        if key.parent.table.name not in names:
+            names.add(key.parent.table.name)
+            # Deleted rows can cascade further, nulled ones can't
+            if key.ondelete.upper() == "CASCADE":
+                names |= cascaded_tables(key.parent.table)
+    return names
+
+
+@event.listens_for(Session, "after_flush")
+def _touch_flushed_revisions(session, flush_context):
+    '''
+    Remember the tables changed by a flush, including the tables changed by
+    the ON DELETE actions of deleted rows
+    '''
+    names = {
+        obj.__table__.name for obj in session.new | session.dirty | session.deleted
+        if not isinstance(obj, Revision)
+    }
+    for table in {obj.__table__ for obj in session.deleted}:
+        names |= cascaded_tables(table)
+    if names:
+        Revision.touch(session, names)
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _touch_statement_revisions(orm_execute_state):
+    ''' Remember the table changed by a bulk INSERT, UPDATE or DELETE '''
+    state = orm_execute_state
+    if state.is_insert or state.is_update or state.is_delete:
+        table = state.statement.table
+        if table.name != Revision.__tablename__:
+            names = {table.name}
+            if state.is_delete:
+                names |= cascaded_tables(table)
+            Revision.touch(state.session, names)
+
+
+@event.listens_for(Session, "before_commit")
+def _bump_touched_revisions(session):
+    '''
+    Bump the revisions of the tables changed by the transaction with one
+    statement. The changes left in the session are flushed first, commit
+    would flush them only after this hook.
+    '''
+    session.flush()
+    names = session.info.pop("touched_tables", None)
+    if names:
+        Revision.bump(session.connection(), names)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_touched_revisions(session):
+    ''' Rolled back changes never reached the database '''
+    session.info.pop("touched_tables", None)
+
+
+# FTS5 index of product names and descriptions. It is an external content
+# table that reads the text from the product table, the triggers keep it in
+# sync with every insert, update and delete, including bulk statements.
+# Prefixes of 2 and 3 characters are indexed for fast prefix queries.
+PRODUCT_SEARCH_TABLE = "product_search"
+_PRODUCT_SEARCH_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS product_search USING fts5(
+        name, "desc", content='product', content_rowid='id', prefix='2 3'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS product_search_insert AFTER INSERT ON product BEGIN
+        INSERT INTO product_search(rowid, name, "desc") VALUES (new.id, new.name, new."desc");
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS product_search_delete AFTER DELETE ON product BEGIN
+        INSERT INTO product_search(product_search, rowid, name, "desc")
+        VALUES ('delete', old.id, old.name, old."desc");
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS product_search_update
+    AFTER UPDATE OF name, "desc" ON product BEGIN
+        INSERT INTO product_search(product_search, rowid, name, "desc")
+        VALUES ('delete', old.id, old.name, old."desc");
+        INSERT INTO product_search(rowid, name, "desc") VALUES (new.id, new.name, new."desc");
+    END""",
+]
+
+
+def has_product_search(connection):
+    ''' Check if the database has the full-text index of products '''
+    if connection.dialect.name != "sqlite":
+        return False
+    row = connection.execute(
+        text("SELECT 1 FROM sqlite_master WHERE name = :name"), {"name": PRODUCT_SEARCH_TABLE}
+    ).first()
+    return row is not None
+
+
+def create_product_search(connection):
+    '''
+    Create the full-text index of products and index the existing products.
+    Only SQLite databases with FTS5 get the index, product search falls back
+    to LIKE queries elsewhere. Returns True if the index was created.
+    '''
+    if connection.dialect.name != "sqlite" or has_product_search(connection):
+        return False
+    options = {row[0] for row in connection.execute(text("PRAGMA compile_options"))}
+    if "ENABLE_FTS5" not in options:
+        return False
+    for statement in _PRODUCT_SEARCH_DDL:
+        connection.execute(text(statement))
+    connection.execute(text("INSERT INTO product_search(product_search) VALUES ('rebuild')"))
+    return True
+
+
+@event.listens_for(Product.__table__, "after_create")
+def _create_product_search(target, connection, **kw):
+    ''' Create the full-text index with the product table '''
+    create_product_search(connection)
+
+
+@event.listens_for(Product.__table__, "after_drop")
+def _drop_product_search(target, connection, **kw):
+    ''' Drop the full-text index with the product table, the triggers are dropped with it '''
+    if connection.dialect.name == "sqlite":
+        connection.execute(text(f"DROP TABLE IF EXISTS {PRODUCT_SEARCH_TABLE}"))
+
+
+# How SQLAlchemy stores datetimes in SQLite, older versions stored the client's string
+_STORED_DATETIME = re.compile(r"\d{4}-\d\d-\d\d \d\d:\d\d:\d\d\.\d{6}$")
+
+
+def _migrate_order_times(connection):
+    '''
+    Convert the creation times of orders stored as free-form strings by older
+    versions to UTC datetimes. Strings without an offset are in the local time
+    of the server, like the client created them. Strings that can't be parsed
+    are left as they are and the IDs of their orders are logged as a warning,
+    so they can be fixed by hand and converted by running the migration again.
+    Returns the number of converted orders.
+    '''
+    table = Order.__table__
+    rows = connection.execute(db.select(table.c.id, type_coerce(table.c.createdAt, db.String)))
+    converted = {}
+    invalid = []
+    for order_id, value in rows:
+        if not isinstance(value, str) or _STORED_DATETIME.match(value):
+            continue
+        try:
+            moment = datetime.fromisoformat(value).astimezone(timezone.utc)
+        except ValueError:
+            invalid.append(order_id)
+            continue
+        converted[order_id] = moment.replace(tzinfo=None)
+
+    for order_id, moment in converted.items():
+        connection.execute(update(table).where(table.c.id == order_id).values(createdAt=moment))
+    if converted:
+        Revision.bump(connection, {table.name})
+    if invalid:
+        current_app.logger.warning(
+            "Orders with unparseable createdAt left unconverted: %s",
+            ", ".join(str(order_id) for order_id in invalid)
+        )
+    return len(converted)
+
+
+def _migrate_order_totals(connection):
+    '''
+    Fill the unit prices of the product orders created by older versions with
+    the current prices of their products and compute the totals and item
+    counts of the orders from their product orders.
+    '''
+    lines = ProductOrder.__table__
+    products = Product.__table__
+    orders = Order.__table__
+    connection.execute(
+        update(lines).where(lines.c.productId.is_not(None))
+        .values(unitPrice=db.select(products.c.price)
+                .where(products.c.id == lines.c.productId).scalar_subquery())
+    )
+    sums = db.select(
+        round_money(func.coalesce(func.sum(lines.c.unitPrice * lines.c.quantity), 0))
+    ).where(lines.c.orderId == orders.c.id).scalar_subquery()
+    counts = db.select(
+        func.coalesce(func.sum(lines.c.quantity), 0)
+    ).where(lines.c.orderId == orders.c.id).scalar_subquery()
+    connection.execute(update(orders).values(total=sums, itemCount=counts))
+    Revision.bump(connection, {orders.name, lines.name})
+
+
+def rebuild_reports(connection):
+    '''
+    Compute the summary tables of the reports from all product orders. The
+    tables are maintained incrementally by onlinestore.reports, rebuilding
+    fixes them after changes made outside the app. The product orders are
+    read once and aggregated in one pass.
+    '''
+    lines = ProductOrder.__table__
+    orders = Order.__table__
+    rows = connection.execute(
+        db.select(
+            lines.c.productId, lines.c.quantity, lines.c.unitPrice,
+            orders.c.createdAt, orders.c.customerId
+        ).join_from(lines, orders, lines.c.orderId == orders.c.id)
+    )
+    sums = {model: {} for model in REPORTS}
+    for product_id, quantity, price, created_at, customer_id in rows:
+        keys = {
+            ProductSales: product_id,
+            DailySales: created_at.date(),
+            CustomerSales: customer_id,
+        }
+        for model, key in keys.items():
+            if key is not None:
+                units, revenue = sums[model].get(key, (0, 0.0))
+                sums[model][key] = (units + quantity, revenue + quantity * price)
+
+    for model, key_column in REPORTS.items():
+        table = model.__table__
+        connection.execute(delete(table))
+        values = [
+            {key_column.key: key, "quantity": units, "revenue": round(revenue, 2)}
+            for key, (units, revenue) in sums[model].items()
+        ]
+        if values:
+            connection.execute(insert(table), values)
+    Revision.bump(connection, {model.__tablename__ for model in REPORTS})
+
+
+def _foreign_keys(inspector, table):
+    ''' Foreign keys of a table in the database as (columns, table, columns, ON DELETE) '''
+    return {
+        (tuple(key["constrained_columns"]), key["referred_table"],
+         tuple(key["referred_columns"]), (key.get("options") or {}).get("ondelete"))
+        for key in inspector.get_foreign_keys(table.name)
+    }
+
+
+def _model_foreign_keys(table):
+    ''' Foreign keys of the model of a table as (columns, table, columns, ON DELETE) '''
+    return {
+        (tuple(column.name for column in key.columns), key.referred_table.name,
+         tuple(element.column.name for element in key.elements), key.ondelete)
+        for key in table.foreign_key_constraints
+    }
+
+
+def _outdated_tables(connection):
+    '''
+    Tables whose foreign keys or column types in the database differ from
+    their models, with the names of their columns in the database. Older
+    versions declared e.g. the customer of an order as an integer referencing
+    customer.id while it holds the UUID.
+    '''
+    inspector = inspect(connection)
+    dialect = connection.dialect
+    outdated = {}
+    for table in db.metadata.sorted_tables:
+        columns = {column["name"]: column for column in inspector.get_columns(table.name)}
+        types = [
+            (column.type.compile(dialect), columns[column.name]["type"].compile(dialect))
+            for column in table.columns if column.name in columns
+        ]
+        if (_foreign_keys(inspector, table) != _model_foreign_keys(table)
+                or any(model != stored for model, stored in types)):
+            outdated[table] = [name for name in columns if name in table.c]
+    return outdated
+
+
+def _rebuild_table(connection, table, columns):
+    '''
+    Replace a SQLite table with one created from its model, SQLite can't
+    alter the foreign keys or types of columns. The rows are copied with the
+    *columns* the old table has, the indexes are created again.
+    '''
+    metadata = db.MetaData()
+    for other in db.metadata.sorted_tables:
+        other.to_metadata(metadata)
+    new = metadata.tables[table.name].to_metadata(metadata, name=f"_migrate_{table.name}")
+    preparer = connection.dialect.identifier_preparer
+    connection.execute(CreateTable(new))
+    connection.execute(
+        insert(new).from_select(columns, select(*(table.c[name] for name in columns)))
+    )
+    if table is Product.__table__:
+        # The triggers of the full-text index are dropped with the table
+        connection.execute(text(f"DROP TABLE IF EXISTS {PRODUCT_SEARCH_TABLE}"))
+    connection.execute(text(f"DROP TABLE {preparer.format_table(table)}"))
+    connection.execute(text(
+        f"ALTER TABLE {preparer.format_table(new)} RENAME TO {preparer.format_table(table)}"
+    ))
+    for index in table.indexes:
+        index.create(connection)
+
+
+def _repair_references(connection):
+    '''
+    Apply the ON DELETE action of their foreign key to the rows referencing
+    rows that don't exist, SQLite didn't enforce the foreign keys when older
+    versions wrote them. Returns the names of the changed columns, raises
+    IntegrityError for a foreign key without an action.
+    '''
+    preparer = connection.dialect.identifier_preparer
+    repaired = set()
+    while True:
+        violations = connection.execute(text("PRAGMA foreign_key_check")).all()
+        if not violations:
+            return repaired
+        for table, rowid, parent, key_id in violations:
+            keys = connection.execute(text(f"PRAGMA foreign_key_list({preparer.quote(table)})"))
+            # id, seq, table, from, to, on_update, on_delete, match
+            key = next(row for row in keys if row[0] == key_id)
+            column, action = key[3], key[6]
+            if action == "SET NULL":
+                connection.execute(text(
+                    f"UPDATE {preparer.quote(table)} SET {preparer.quote(column)} = NULL "
+                    "WHERE rowid = :rowid"
+                ), {"rowid": rowid})
+            elif action == "CASCADE":
+                connection.execute(
+                    text(f"DELETE FROM {preparer.quote(table)} WHERE rowid = :rowid"),
+                    {"rowid": rowid}
+                )
+            else:
+                raise IntegrityError(
+                    f"PRAGMA foreign_key_check: {table}", {"rowid": rowid},
+                    Exception(f"Row {rowid} of {table} references a missing row of {parent}")
+                )
+            repaired.add(f"{table}.{column}")
+
+
+def _migrate_foreign_keys(engine):
+    '''
+    Rebuild the SQLite tables whose foreign keys or column types differ from
+    their models and repair the references to missing rows, so the foreign
+    keys can be enforced. The foreign keys are off while the tables are
+    swapped, which needs its own connection outside of a transaction.
+    Returns the names of the rebuilt tables, their new columns and the
+    repaired columns. Nothing is done on other databases.
+    '''
+    if engine.dialect.name != "sqlite":
+        return []
+    created = []
+    with engine.connect() as connection:
+        dbapi_connection = connection.connection.dbapi_connection
+        isolation_level = dbapi_connection.isolation_level
+        # The transaction is begun and ended here, the driver would begin it too late
+        dbapi_connection.isolation_level = None
+        try:
+            connection.execute(text("PRAGMA foreign_keys=OFF"))
+            connection.execute(text("BEGIN"))
+            try:
+                names = set()
+                for table, columns in _outdated_tables(connection).items():
+                    _rebuild_table(connection, table, columns)
+                    created.append(table.name)
+                    created.extend(
+                        f"{table.name}.{column.name}" for column in table.columns
+                        if column.name not in columns
+                    )
+                    names.add(table.name)
+                repaired = _repair_references(connection)
+                created.extend(sorted(repaired))
+                names.update(name.split(".")[0] for name in repaired)
+                if names:
+                    Revision.bump(connection, names)
+            except Exception:
+                connection.execute(text("ROLLBACK"))
+                raise
+            connection.execute(text("COMMIT"))
+        finally:
+            connection.execute(text("PRAGMA foreign_keys=ON"))
+            dbapi_connection.isolation_level = isolation_level
+    return created
+
+
+def migrate_db():
+    '''
+    Bring an existing database up to date with the models. Missing tables are
+    created, tables whose foreign keys or column types changed are rebuilt,
+    columns and indexes missing from existing tables are added and data
+    stored in old formats is converted. Returns the names of the rebuilt
+    tables, the created columns and indexes and the converted columns.
+    Running it again does nothing.
+    '''
+    tables = set(inspect(db.engine).get_table_names())
+    db.create_all()
+    created = _migrate_foreign_keys(db.engine)
+    with db.engine.begin() as connection:
+        inspector = inspect(connection)
+        for table in db.metadata.sorted_tables:
+            columns = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in columns:
+                    name = connection.dialect.identifier_preparer.format_table(table)
+                    ddl = CreateColumn(column).compile(dialect=connection.dialect)
+                    connection.execute(text(f"ALTER TABLE {name} ADD COLUMN {ddl}"))
+                    created.append(f"{table.name}.{column.name}")
+
+            indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(connection)
+                    created.append(index.name)
+
+        if {"product_order.unitPrice", "order.total", "order.itemCount"} & set(created):
+            _migrate_order_totals(connection)
+        if create_product_search(connection):
+            created.append(PRODUCT_SEARCH_TABLE)
+        if _migrate_order_times(connection):
+            created.append("order.createdAt")
+        # Reports added to a database with orders start from the existing orders
+        if tables and any(model.__tablename__ not in tables for model in REPORTS):
+            rebuild_reports(connection)
+            created.append("reports")
+    return created
+
 
 @click.command("init-db")
 @with_appcontext
 def init_db_command():
-    ''' Clear existing data and create new tables '''
-    db.create_all()
+    ''' Create the tables or bring an existing database up to date with the models '''
+    migrate_db()
+
+
+@click.command("rebuild-reports")
+@with_appcontext
+def rebuild_reports_command():
+    ''' Compute the summary tables of the reports from all product orders '''
+    with db.engine.begin() as connection:
+        rebuild_reports(connection)
+    click.echo("Reports rebuilt")
+
+
+@click.command("migrate-db")
+@with_appcontext
+def migrate_db_command():
+    ''' Add the tables, columns and indexes missing from an existing database '''
+    for name in migrate_db():
+        click.echo(f"Migrated {name}")
+    click.echo("Database is up to date")
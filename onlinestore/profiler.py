@@ -0,0 +1,162 @@
+'''
+Sampling profiler of live requests of onlinestore API
+'''
+import hmac
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import Response, current_app, g, request
+
+from onlinestore.utils import create_error_response
+
+# Frames kept from the top of a stack
+MAX_DEPTH = 128
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{frame.f_globals.get('__name__', '?')}:{getattr(code, 'co_qualname', code.co_name)}"
+
+
+def collapse(frame):
+    ''' A stack as the names of its frames from the outermost, separated by ; '''
+    names = []
+    while frame is not None and len(names) < MAX_DEPTH:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class Profiler:
+    """
+    Samples the stacks of the threads handling profiled requests every
+    *interval* seconds from a background thread, so the requests themselves
+    run unchanged. The samples are counted by endpoint and stack in windows
+    of *window* seconds, the current and the previous window are kept. The
+    thread only runs while requests are being profiled.
+    """
+
+    def __init__(self, interval=0.005, window=60):
+        self.interval = interval
+        self.window = window
+        # Endpoints of the profiled requests by thread ID
+        self._active = {}
+        self._condition = threading.Condition()
+        self._thread = None
+        self._windows = [(time.monotonic(), {})]
+
+    def start(self, endpoint):
+        ''' Sample the current thread for an endpoint until stop is called '''
+        with self._condition:
+            self._active[threading.get_ident()] = endpoint
+            # Threads don't survive forking the worker processes
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="onlinestore-profiler", daemon=True
+                )
+                self._thread.start()
+            self._condition.notify()
+
+    def stop(self):
+        ''' Stop sampling the current thread '''
+        with self._condition:
+            self._active.pop(threading.get_ident(), None)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._active:
+                    self._condition.wait()
+            self.sample()
+            time.sleep(self.interval)
+
+    def sample(self):
+        ''' Count the current stack of every profiled thread '''
+        with self._condition:
+            active = dict(self._active)
+            now = time.monotonic()
+            elapsed = now - self._windows[-1][0]
+            # After an idle period the last window isn't the previous one
+            if elapsed >= 2 * self.window:
+                self._windows = [(now, {})]
+            elif elapsed >= self.window:
+                self._windows = [self._windows[-1], (now, {})]
+            counts = self._windows[-1][1]
+        frames = sys._current_frames()
+        for thread, endpoint in active.items():
+            frame = frames.get(thread)
+            if frame is not None:
+                stack = collapse(frame)
+                with self._condition:
+                    counts.setdefault(endpoint, Counter())[stack] += 1
+
+    def collapsed(self, endpoint=None):
+        '''
+        Samples of the current and the previous window in the collapsed stack
+        format of flamegraph.pl, one "endpoint;frame;...;frame count" line per
+        stack. With *endpoint*, only the stacks of that endpoint. Windows only
+        rotate while requests are sampled, so older ones are skipped here.
+        '''
+        totals = {}
+        oldest = time.monotonic() - 2 * self.window
+        with self._condition:
+            for start, counts in self._windows:
+                if start < oldest:
+                    continue
+                for name, stacks in counts.items():
+                    if endpoint is None or name == endpoint:
+                        totals.setdefault(name, Counter()).update(stacks)
+        return "".join(
+            f"{name};{stack} {count}\n"
+            for name, stacks in sorted(totals.items())
+            for stack, count in stacks.most_common()
+        )
+
+
+def _authorized():
+    ''' Whether the request carries the admin token of PROFILER_TOKEN '''
+    token = current_app.config.get("PROFILER_TOKEN")
+    given = request.headers.get("X-Profile-Token", "")
+    return bool(token) and hmac.compare_digest(given.encode(), token.encode())
+
+
+def _start_request():
+    if not (current_app.config.get("PROFILER") or request.headers.get("X-Profile-Token")):
+        return
+    if request.endpoint == "profile":
+        return
+    if current_app.config.get("PROFILER") or _authorized():
+        g._profiled = True
+        current_app.extensions["profiler"].start(request.endpoint or "unmatched")
+
+
+def _finish_request(exc):
+    if g.pop("_profiled", False):
+        current_app.extensions["profiler"].stop()
+
+
+def send_profile():
+    ''' The collapsed stacks of the profiled requests, for the admin token only '''
+    if not current_app.config.get("PROFILER_TOKEN"):
+        return create_error_response(404, "Not found", "Profiling is not enabled")
+    if not _authorized():
+        return create_error_response(403, "Forbidden", "The admin token is missing or wrong")
+    profile = current_app.extensions["profiler"].collapsed(request.args.get("endpoint"))
+    return Response(profile, 200, mimetype="text/plain")
+
+
+def init_app(app):
+    '''
+    Profile every request if PROFILER is set, or the requests with the admin
+    token of PROFILER_TOKEN in the X-Profile-Token header. The stacks are
+    sampled every PROFILER_INTERVAL seconds and served at /admin/profile/ in
+    windows of PROFILER_WINDOW seconds.
+    '''
+    app.extensions["profiler"] = Profiler(
+        app.config.get("PROFILER_INTERVAL", 0.005), app.config.get("PROFILER_WINDOW", 60)
+    )
+    app.before_request(_start_request)
+    app.teardown_request(_finish_request)
+    app.add_url_rule("/admin/profile/", "profile", send_profile)
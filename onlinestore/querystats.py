@@ -0,0 +1,171 @@
+'''
+Per-request SQL query counter and N+1 detector of onlinestore API
+'''
+import re
+import threading
+import time
+from collections import Counter
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+
+from onlinestore import db
+
+# Literals and bound parameters of a statement, replaced by ? in fingerprints
+_LITERALS = re.compile(r"'(?:[^']|'')*'|%\(\w+\)s|%s|:\w+|\$\d+|\b\d+(?:\.\d+)?\b")
+# Parameter lists of IN clauses and multi-row VALUES, collapsed to one item
+_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SPACE = re.compile(r"\s+")
+
+
+class QueryBudgetExceeded(RuntimeError):
+    ''' Raised in strict mode when a request runs more queries than its budget '''
+
+
+def fingerprint(statement):
+    '''
+    Fingerprint of a SQL statement: the statement with its literals and
+    parameters replaced by ? and IN lists of any length collapsed, so the
+    same query with other values has the same fingerprint.
+    '''
+    statement = _LITERALS.sub("?", _SPACE.sub(" ", statement.strip()))
+    return _LISTS.sub("(?)", statement)
+
+
+class QueryStats:
+    """
+    Query counts and SQL time of the requests of every endpoint since the app
+    was created. The counts of one request are kept in flask.g while it runs
+    and added here when it finishes.
+    """
+
+    def __init__(self):
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def add(self, endpoint, queries, seconds, repeated):
+        ''' Add the counts of a finished request '''
+        with self._lock:
+            stats = self._endpoints.setdefault(endpoint, {
+                "requests": 0, "queries": 0, "seconds": 0.0,
+                "max_queries": 0, "repeated": 0,
+            })
+            stats["requests"] += 1
+            stats["queries"] += queries
+            stats["seconds"] += seconds
+            stats["max_queries"] = max(stats["max_queries"], queries)
+            stats["repeated"] += bool(repeated)
+
+    def snapshot(self):
+        ''' Copy of the counts by endpoint '''
+        with self._lock:
+            return {endpoint: dict(stats) for endpoint, stats in self._endpoints.items()}
+
+    def clear(self):
+        ''' Forget the counts of every endpoint '''
+        with self._lock:
+            self._endpoints.clear()
+
+
+def _request_queries():
+    '''
+    Counts of the current request, or None outside requests. They are created
+    by the first query, the URL converters run queries before before_request.
+    '''
+    if not has_request_context():
+        return None
+    if "_queries" not in g:
+        g._queries = {"seconds": 0.0, "statements": Counter()}
+    return g._queries
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    queries = _request_queries()
+    if queries is None or not conn.info.get("query_start"):
+        return
+    queries["seconds"] += time.perf_counter() - conn.info["query_start"].pop()
+    queries["statements"][fingerprint(statement)] += 1
+
+
+def _handle_error(context):
+    ''' Statements that fail don't get to after_cursor_execute, they are counted here '''
+    if context.connection is None or context.statement is None:
+        return
+    _after_cursor_execute(
+        context.connection, None, context.statement, context.parameters,
+        context.execution_context, False
+    )
+
+
+def _budget(app, endpoint):
+    ''' Query budget of an endpoint from QUERY_BUDGETS or QUERY_BUDGET '''
+    return app.config.get("QUERY_BUDGETS", {}).get(endpoint, app.config.get("QUERY_BUDGET"))
+
+
+def _finish_request(response):
+    '''
+    Add the counts of the request to the stats of its endpoint. Statements
+    run QUERY_REPEAT_THRESHOLD times or more are reported as N+1 queries,
+    requests over their budget as warnings or, in strict mode, as errors.
+    The counts are sent as headers in debug mode and logged otherwise.
+    '''
+    queries = g.pop("_queries", None) or {"seconds": 0.0, "statements": Counter()}
+    app = current_app._get_current_object()
+    endpoint = request.endpoint or "unmatched"
+    count = sum(queries["statements"].values())
+    threshold = app.config.get("QUERY_REPEAT_THRESHOLD", 5)
+    repeated = {
+        statement: times for statement, times in queries["statements"].items()
+        if times >= threshold
+    }
+    app.extensions["query_stats"].add(endpoint, count, queries["seconds"], repeated)
+
+    if app.config.get("QUERY_STATS_HEADERS", app.debug):
+        response.headers["X-Query-Count"] = str(count)
+        response.headers["X-Query-Time"] = f"{queries['seconds'] * 1000:.3f}"
+        response.headers["X-Query-Repeated"] = str(len(repeated))
+    else:
+        app.logger.info(
+            "%s %s %s: %d queries in %.1f ms",
+            request.method, request.path, endpoint, count, queries["seconds"] * 1000
+        )
+    for statement, times in repeated.items():
+        app.logger.warning("%s ran %d times in one request: %s", endpoint, times, statement)
+
+    budget = _budget(app, endpoint)
+    if budget is not None and count > budget:
+        message = f"{endpoint} ran {count} queries, the budget is {budget}"
+        if app.config.get("QUERY_BUDGET_STRICT", app.testing):
+            raise QueryBudgetExceeded(message)
+        app.logger.warning(message)
+    return response
+
+
+def init_app(app):
+    '''
+    Count the SQL statements and time of every request if QUERY_STATS is set.
+    The budgets of QUERY_BUDGETS by endpoint and QUERY_BUDGET for the rest
+    are enforced in strict mode, on by default in testing.
+    '''
+    if not app.config.get("QUERY_STATS", True):
+        return
+    app.extensions["query_stats"] = QueryStats()
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine, "handle_error", _handle_error)
+    app.after_request(_finish_request)
+    # Requests that fail don't get to after_request
+    app.teardown_request(lambda exc: g.pop("_queries", None))
+
+
+def get_stats():
+    ''' Query counts by endpoint of the current app, or None if they are off '''
+    stats = current_app.extensions.get("query_stats")
+    return None if stats is None else stats.snapshot()
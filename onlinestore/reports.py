@@ -0,0 +1,200 @@
+'''
+Summary tables of the reports maintained from the product orders of onlinestore API
+'''
+from sqlalchemy import delete, event, func, insert, inspect, select, update
+from sqlalchemy.orm import Session
+
+from onlinestore.models import (
+    Customer, CustomerSales, DailySales, Order, Product, ProductOrder, ProductSales, REPORTS,
+    Revision, round_money, update_returning
+)
+from onlinestore.totals import committed_value
+
+
+def add_sales(connection, model, deltas):
+    '''
+    Add units and revenue to the rows of a summary table with relative
+    UPDATEs, inserting the rows that don't exist yet. Rows left without
+    units are deleted, as if the table had been rebuilt.
+
+    : param model: the model of the summary table
+    : param dict deltas: (units, revenue) to add by the key of the row
+    '''
+    table = model.__table__
+    key_column = table.c[REPORTS[model].key]
+    # Rows are updated in a fixed order so concurrent transactions lock rows the same way
+    for key in sorted(deltas):
+        units, revenue = deltas[key]
+        if not units and not revenue:
+            continue
+        row = update_returning(
+            connection,
+            update(table).where(key_column == key).values(
+                quantity=table.c.quantity + units,
+                revenue=round_money(table.c.revenue + revenue),
+            ),
+            key_column == key, table.c.quantity
+        )
+        if row is None:
+            connection.execute(insert(table).values({
+                key_column.key: key, "quantity": units, "revenue": round(revenue, 2)
+            }))
+        elif row.quantity <= 0:
+            connection.execute(delete(table).where(key_column == key))
+
+
+@event.listens_for(Session, "before_flush")
+def _capture_deleted_orders(session, flush_context, instances):
+    '''
+    Read the sales of the orders the flush deletes while their product orders
+    still exist, the database deletes them with the orders (ON DELETE
+    CASCADE) without loading them. One grouped query sums the lines by order
+    and product.
+    '''
+    orders = [
+        obj for obj in session.deleted
+        if isinstance(obj, Order) and inspect(obj).persistent
+    ]
+    if not orders:
+        # Left by a flush that failed
+        session.info.pop("deleted_orders", None)
+        session.info.pop("deleted_order_sales", None)
+        return
+    # Read now, the orders can't be loaded after the flush
+    session.info["deleted_orders"] = {
+        order.id: (order.createdAt, committed_value(order, "customerId")) for order in orders
+    }
+    session.info["deleted_order_sales"] = session.execute(
+        select(
+            ProductOrder.orderId, ProductOrder.productId,
+            func.sum(ProductOrder.quantity),
+            func.sum(ProductOrder.quantity * ProductOrder.unitPrice)
+        )
+        .where(ProductOrder.orderId.in_([order.id for order in orders]))
+        .group_by(ProductOrder.orderId, ProductOrder.productId)
+    ).all()
+
+
+def _line_changes(session, deleted_orders):
+    '''
+    Changes of the product orders in a flush as (sign, orderId, productId,
+    quantity, revenue) tuples. A changed line is removed with the values the
+    database had before the flush and added with the new ones, a deleted
+    line that was already gone changes nothing. The lines of deleted orders
+    come from the sums read before the flush, loaded lines of those orders
+    are skipped.
+    '''
+    # Read before the flush by the order totals
+    current = session.info.pop("current_lines", {})
+
+    def values(sign, order_id, product_id, quantity, price):
+        return (sign, order_id, product_id, quantity, quantity * (price or 0.0))
+
+    def old_values(line):
+        row = current.get(inspect(line).identity[0])
+        if row is None or row.orderId in deleted_orders:
+            return None
+        return values(-1, row.orderId, row.productId, row.quantity, row.unitPrice)
+
+    changes = []
+    for line in session.new:
+        if isinstance(line, ProductOrder) and line.orderId not in deleted_orders:
+            changes.append(values(1, line.orderId, line.productId, line.quantity, line.unitPrice))
+    for line in session.dirty:
+        if isinstance(line, ProductOrder) and session.is_modified(line):
+            old = old_values(line)
+            if old is not None:
+                changes.append(old)
+            if line.orderId not in deleted_orders:
+                changes.append(
+                    values(1, line.orderId, line.productId, line.quantity, line.unitPrice)
+                )
+    for line in session.deleted:
+        if isinstance(line, ProductOrder):
+            old = old_values(line)
+            if old is not None:
+                changes.append(old)
+    for order_id, product_id, quantity, revenue in session.info.pop("deleted_order_sales", ()):
+        changes.append((-1, order_id, product_id, quantity, revenue or 0.0))
+    return changes
+
+
+def _order_info(session, order_ids, deleted_orders):
+    ''' Creation time and customer of orders by ID, from the session when possible '''
+    info = dict(deleted_orders)
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, Order):
+            info[obj.id] = (obj.createdAt, obj.customerId)
+    mapper = inspect(Order)
+    for order_id in order_ids - set(info):
+        order = session.identity_map.get(mapper.identity_key_from_primary_key((order_id,)))
+        if order is not None and "createdAt" in order.__dict__:
+            info[order_id] = (order.createdAt, order.customerId)
+    missing = order_ids - set(info)
+    if missing:
+        rows = session.connection().execute(
+            select(Order.id, Order.createdAt, Order.customerId).where(Order.id.in_(missing))
+        )
+        for order_id, created_at, customer_id in rows:
+            info[order_id] = (created_at, customer_id)
+    return info
+
+
+@event.listens_for(Session, "after_flush")
+def _update_reports(session, flush_context):
+    '''
+    Apply the product orders added, changed and deleted by a flush to the
+    summary tables of the reports in the same transaction. Only the rows of
+    the affected products, days and customers are touched. When an order
+    moves to another customer its earlier total moves with it.
+    '''
+    deleted_orders = session.info.pop("deleted_orders", {})
+    changes = _line_changes(session, deleted_orders)
+    moved = [
+        obj for obj in session.dirty
+        if isinstance(obj, Order) and inspect(obj).attrs.customerId.history.has_changes()
+    ]
+    if not changes and not moved:
+        return
+
+    info = _order_info(session, {order_id for _, order_id, *_ in changes} | {
+        order.id for order in moved
+    }, deleted_orders)
+    # Summary rows of deleted products and customers are deleted with them
+    deleted = {
+        ProductSales: {obj.id for obj in session.deleted if isinstance(obj, Product)},
+        DailySales: set(),
+        CustomerSales: {obj.uuid for obj in session.deleted if isinstance(obj, Customer)},
+    }
+    deltas = {model: {} for model in REPORTS}
+    orders = {}
+
+    def add(model, key, units, revenue):
+        if key is not None and key not in deleted[model]:
+            old_units, old_revenue = deltas[model].get(key, (0, 0.0))
+            deltas[model][key] = (old_units + units, old_revenue + revenue)
+
+    for sign, order_id, product_id, quantity, revenue in changes:
+        units, revenue = sign * quantity, sign * revenue
+        created_at, customer_id = info.get(order_id, (None, None))
+        add(ProductSales, product_id, units, revenue)
+        add(DailySales, created_at.date() if created_at else None, units, revenue)
+        add(CustomerSales, customer_id, units, revenue)
+        old_units, old_revenue = orders.get(order_id, (0, 0.0))
+        orders[order_id] = (old_units + units, old_revenue + revenue)
+
+    for order in moved:
+        # The total before this flush, the changes of the flush went to the new customer
+        units, revenue = orders.get(order.id, (0, 0.0))
+        units, revenue = order.itemCount - units, order.total - revenue
+        add(CustomerSales, committed_value(order, "customerId"), -units, -revenue)
+        add(CustomerSales, order.customerId, units, revenue)
+
+    connection = session.connection()
+    names = set()
+    for model, model_deltas in deltas.items():
+        if model_deltas:
+            add_sales(connection, model, model_deltas)
+            names.add(model.__tablename__)
+    if names:
+        Revision.touch(session, names)
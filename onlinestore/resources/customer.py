@@ -1,19 +1,38 @@
 """ Customer resource module """
-import json
+import uuid
 from flask import Response, request, url_for
 from flask_restful import Resource
-from jsonschema import ValidationError, validate
+from sqlalchemy import insert
+from jsonschema import ValidationError
 
 from flasgger import swag_from
 from onlinestore import db
 from onlinestore.models import Customer
-from onlinestore.utils import InventoryBuilder, create_error_response
+from onlinestore.utils import (
+    InventoryBuilder, create_error_response, paginate, query_collection, stream_collection,
+    wants_stream,
+    validate_batch, create_batch_item, create_batch_error, create_batch_response,
+    create_etag, conditional_item, conditional_collection, ItemEncoder
+)
+from onlinestore.encoding import encode
+from onlinestore.validation import validate_json
 from onlinestore.constants import JSON, MASON, LINK_RELATIONS_URL, CUSTOMER_PROFILE, ORDER_PROFILE
 
 
+def _customer_items(fields=None):
+    ''' Encoder for the collection items of customers '''
+    return ItemEncoder("api.customeritem", "customer", "uuid", CUSTOMER_PROFILE, fields=fields)
+
+
+def _customer_etag(customer):
+    ''' ETag of a customer item, the document lists the customer's orders '''
+    return create_etag([customer.serialize(), [order.serialize() for order in customer.orders]])
+
+
 class CustomerCollection(Resource):
     """ Resource CustomerCollection """
 
+    @conditional_collection(Customer)
     @swag_from('../../doc/customer/customer_collection_get.yml')
     def get(self):
         ''' Get list of all customers (returns a Mason document) '''
@@ -23,16 +42,30 @@ class CustomerCollection(Resource):
         body.add_control("self", href=url_for("api.customercollection"))
         body.add_control_all_customers()  # GET
         body.add_control_add_customer()  # POST
-        body["customers"] = []
+
+        try:
+            params = query_collection(Customer, Customer.query, Customer.id)
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+
+        encode_item = _customer_items(params.fields)
+        if wants_stream():
+            return stream_collection(
+                body, "customers", params.query, Customer.id, encode_item,
+                sort=params.sort, descending=params.descending
+            )
+
+        try:
+            page = paginate(params.query, Customer.id, params.sort, params.descending)
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+
+        body.add_control_pagination("api.customercollection", page)
 
         # List all customers in the database
-        for customer in Customer.query.all():
-            item = InventoryBuilder(customer.serialize())
-            item.add_control("self", href=url_for("api.customeritem", customer=customer.uuid))
-            item.add_control("profile", CUSTOMER_PROFILE)
-            body["customers"].append(item)
+        body["customers"] = [encode_item(customer) for customer in page.items]
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return Response(encode(body), 200, mimetype=MASON)
 
     @swag_from('../../doc/customer/customer_collection_post.yml')
     def post(self):
@@ -43,9 +76,12 @@ class CustomerCollection(Resource):
                 "Requests must be JSON"
             )
 
+        if isinstance(request.json, list):
+            return self._post_batch(request.json)
+
         # Validate the JSON document against the schema
         try:
-            validate(request.json, Customer.json_schema())
+            validate_json(request.json, Customer)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
@@ -67,31 +103,77 @@ class CustomerCollection(Resource):
             "Location": url_for("api.customeritem", customer=customer.uuid)
         })
 
+    def _post_batch(self, items):
+        '''
+        Create many customers from an array body. Emails are checked with one
+        query, the valid customers are inserted with one bulk statement and
+        committed once. Returns the result of each item.
+        '''
+        try:
+            results = validate_batch(items, Customer)
+        except ValueError as e:
+            return create_error_response(400, "Invalid JSON document", str(e))
+
+        emails = [item["email"] for item, result in zip(items, results) if result is None]
+        taken = {
+            email for (email,) in
+            db.session.query(Customer.email).filter(Customer.email.in_(emails))
+        }
+
+        rows = {}
+        for i, item in enumerate(items):
+            if results[i] is not None:
+                continue
+            email = item["email"]
+            # Emails repeated in the batch conflict as well
+            if email in taken:
+                results[i] = create_batch_error(
+                    409, "Already exists",
+                    f"Customer with email '{email}' already exists."
+                )
+                continue
+            taken.add(email)
+            # UUIDs are generated here to know the locations without querying them back
+            rows[i] = {
+                "uuid": str(uuid.uuid4()),
+                "firstName": item["firstName"],
+                "lastName": item["lastName"],
+                "email": email,
+                "phone": item.get("phone")
+            }
+
+        if rows:
+            db.session.execute(insert(Customer), list(rows.values()))
+            db.session.commit()
+            for i, row in rows.items():
+                results[i] = create_batch_item(url_for("api.customeritem", customer=row["uuid"]))
+
+        return create_batch_response(results)
+
 
 class CustomerItem(Resource):
     """ Resource CustomerItem """
 
+    @conditional_item(_customer_etag)
     @swag_from('../../doc/customer/customer_item_get.yml')
     def get(self, customer):
         ''' Get a single customer from the database '''
         body = InventoryBuilder(customer.serialize())
         body.add_namespace("store", LINK_RELATIONS_URL)
         body.add_control("self", href=url_for("api.customeritem", customer=customer.uuid))
-        body.add_control("profile", CUSTOMER_PROFILE)
-        body.add_control("collection", href=url_for("api.customercollection"))
+        body.add_control_profile(CUSTOMER_PROFILE)
+        body.add_control_collection("api.customercollection")
+        body.add_control_customer_orders(customer)  # GET orders of the customer
         body.add_control_edit_customer(customer)  # PUT
         body.add_control_delete_customer(customer)  # DELETE
-        body["orders"] = []
 
         # List all orders for the customer
-        for order in customer.orders:
-            item = InventoryBuilder(order.serialize())
-            item.add_control("self", href=url_for("api.orderitem", order=order.id))
-            item.add_control("profile", ORDER_PROFILE)
-            body["orders"].append(item)
+        encode_item = ItemEncoder("api.orderitem", "order", "id", ORDER_PROFILE)
+        body["orders"] = [encode_item(order) for order in customer.orders]
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return Response(encode(body), 200, mimetype=MASON)
 
+    @conditional_item(_customer_etag)
     @swag_from('../../doc/customer/customer_item_put.yml')
     def put(self, customer):
         ''' Update a customer in the database '''
@@ -102,7 +184,7 @@ class CustomerItem(Resource):
             )
 
         try:
-            validate(request.json, Customer.json_schema())
+            validate_json(request.json, Customer)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
@@ -122,6 +204,7 @@ class CustomerItem(Resource):
 
         return Response(status=204)
 
+    @conditional_item(_customer_etag)
     @swag_from('../../doc/customer/customer_item_delete.yml')
     def delete(self, customer):
         ''' Delete a customer from the database '''
@@ -1,22 +1,182 @@
 """This module defines the resources for the Order and OrderCollection endpoints."""
-import json
 from flask import Response, request, url_for
 from flask_restful import Resource
-from jsonschema import ValidationError, validate
+from jsonschema import ValidationError
+from sqlalchemy import inspect
+from sqlalchemy.orm import joinedload, selectinload
 
 from flasgger import swag_from
 from onlinestore import db
-from onlinestore.models import Order, Customer
-from onlinestore.utils import InventoryBuilder, create_error_response
+from onlinestore.models import Order, Customer, Product, ProductOrder, Stock
+from onlinestore.cache import invalidate_on_commit
+from onlinestore.utils import (
+    InventoryBuilder, create_error_response, paginate, query_collection, stream_collection,
+    wants_stream,
+    create_etag, conditional_item, conditional_collection, ItemEncoder, get_embed,
+    parse_datetime
+)
+from onlinestore.encoding import encode
+from onlinestore.validation import validate_json
 from onlinestore.constants import (
     JSON, MASON, LINK_RELATIONS_URL,
-    ORDER_PROFILE, PRODUCTORDER_PROFILE
+    ORDER_PROFILE, PRODUCTORDER_PROFILE, PRODUCT_PROFILE, CUSTOMER_PROFILE
 )
 
+# Resources that can be embedded in order documents with ?embed=
+ORDER_EMBEDS = {"productorders": ProductOrder, "products": Product, "customer": Customer}
+
+
+def _get_order_embed():
+    ''' Resources to embed in the order documents, products come with their product orders '''
+    embed = get_embed(ORDER_EMBEDS)
+    if "products" in embed:
+        embed.add("productorders")
+    return embed
+
+
+def _order_options(embed):
+    '''
+    Loader options for the relationships the embedded resources need. The
+    customer is joined to the orders and the product orders are loaded with
+    their products in one more query, however many lines the orders have.
+    '''
+    options = []
+    if "productorders" in embed:
+        loader = selectinload(Order.productOrders)
+        if "products" in embed:
+            loader = loader.joinedload(ProductOrder.product)
+        options.append(loader)
+    if "customer" in embed:
+        options.append(joinedload(Order.customer))
+    return options
+
+
+def _load_order(order, embed):
+    ''' Load the relationships of an order the embedded resources need if they aren't loaded '''
+    unloaded = inspect(order).unloaded
+    needed = {"productorders": "productOrders", "customer": "customer"}
+    if any(needed[name] in unloaded for name in embed if name in needed):
+        db.session.query(Order).options(*_order_options(embed)).filter(Order.id == order.id).one()
+
+
+def _order_embedder(embed):
+    '''
+    Function that encodes the resources embedded in the document of an order.
+    The relationships must be loaded with _order_options or _load_order.
+    '''
+    encode_product = ItemEncoder("api.productitem", "product", "id", PRODUCT_PROFILE)
+    encode_customer = ItemEncoder("api.customeritem", "customer", "uuid", CUSTOMER_PROFILE)
+
+    def embedded_product(product_order):
+        product = product_order.product
+        return {"product": encode_product(product) if product is not None else None}
+
+    encode_line = ItemEncoder(
+        "api.productorderitem", "productorder", "id", PRODUCTORDER_PROFILE,
+        embed=embedded_product if "products" in embed else None
+    )
+
+    def embedded(order):
+        members = {}
+        if "productorders" in embed:
+            members["productorders"] = [encode_line(line) for line in order.productOrders]
+        if "customer" in embed:
+            customer = order.customer
+            members["customer"] = encode_customer(customer) if customer is not None else None
+        return members
+    return embedded
+
+
+def _order_items(embed=None, fields=None):
+    ''' Encoder for the collection items of orders with the embedded resources '''
+    embedder = _order_embedder(embed) if embed else None
+    return ItemEncoder(
+        "api.orderitem", "order", "id", ORDER_PROFILE, embed=embedder, fields=fields
+    )
+
+
+def _order_etag(order):
+    ''' ETag of an order item, the document lists the order's product orders '''
+    try:
+        embed = _get_order_embed()
+    except ValueError:
+        # The method responds to invalid parameters
+        embed = set()
+    _load_order(order, embed | {"productorders", "customer"})
+    lines = order.productOrders
+    data = [order.serialize(), [product_order.serialize() for product_order in lines]]
+    if "products" in embed:
+        data.append([line.product.serialize() if line.product else None for line in lines])
+    if "customer" in embed:
+        data.append(order.customer.serialize() if order.customer else None)
+    return create_etag(data)
+
+
+def _filter_created(query):
+    '''
+    Filter orders by creation time with the from and to query parameters (ISO
+    8601 times, to is exclusive). Returns the query and the column to sort by
+    unless the sort parameter says otherwise: orders in a time range are
+    sorted by creation time, which makes the pages range scans of the
+    createdAt index.
+    '''
+    start = request.args.get("from")
+    end = request.args.get("to")
+    if start is None and end is None:
+        return query, None
+    if start is not None:
+        query = query.filter(Order.createdAt >= parse_datetime(start))
+    if end is not None:
+        query = query.filter(Order.createdAt < parse_datetime(end))
+    return query, Order.createdAt
+
+
+def _order_collection(body, query, endpoint, **values):
+    '''
+    Respond with a page of the orders of *query*, or all of them with
+    ?stream=1. The filter, sort, fields, time range and embed query parameters
+    are applied to the query.
+
+    : param body: the document without the orders
+    : param endpoint: endpoint of the collection, the pages link to it with *values*
+    '''
+    try:
+        embed = _get_order_embed()
+        # Embedded resources need the orders as objects
+        # The sort column is settled before the fields are selected
+        query, default_sort = _filter_created(query)
+        params = query_collection(
+            Order, query, Order.id, projection=not embed, default_sort=default_sort
+        )
+    except ValueError as e:
+        return create_error_response(400, "Invalid query parameter", str(e))
+    query = params.query
+    if embed:
+        query = query.options(*_order_options(embed))
+
+    encode_item = _order_items(embed, params.fields)
+    if wants_stream():
+        return stream_collection(
+            body, "orders", query, Order.id, encode_item,
+            sort=params.sort, descending=params.descending
+        )
+
+    try:
+        page = paginate(query, Order.id, params.sort, params.descending)
+    except ValueError as e:
+        return create_error_response(400, "Invalid query parameter", str(e))
+
+    body.add_control_pagination(endpoint, page, **values)
+
+    body["orders"] = [encode_item(order) for order in page.items]
+
+    return Response(encode(body), 200, mimetype=MASON)
+
 
 class OrderCollection(Resource):
     """Resource OrderCollection"""
 
+    @conditional_collection(Order, embeds=ORDER_EMBEDS)
     @swag_from('../../doc/order/order_collection_get.yml')
     def get(self):
         ''' Get list of all orders (returns a Mason document) '''
@@ -26,16 +186,9 @@ class OrderCollection(Resource):
         body.add_control("self", href=url_for("api.ordercollection"))
         body.add_control_all_orders()  # GET
         body.add_control_add_order()  # POST
-        body["orders"] = []
-
-        # List all orders in the database
-        for order in Order.query.all():
-            item = InventoryBuilder(order.serialize())
-            item.add_control("self", href=url_for("api.orderitem", order=str(order.id)))
-            item.add_control("profile", ORDER_PROFILE)
-            body["orders"].append(item)
+        body.add_control_place_order()  # POST with product orders
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return _order_collection(body, Order.query, "api.ordercollection")
 
     @swag_from('../../doc/order/order_collection_post.yml')
     def post(self):
@@ -48,7 +201,7 @@ class OrderCollection(Resource):
 
         # Validate the JSON document against the schema
         try:
-            validate(request.json, Order.json_schema())
+            validate_json(request.json, Order)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
@@ -70,32 +223,132 @@ class OrderCollection(Resource):
         return Response(status=201, headers={"Location": order_uri})
 
 
+class OrderPlacement(Resource):
+    """Resource OrderPlacement"""
+
+    @swag_from('../../doc/order/order_placement_post.yml')
+    def post(self):
+        '''
+        Place an order with all of its product orders. Stock is checked and
+        reduced, and the order and its product orders are created in a single
+        transaction, so concurrent orders can't oversell a product.
+        '''
+        if request.content_type != JSON:
+            return create_error_response(
+                415, "Unsupported media type",
+                "Requests must be JSON"
+            )
+
+        try:
+            validate_json(request.json, Order, "place_schema")
+        except ValidationError as e:
+            return create_error_response(400, "Invalid JSON document", str(e))
+
+        customerId = request.json["customerId"]
+        if db.session.query(Customer).filter(Customer.uuid == customerId).first() is None:
+            return create_error_response(
+                404, "Not found",
+                f"Customer with ID {customerId} not found."
+            )
+
+        # The same product may be on several lines, stock is checked for the total
+        lines = request.json["productOrders"]
+        quantities = {}
+        for line in lines:
+            productId = line["productId"]
+            quantities[productId] = quantities.get(productId, 0) + line["quantity"]
+
+        # Check all products with one query, the lines get the current prices
+        prices = dict(
+            db.session.query(Product.id, Product.price).filter(Product.id.in_(quantities)).all()
+        )
+        missing = sorted(set(quantities) - set(prices))
+        if missing:
+            return create_error_response(
+                404, "Not found",
+                f"Product with ID {missing[0]} not found"
+            )
+
+        # Products are taken in a fixed order so concurrent orders lock rows the same way
+        for productId, quantity in sorted(quantities.items()):
+            invalidate_on_commit(Stock, productId)
+            if Stock.adjust(productId, -quantity) is None:
+                db.session.rollback()
+                return create_error_response(
+                    409, "Insufficient stock",
+                    f"Not enough stock for product with ID {productId}"
+                )
+
+        order = Order(customerId=customerId)
+        order.productOrders = [
+            ProductOrder(
+                productId=line["productId"], quantity=line["quantity"],
+                unitPrice=prices[line["productId"]]
+            )
+            for line in lines
+        ]
+        db.session.add(order)
+        db.session.commit()
+
+        order_uri = url_for("api.orderitem", order=order.id)
+        return Response(status=201, headers={"Location": order_uri})
+
+
+class CustomerOrderCollection(Resource):
+    """Resource CustomerOrderCollection"""
+
+    @conditional_collection(Order, embeds=ORDER_EMBEDS)
+    @swag_from('../../doc/order/customer_orders_get.yml')
+    def get(self, customer):
+        '''
+        Get the orders of a customer (returns a Mason document). The pages are
+        range scans of the customerId index.
+        '''
+        body = InventoryBuilder()
+
+        body.add_namespace("store", LINK_RELATIONS_URL)
+        body.add_control(
+            "self", href=url_for("api.customerordercollection", customer=customer.uuid)
+        )
+        body.add_control("up", href=url_for("api.customeritem", customer=customer.uuid))
+        body.add_control_all_orders()  # GET
+
+        query = Order.query.filter(Order.customerId == customer.uuid)
+        return _order_collection(
+            body, query, "api.customerordercollection", customer=customer.uuid
+        )
+
+
 class OrderItem(Resource):
     """Resource OrderItem"""
 
+    @conditional_item(_order_etag)
     @swag_from('../../doc/order/order_item_get.yml')
     def get(self, order):
         ''' Get order details '''
+        try:
+            embed = _get_order_embed()
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+        # The product orders are always listed and the customer has a control
+        embed.add("productorders")
+        _load_order(order, embed | {"customer"})
+
         body = InventoryBuilder(order.serialize())
         body.add_namespace("store", LINK_RELATIONS_URL)
         body.add_control("self", href=url_for("api.orderitem", order=str(order.id)))
-        body.add_control("profile", ORDER_PROFILE)
-        body.add_control("collection", href=url_for("api.ordercollection"))
+        body.add_control_profile(ORDER_PROFILE)
+        body.add_control_collection("api.ordercollection")
         body.add_control_customer_to_order(order)  # GET customer to order
         body.add_control_edit_order(order)  # PUT
         body.add_control_delete_order(order)  # DELETE
-        body["productorders"] = []
 
-        # List all product orders for the order
-        for product_order in order.productOrders:
-            item = InventoryBuilder(product_order.serialize())
-            href = url_for("api.productorderitem", productorder=product_order.id)
-            item.add_control("self", href=href)
-            item.add_control("profile", PRODUCTORDER_PROFILE)
-            body["productorders"].append(item)
+        # List all product orders for the order and the other embedded resources
+        body.update(_order_embedder(embed)(order))
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return Response(encode(body), 200, mimetype=MASON)
 
+    @conditional_item(_order_etag)
     @swag_from('../../doc/order/order_item_put.yml')
     def put(self, order):
         ''' Update an order '''
@@ -106,16 +359,24 @@ class OrderItem(Resource):
             )
 
         try:
-            validate(request.json, Order.json_schema())
+            validate_json(request.json, Order)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
+        customerId = request.json["customerId"]
+        if db.session.query(Customer).filter(Customer.uuid == customerId).first() is None:
+            return create_error_response(
+                404, "Not found",
+                f"Customer with ID {customerId} not found."
+            )
+
         order.deserialize(request.json)
         db.session.add(order)
         db.session.commit()
 
         return Response(status=204)
 
+    @conditional_item(_order_etag)
     @swag_from('../../doc/order/order_item_delete.yml')
     def delete(self, order):
         ''' Delete an order '''
@@ -1,19 +1,74 @@
 """ This module contains the resources for the product endpoints. """
-import json
-from flask import Response, request, url_for
+import re
+from flask import Response, current_app, request, url_for
 from flask_restful import Resource
-from jsonschema import ValidationError, validate
+from sqlalchemy import case, column, func, insert, literal_column, table
+from jsonschema import ValidationError
 
 from flasgger import swag_from
 from onlinestore import db
-from onlinestore.models import Product
-from onlinestore.utils import InventoryBuilder, create_error_response
+from onlinestore.models import PRODUCT_SEARCH_TABLE, Product, has_product_search
+from onlinestore.utils import (
+    InventoryBuilder, create_error_response, paginate, query_collection, stream_collection,
+    wants_stream,
+    validate_batch, create_batch_item, create_batch_error, create_batch_response,
+    create_etag, conditional_item, conditional_collection, ItemEncoder
+)
+from onlinestore.encoding import encode
+from onlinestore.validation import validate_json
 from onlinestore.constants import JSON, MASON, LINK_RELATIONS_URL, PRODUCT_PROFILE
 
 
+def _product_items(fields=None):
+    ''' Encoder for the collection items of products '''
+    return ItemEncoder("api.productitem", "product", "id", PRODUCT_PROFILE, fields=fields)
+
+
+def _search_query(terms):
+    '''
+    Query of the products matching every term of a search as prefixes, with
+    the rank the results are sorted by (smaller is better). Uses the FTS5 index
+    ranked with bm25, names weighing more than descriptions. Databases without
+    the index fall back to LIKE queries ranking name prefix matches first.
+    '''
+    columns = [Product.id, Product.name, Product.desc, Product.price]
+    search = current_app.extensions.get("product_search")
+    if search is None:
+        # Checked once per app, the index is created with the product table
+        search = has_product_search(db.session.connection())
+        current_app.extensions["product_search"] = search
+
+    if search:
+        index = table(PRODUCT_SEARCH_TABLE, column("rowid"))
+        rank = func.bm25(literal_column(PRODUCT_SEARCH_TABLE), 10.0, 1.0, type_=db.Float)
+        rank = rank.label("rank")
+        match = " ".join(f'"{term}"*' for term in terms)
+        return (
+            db.session.query(*columns, rank)
+            .join(index, index.c.rowid == Product.id)
+            .filter(literal_column(PRODUCT_SEARCH_TABLE).match(match))
+        ), rank
+
+    rank = case((Product.name.istartswith(terms[0], autoescape=True), 0.0), else_=1.0)
+    rank = rank.label("rank")
+    query = db.session.query(*columns, rank)
+    for term in terms:
+        query = query.filter(
+            Product.name.icontains(term, autoescape=True)
+            | Product.desc.icontains(term, autoescape=True)
+        )
+    return query, rank
+
+
+def _product_etag(product):
+    ''' ETag of a product item '''
+    return create_etag(product.serialize())
+
+
 class ProductCollection(Resource):
     """ Resource ProductCollection """
 
+    @conditional_collection(Product)
     @swag_from('../../doc/product/product_collection_get.yml')
     def get(self):
         ''' Get list of all products (returns a Mason document) '''
@@ -22,18 +77,32 @@ class ProductCollection(Resource):
         body.add_namespace("store", LINK_RELATIONS_URL)
         body.add_control("self", href=url_for("api.productcollection"))
         body.add_control_all_products()  # GET
+        body.add_control_search_products()  # GET with ?q=
         body.add_control_add_product()  # POST
 
-        body["products"] = []
+        try:
+            params = query_collection(Product, Product.query, Product.id)
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+
+        encode_item = _product_items(params.fields)
+        if wants_stream():
+            return stream_collection(
+                body, "products", params.query, Product.id, encode_item,
+                sort=params.sort, descending=params.descending
+            )
+
+        try:
+            page = paginate(params.query, Product.id, params.sort, params.descending)
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+
+        body.add_control_pagination("api.productcollection", page)
 
         # List all products in the database
-        for product in Product.query.all():
-            item = InventoryBuilder(product.serialize())
-            item.add_control("self", href=url_for("api.productitem", product=product.id))
-            item.add_control("profile", PRODUCT_PROFILE)
-            body["products"].append(item)
+        body["products"] = [encode_item(product) for product in page.items]
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return Response(encode(body), 200, mimetype=MASON)
 
     @swag_from('../../doc/product/product_collection_post.yml')
     def post(self):
@@ -44,8 +113,11 @@ class ProductCollection(Resource):
                 "Requests must be JSON"
             )
 
+        if isinstance(request.json, list):
+            return self._post_batch(request.json)
+
         try:
-            validate(request.json, Product.json_schema())
+            validate_json(request.json, Product)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
@@ -66,25 +138,102 @@ class ProductCollection(Resource):
             "Location": url_for("api.productitem", product=product.id)
         })
 
+    def _post_batch(self, items):
+        '''
+        Create many products from an array body. Names are checked with one
+        query, the valid products are inserted with one bulk statement and
+        committed once. Returns the result of each item.
+        '''
+        try:
+            results = validate_batch(items, Product)
+        except ValueError as e:
+            return create_error_response(400, "Invalid JSON document", str(e))
+
+        names = [item["name"] for item, result in zip(items, results) if result is None]
+        taken = {name for (name,) in db.session.query(Product.name).filter(Product.name.in_(names))}
+
+        rows = {}
+        for i, item in enumerate(items):
+            if results[i] is not None:
+                continue
+            name = item["name"]
+            # Names repeated in the batch conflict as well
+            if name in taken:
+                results[i] = create_batch_error(
+                    409, "Already exists",
+                    f"Product with name '{name}' already exists."
+                )
+                continue
+            taken.add(name)
+            rows[i] = {"name": name, "desc": item["desc"], "price": item["price"]}
+
+        if rows:
+            db.session.execute(insert(Product), list(rows.values()))
+            names = [row["name"] for row in rows.values()]
+            ids = dict(db.session.query(Product.name, Product.id).filter(Product.name.in_(names)))
+            db.session.commit()
+            for i, row in rows.items():
+                href = url_for("api.productitem", product=ids[row["name"]])
+                results[i] = create_batch_item(href)
+
+        return create_batch_response(results)
+
+
+class ProductSearch(Resource):
+    """ Resource ProductSearch """
+
+    @conditional_collection(Product)
+    @swag_from('../../doc/product/product_search_get.yml')
+    def get(self):
+        ''' Search products by name and description (returns a Mason document) '''
+        terms = re.findall(r"\w+", request.args.get("q", ""))
+        if not terms:
+            return create_error_response(
+                400, "Invalid query parameter",
+                "Search query 'q' must contain at least one word"
+            )
+
+        body = InventoryBuilder()
+        body.add_namespace("store", LINK_RELATIONS_URL)
+        body.add_control("self", href=url_for("api.productsearch", q=request.args["q"]))
+        body.add_control_all_products()  # GET
+        body.add_control_search_products()  # GET with ?q=
+
+        query, rank = _search_query(terms)
+        try:
+            page = paginate(query, Product.id, sort=rank)
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+
+        body.add_control_pagination("api.productsearch", page)
+
+        # Best matches first
+        encode_item = _product_items(["name", "desc", "price"])
+        body["products"] = [encode_item(product) for product in page.items]
+
+        return Response(encode(body), 200, mimetype=MASON)
+
 
 class ProductItem(Resource):
     """ Resource ProductItem """
 
+    @conditional_item(_product_etag)
     @swag_from('../../doc/product/product_item_get.yml')
     def get(self, product):
         ''' Get product information '''
         body = InventoryBuilder(product.serialize())
         body.add_namespace("store", LINK_RELATIONS_URL)
         body.add_control("self", href=url_for("api.productitem", product=product.id))
-        body.add_control("profile", PRODUCT_PROFILE)
-        body.add_control("collection", href=url_for("api.productcollection"))
+        body.add_control_profile(PRODUCT_PROFILE)
+        body.add_control_collection("api.productcollection")
         body.add_control_get_productorder(product)  # GET product order for the product
         body.add_control_get_stock(product)  # GET stock for the product
         body.add_control_edit_product(product)  # PUT
         body.add_control_delete_product(product)  # DELETE
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return Response(encode(body), 200, mimetype=MASON)
 
+    @conditional_item(_product_etag)
     @swag_from('../../doc/product/product_item_put.yml')
     def put(self, product):
         ''' Update product information '''
@@ -95,7 +244,7 @@ class ProductItem(Resource):
             )
 
         try:
-            validate(request.json, Product.json_schema())
+            validate_json(request.json, Product)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
@@ -105,6 +254,7 @@ class ProductItem(Resource):
 
         return Response(status=204)
 
+    @conditional_item(_product_etag)
     @swag_from('../../doc/product/product_item_delete.yml')
     def delete(self, product):
         ''' Delete a product '''
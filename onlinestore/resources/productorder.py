@@ -2,21 +2,73 @@
 This module defines the REST API for the ProductOrder resource. It handles
 GET, POST, PUT, and DELETE requests for the ProductOrder resource.
 """
-import json
 from flask import Response, request, url_for
 from flask_restful import Resource
-from jsonschema import ValidationError, validate
+from jsonschema import ValidationError
 
 from flasgger import swag_from
 from onlinestore import db
 from onlinestore.models import ProductOrder, Order, Product
-from onlinestore.utils import InventoryBuilder, create_error_response
+from onlinestore.utils import (
+    InventoryBuilder, create_error_response, paginate, query_collection, stream_collection,
+    wants_stream,
+    validate_batch, create_batch_item, create_batch_error, create_batch_response,
+    create_etag, conditional_item, conditional_collection, ItemEncoder
+)
+from onlinestore.encoding import encode
+from onlinestore.validation import validate_json
 from onlinestore.constants import JSON, MASON, LINK_RELATIONS_URL, PRODUCTORDER_PROFILE
 
 
+def _productorder_items(fields=None):
+    ''' Encoder for the collection items of product orders '''
+    return ItemEncoder(
+        "api.productorderitem", "productorder", "id", PRODUCTORDER_PROFILE, fields=fields
+    )
+
+
+def _productorder_etag(productorder):
+    ''' ETag of a product order item '''
+    return create_etag(productorder.serialize())
+
+
+def _productorder_collection(body, query, endpoint, **values):
+    '''
+    Respond with a page of the product orders of *query*, or all of them
+    with ?stream=1. The filter, sort and fields query parameters are applied
+    to the query.
+
+    : param body: the document without the product orders
+    : param endpoint: endpoint of the collection, the pages link to it with *values*
+    '''
+    try:
+        params = query_collection(ProductOrder, query, ProductOrder.id)
+    except ValueError as e:
+        return create_error_response(400, "Invalid query parameter", str(e))
+
+    encode_item = _productorder_items(params.fields)
+    if wants_stream():
+        return stream_collection(
+            body, "productorders", params.query, ProductOrder.id, encode_item,
+            sort=params.sort, descending=params.descending
+        )
+
+    try:
+        page = paginate(params.query, ProductOrder.id, params.sort, params.descending)
+    except ValueError as e:
+        return create_error_response(400, "Invalid query parameter", str(e))
+
+    body.add_control_pagination(endpoint, page, **values)
+
+    body["productorders"] = [encode_item(productorder) for productorder in page.items]
+
+    return Response(encode(body), 200, mimetype=MASON)
+
+
 class ProductOrderCollection(Resource):
     """ Resource ProductOrderCollection """
 
+    @conditional_collection(ProductOrder)
     @swag_from('../../doc/productorder/productorder_collection_get.yml')
     def get(self):
         ''' Get list of all product orders (returns a Mason document) '''
@@ -26,17 +78,10 @@ class ProductOrderCollection(Resource):
         body.add_control("self", href=url_for("api.productordercollection"))
         body.add_control_all_productorders()  # GET
         body.add_control_add_productorder()  # POST
-        body["productorders"] = []
-
-        # List all product orders in the database
-        for productorder in ProductOrder.query.all():
-            item = InventoryBuilder(productorder.serialize())
-            item.add_control("self", href=url_for(
-                "api.productorderitem", productorder=productorder.id))
-            item.add_control("profile", PRODUCTORDER_PROFILE)
-            body["productorders"].append(item)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return _productorder_collection(
+            body, ProductOrder.query, "api.productordercollection"
+        )
 
     @swag_from('../../doc/productorder/productorder_collection_post.yml')
     def post(self):
@@ -47,9 +92,12 @@ class ProductOrderCollection(Resource):
                 "Requests must be JSON"
             )
 
+        if isinstance(request.json, list):
+            return self._post_batch(request.json)
+
         # Validate the JSON document against the schema
         try:
-            validate(request.json, ProductOrder.json_schema())
+            validate_json(request.json, ProductOrder)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
@@ -61,33 +109,113 @@ class ProductOrderCollection(Resource):
             )
 
         productId = request.json["productId"]
-        if db.session.query(Product).filter(Product.id == productId).first() is None:
+        product = db.session.query(Product).filter(Product.id == productId).first()
+        if product is None:
             return create_error_response(
                 404, "Not found",
                 f"Product with ID {productId} not found"
             )
 
-        productOrder = ProductOrder()
+        productOrder = ProductOrder(unitPrice=product.price)
         productOrder.deserialize(request.json)
 
         db.session.add(productOrder)
         db.session.commit()
 
-        productOrder_uri = url_for("api.productordercollection", id=productOrder.id)
+        productOrder_uri = url_for("api.productorderitem", productorder=productOrder.id)
         return Response(status=201, headers={"Location": productOrder_uri})
 
+    def _post_batch(self, items):
+        '''
+        Create many product orders from an array body. Orders and products
+        are checked with one query each and the valid product orders are
+        committed once. Returns the result of each item.
+        '''
+        try:
+            results = validate_batch(items, ProductOrder)
+        except ValueError as e:
+            return create_error_response(400, "Invalid JSON document", str(e))
+
+        valid = [item for item, result in zip(items, results) if result is None]
+        order_ids = [item["orderId"] for item in valid]
+        product_ids = [item["productId"] for item in valid]
+        orders = {
+            orderId for (orderId,) in
+            db.session.query(Order.id).filter(Order.id.in_(order_ids))
+        }
+        # The prices of the products are captured on the lines
+        prices = dict(
+            db.session.query(Product.id, Product.price).filter(Product.id.in_(product_ids))
+        )
+
+        created = {}
+        for i, item in enumerate(items):
+            if results[i] is not None:
+                continue
+            if item["orderId"] not in orders:
+                results[i] = create_batch_error(
+                    404, "Not found",
+                    f"Order with ID {item['orderId']} not found"
+                )
+            elif item["productId"] not in prices:
+                results[i] = create_batch_error(
+                    404, "Not found",
+                    f"Product with ID {item['productId']} not found"
+                )
+            else:
+                productOrder = ProductOrder(unitPrice=prices[item["productId"]])
+                productOrder.deserialize(item)
+                created[i] = productOrder
+
+        if created:
+            # SQLite can't return generated IDs of a multi-row INSERT in order,
+            # so the product orders go through the session to get their IDs
+            db.session.add_all(created.values())
+            db.session.commit()
+            for i, productOrder in created.items():
+                href = url_for("api.productorderitem", productorder=productOrder.id)
+                results[i] = create_batch_item(href)
+
+        return create_batch_response(results)
+
+
+class ProductProductOrderCollection(Resource):
+    """ Resource ProductProductOrderCollection """
+
+    @conditional_collection(ProductOrder)
+    @swag_from('../../doc/productorder/product_productorders_get.yml')
+    def get(self, product):
+        '''
+        Get the product orders of a product (returns a Mason document). The
+        pages are range scans of the productId index.
+        '''
+        body = InventoryBuilder()
+
+        body.add_namespace("store", LINK_RELATIONS_URL)
+        body.add_control(
+            "self", href=url_for("api.productproductordercollection", product=product.id)
+        )
+        body.add_control("up", href=url_for("api.productitem", product=product.id))
+        body.add_control_all_productorders()  # GET
+
+        query = ProductOrder.query.filter(ProductOrder.productId == product.id)
+        return _productorder_collection(
+            body, query, "api.productproductordercollection", product=product.id
+        )
+
 
 class ProductOrderItem(Resource):
     """ Resource ProductOrderItem """
 
+    @conditional_item(_productorder_etag)
     @swag_from('../../doc/productorder/productorder_item_get.yml')
     def get(self, productorder):
         ''' Get product order details '''
         body = InventoryBuilder(productorder.serialize())
         body.add_namespace("store", LINK_RELATIONS_URL)
         body.add_control("self", href=url_for("api.productorderitem", productorder=productorder.id))
-        body.add_control("profile", PRODUCTORDER_PROFILE)
-        body.add_control("collection", href=url_for("api.productordercollection"))
+        body.add_control_profile(PRODUCTORDER_PROFILE)
+        body.add_control_collection("api.productordercollection")
         body.add_control_edit_productorder(productorder)  # PUT
         body.add_control_delete_productorder(productorder)  # DELETE
 
@@ -95,8 +223,9 @@ class ProductOrderItem(Resource):
         body.add_control_order(productorder)  # GET order details
         body.add_control_product(productorder)  # GET product details
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return Response(encode(body), 200, mimetype=MASON)
 
+    @conditional_item(_productorder_etag)
     @swag_from('../../doc/productorder/productorder_item_put.yml')
     def put(self, productorder):
         ''' Update a product order '''
@@ -107,16 +236,31 @@ class ProductOrderItem(Resource):
             )
 
         try:
-            validate(request.json, ProductOrder.json_schema())
+            validate_json(request.json, ProductOrder)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
+        orderId = request.json["orderId"]
+        if db.session.query(Order).filter(Order.id == orderId).first() is None:
+            return create_error_response(
+                404, "Not found",
+                f"Order with ID {orderId} not found"
+            )
+
+        productId = request.json["productId"]
+        if db.session.query(Product).filter(Product.id == productId).first() is None:
+            return create_error_response(
+                404, "Not found",
+                f"Product with ID {productId} not found"
+            )
+
         productorder.deserialize(request.json)
         db.session.add(productorder)
         db.session.commit()
 
         return Response(status=204)
 
+    @conditional_item(_productorder_etag)
     @swag_from('../../doc/productorder/productorder_item_delete.yml')
     def delete(self, productorder):
         ''' Delete a product order '''
@@ -0,0 +1,164 @@
+""" This module contains the resources for the report endpoints. """
+from datetime import timedelta
+from flask import Response, request, url_for
+from flask_restful import Resource
+
+from flasgger import swag_from
+from onlinestore import db
+from onlinestore.models import CustomerSales, DailySales, ProductSales, Stock
+from onlinestore.utils import (
+    InventoryBuilder, MasonBuilder, create_error_response, paginate, query_collection,
+    conditional_collection
+)
+from onlinestore.encoding import encode
+from onlinestore.constants import MASON, LINK_RELATIONS_URL, REPORT_PROFILE
+
+
+# Link relations, endpoints and titles of the reports
+REPORTS = [
+    ("product-sales", "api.productsalesreport", "Units sold and revenue per product"),
+    ("daily-sales", "api.dailysalesreport", "Units sold and revenue per day"),
+    ("customer-sales", "api.customersalesreport", "Units bought and money spent per customer"),
+    ("stock-turnover", "api.stockturnoverreport", "Units sold and in stock per product"),
+]
+
+
+def _report_body(endpoint):
+    ''' Document of a report without its items '''
+    body = InventoryBuilder()
+    body.add_namespace("store", LINK_RELATIONS_URL)
+    body.add_control("self", href=url_for(endpoint))
+    body.add_control_profile(REPORT_PROFILE)
+    body.add_control("up", href=url_for("api.reportindex"))
+    return body
+
+
+def _report_item(data, ctrl, href):
+    ''' Item of a report with a control to the resource it is about '''
+    item = MasonBuilder(data)
+    item.add_control(ctrl, href=href)
+    return item
+
+
+def _sales_report(model, key, endpoint, item, default_sort=None):
+    '''
+    Respond with a page of a sales summary table. The filter, sort and
+    fields query parameters work like in the collections.
+
+    : param item: function building the report item of a row
+    : param default_sort: column sorted by in descending order without ?sort=
+    '''
+    try:
+        params = query_collection(model, model.query, key, projection=False)
+        if default_sort is not None and not request.args.get("sort"):
+            params = params._replace(sort=default_sort, descending=True)
+        page = paginate(params.query, key, params.sort, params.descending)
+    except ValueError as e:
+        return create_error_response(400, "Invalid query parameter", str(e))
+
+    body = _report_body(endpoint)
+    body.add_control_pagination(endpoint, page)
+    body["items"] = []
+    for row in page.items:
+        data = row.serialize()
+        if params.fields is not None:
+            data = {name: data[name] for name in params.fields}
+        body["items"].append(item(row, data))
+    return Response(encode(body), 200, mimetype=MASON)
+
+
+class ReportIndex(Resource):
+    """ Resource ReportIndex """
+
+    @swag_from('../../doc/report/report_index_get.yml')
+    def get(self):
+        ''' Get the controls of the available reports '''
+        body = InventoryBuilder()
+        body.add_namespace("store", LINK_RELATIONS_URL)
+        body.add_control("self", href=url_for("api.reportindex"))
+        for rel, endpoint, title in REPORTS:
+            body.add_control(f"store:{rel}", url_for(endpoint), method="GET", title=title)
+        return Response(encode(body), 200, mimetype=MASON)
+
+
+class ProductSalesReport(Resource):
+    """ Resource ProductSalesReport """
+
+    @conditional_collection(ProductSales)
+    @swag_from('../../doc/report/product_sales_get.yml')
+    def get(self):
+        ''' Get units sold and revenue per product, highest revenue first '''
+        return _sales_report(
+            ProductSales, ProductSales.productId, "api.productsalesreport",
+            lambda row, data: _report_item(
+                data, "product", url_for("api.productitem", product=row.productId)
+            ),
+            default_sort=ProductSales.revenue
+        )
+
+
+class DailySalesReport(Resource):
+    """ Resource DailySalesReport """
+
+    @conditional_collection(DailySales)
+    @swag_from('../../doc/report/daily_sales_get.yml')
+    def get(self):
+        ''' Get units sold and revenue per day, filter the days with day[gte] and day[lt] '''
+        def item(row, data):
+            # The orders of the day
+            args = {"from": row.day.isoformat(), "to": (row.day + timedelta(days=1)).isoformat()}
+            return _report_item(data, "orders", url_for("api.ordercollection", **args))
+
+        return _sales_report(DailySales, DailySales.day, "api.dailysalesreport", item)
+
+
+class CustomerSalesReport(Resource):
+    """ Resource CustomerSalesReport """
+
+    @conditional_collection(CustomerSales)
+    @swag_from('../../doc/report/customer_sales_get.yml')
+    def get(self):
+        ''' Get units bought and money spent per customer, top customers first '''
+        return _sales_report(
+            CustomerSales, CustomerSales.customerId, "api.customersalesreport",
+            lambda row, data: _report_item(
+                data, "customer", url_for("api.customeritem", customer=row.customerId)
+            ),
+            default_sort=CustomerSales.revenue
+        )
+
+
+class StockTurnoverReport(Resource):
+    """ Resource StockTurnoverReport """
+
+    @conditional_collection(Stock, ProductSales)
+    @swag_from('../../doc/report/stock_turnover_get.yml')
+    def get(self):
+        '''
+        Get the units sold and in stock per product. The turnover is the units
+        sold divided by the units in stock, null when the product is out of stock.
+        '''
+        sold = db.func.coalesce(ProductSales.quantity, 0).label("sold")
+        query = db.session.query(Stock.productId, Stock.quantity, sold).outerjoin(
+            ProductSales, ProductSales.productId == Stock.productId
+        )
+        try:
+            page = paginate(query, Stock.productId)
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+
+        body = _report_body("api.stockturnoverreport")
+        body.add_control_pagination("api.stockturnoverreport", page)
+        body["items"] = [
+            _report_item(
+                {
+                    "productId": row.productId,
+                    "sold": row.sold,
+                    "inStock": row.quantity,
+                    "turnover": round(row.sold / row.quantity, 2) if row.quantity else None
+                },
+                "product", url_for("api.productitem", product=row.productId)
+            )
+            for row in page.items
+        ]
+        return Response(encode(body), 200, mimetype=MASON)
@@ -1,25 +1,44 @@
 """
 This module defines the resources for the stock of products in the online store.
 The StockCollection resource handles GET and POST requests for the stock of products.
-The StockItem resource handles GET, PUT, and DELETE requests for a specific product's stock.
+The StockItem resource handles GET, PUT, PATCH and DELETE requests for a specific product's stock.
 """
-import json
 from flask import Response, request, url_for
 from flask_restful import Resource
-from jsonschema import ValidationError, validate
+from sqlalchemy import insert
+from jsonschema import ValidationError
 
 from flasgger import swag_from
 from onlinestore import db
 from onlinestore.models import Stock, Product
-from onlinestore.utils import InventoryBuilder, create_error_response
+from onlinestore.cache import invalidate_on_commit
+from onlinestore.utils import (
+    InventoryBuilder, create_error_response, paginate, query_collection, stream_collection,
+    wants_stream,
+    validate_batch, create_batch_item, create_batch_error, create_batch_response,
+    create_etag, conditional_item, conditional_collection, ItemEncoder
+)
+from onlinestore.encoding import encode
+from onlinestore.validation import validate_json
 from onlinestore.constants import JSON, MASON, LINK_RELATIONS_URL, STOCK_PROFILE
 
 
+def _stock_items(fields=None):
+    ''' Encoder for the collection items of stock entries '''
+    return ItemEncoder("api.stockitem", "product", "productId", STOCK_PROFILE, fields=fields)
+
+
+def _stock_etag(stock):
+    ''' ETag of a stock item '''
+    return create_etag(stock.serialize())
+
+
 class StockCollection(Resource):
     """
     StockCollection resource represents the collection of all products and their stock quantities.
     """
 
+    @conditional_collection(Stock)
     @swag_from('../../doc/stock/stock_collection_get.yml')
     def get(self):
         ''' Get list of all stock (returns a Mason document) '''
@@ -28,15 +47,30 @@ class StockCollection(Resource):
         body.add_namespace("store", LINK_RELATIONS_URL)
         body.add_control("self", href=url_for("api.stockcollection"))
         body.add_control_all_stock()  # GET
-        body["items"] = []
 
-        for stock in Stock.query.all():
-            item = InventoryBuilder(stock.serialize())
-            item.add_control("self", href=url_for("api.stockitem", product=stock.productId))
-            item.add_control("profile", STOCK_PROFILE)
-            body["items"].append(item)
+        try:
+            params = query_collection(Stock, Stock.query, Stock.productId)
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+
+        encode_item = _stock_items(params.fields)
+        if wants_stream():
+            return stream_collection(
+                body, "items", params.query, Stock.productId, encode_item,
+                sort=params.sort, descending=params.descending
+            )
+
+        try:
+            page = paginate(params.query, Stock.productId, params.sort, params.descending)
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+
+        body.add_control_pagination("api.stockcollection", page)
+
+        # List all stock in the database
+        body["items"] = [encode_item(stock) for stock in page.items]
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return Response(encode(body), 200, mimetype=MASON)
 
     @swag_from('../../doc/stock/stock_collection_post.yml')
     def post(self):
@@ -47,9 +81,12 @@ class StockCollection(Resource):
                 "Requests must be JSON"
             )
 
+        if isinstance(request.json, list):
+            return self._post_batch(request.json)
+
         # Validate the JSON document against the schema
         try:
-            validate(request.json, Stock.json_schema())
+            validate_json(request.json, Stock)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
@@ -76,24 +113,77 @@ class StockCollection(Resource):
         stock_uri = url_for("api.stockitem", product=stock.productId)
         return Response(status=201, headers={"Location": stock_uri})  # Created
 
+    def _post_batch(self, items):
+        '''
+        Create many stock entries from an array body. Existing stock entries
+        and products are checked with one query each, the valid entries are
+        inserted with one bulk statement and committed once. Returns the
+        result of each item.
+        '''
+        try:
+            results = validate_batch(items, Stock)
+        except ValueError as e:
+            return create_error_response(400, "Invalid JSON document", str(e))
+
+        product_ids = [item["productId"] for item, result in zip(items, results) if result is None]
+        taken = {
+            productId for (productId,) in
+            db.session.query(Stock.productId).filter(Stock.productId.in_(product_ids))
+        }
+        products = {
+            productId for (productId,) in
+            db.session.query(Product.id).filter(Product.id.in_(product_ids))
+        }
+
+        rows = {}
+        for i, item in enumerate(items):
+            if results[i] is not None:
+                continue
+            productId = item["productId"]
+            # Products repeated in the batch conflict as well
+            if productId in taken:
+                results[i] = create_batch_error(
+                    409, "Already exists",
+                    f"Stock entry for product with ID '{productId}' already exists."
+                )
+            elif productId not in products:
+                results[i] = create_batch_error(
+                    404, "Not found",
+                    f"Product with ID '{productId}' not found."
+                )
+            else:
+                taken.add(productId)
+                rows[i] = {"productId": productId, "quantity": item["quantity"]}
+
+        if rows:
+            db.session.execute(insert(Stock), list(rows.values()))
+            db.session.commit()
+            for i, row in rows.items():
+                results[i] = create_batch_item(url_for("api.stockitem", product=row["productId"]))
+
+        return create_batch_response(results)
+
 
 class StockItem(Resource):
     """ Resource StockItem """
 
+    @conditional_item(_stock_etag)
     @swag_from('../../doc/stock/stock_item_get.yml')
     def get(self, product):
         ''' Get stock for a specific product (returns a Mason document) '''
         body = InventoryBuilder(product.serialize())
         body.add_namespace("store", LINK_RELATIONS_URL)
         body.add_control("self", href=url_for("api.stockitem", product=product.productId))
-        body.add_control("profile", STOCK_PROFILE)
-        body.add_control("collection", href=url_for("api.stockcollection"))
+        body.add_control_profile(STOCK_PROFILE)
+        body.add_control_collection("api.stockcollection")
         body.add_control_get_product(product)  # GET product for the stock
         body.add_control_edit_stock(product)  # PUT
+        body.add_control_adjust_stock(product)  # PATCH
         body.add_control_delete_stock(product)  # DELETE
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return Response(encode(body), 200, mimetype=MASON)
 
+    @conditional_item(_stock_etag)
     @swag_from('../../doc/stock/stock_item_put.yml')
     def put(self, product):
         ''' Update stock quantity for product '''
@@ -104,23 +194,19 @@ class StockItem(Resource):
             )
 
         try:
-            validate(request.json, Stock.json_schema())
+            validate_json(request.json, Stock)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
-        # Check if the product exists
-        product_request_body = db.session.query(Product).filter(
-            Product.id == request.json["productId"]).first()
-        if product_request_body is None:
-            product_id = request.json["productId"]
-            return create_error_response(
-                404, "Not found",
-                f"Product with ID {product_id} not found"
-            )
-
-        # Ensure productId is the same as the one in the URI, productId cannot be modified
-        product = db.session.query(Stock).filter(Stock.productId == product.productId).first()
-        if 'productId' in request.json and request.json['productId'] != product.productId:
+        # Ensure productId is the same as the one in the URI, productId cannot be modified.
+        # The product of the stock entry exists, so only other products are looked up
+        product_id = request.json["productId"]
+        if product_id != product.productId:
+            if db.session.query(Product).filter(Product.id == product_id).first() is None:
+                return create_error_response(
+                    404, "Not found",
+                    f"Product with ID {product_id} not found"
+                )
             return create_error_response(
                 400, "Invalid JSON document",
                 "Product ID cannot be modified"
@@ -132,6 +218,47 @@ class StockItem(Resource):
 
         return Response(status=204)
 
+    @swag_from('../../doc/stock/stock_item_patch.yml')
+    def patch(self, product):
+        '''
+        Increase or decrease stock quantity for product. The change is done
+        with one conditional UPDATE instead of a read and a PUT, and it is
+        rejected if the quantity would go below zero.
+        '''
+        if request.content_type != JSON:
+            return create_error_response(
+                415, "Unsupported media type",
+                "Requests must be JSON"
+            )
+
+        try:
+            validate_json(request.json, Stock, "adjust_schema")
+        except ValidationError as e:
+            return create_error_response(400, "Invalid JSON document", str(e))
+
+        delta = request.json["delta"]
+        quantity = Stock.adjust(product.productId, delta)
+        invalidate_on_commit(Stock, product.productId)
+        if quantity is None:
+            db.session.rollback()
+            if delta > 0:
+                return create_error_response(
+                    409, "Stock limit exceeded",
+                    f"Stock of product with ID {product.productId} can't be increased by {delta}"
+                )
+            return create_error_response(
+                409, "Insufficient stock",
+                f"Stock of product with ID {product.productId} can't be reduced by {-delta}"
+            )
+        db.session.commit()
+
+        body = InventoryBuilder(productId=product.productId, quantity=quantity)
+        body.add_control("self", href=url_for("api.stockitem", product=product.productId))
+        body.add_control_profile(STOCK_PROFILE)
+
+        return Response(encode(body), 200, mimetype=MASON)
+
+    @conditional_item(_stock_etag)
     @swag_from('../../doc/stock/stock_item_delete.yml')
     def delete(self, product):
         ''' Delete a product's stock '''
@@ -0,0 +1,160 @@
+'''
+Order totals maintained from the product orders of onlinestore API
+'''
+from sqlalchemy import event, inspect, select, update
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
+
+from onlinestore.cache import invalidate_on_commit
+from onlinestore.models import (
+    Order, Product, ProductOrder, Revision, round_money, update_returning
+)
+
+
+def committed_value(obj, name):
+    ''' Value of a column of an object before the changes of the flush '''
+    history = inspect(obj).attrs[name].history
+    if history.deleted:
+        return history.deleted[0]
+    return getattr(obj, name)
+
+
+def _changed(line, name):
+    return inspect(line).attrs[name].history.has_changes()
+
+
+def _capture_prices(session, lines):
+    '''
+    Set the unit price of product orders to the current price of their
+    product. Products set with the relationship are used as they are, the
+    prices of the rest are read with one query.
+    '''
+    queried = []
+    for line in lines:
+        # The foreign key of a line added with its product is set only by the flush
+        product = line.__dict__.get("product")
+        if product is not None:
+            line.unitPrice = product.price
+        elif line.productId is not None:
+            queried.append(line)
+    if not queried:
+        return
+    prices = dict(session.execute(
+        select(Product.id, Product.price)
+        .where(Product.id.in_({line.productId for line in queried}))
+    ).all())
+    for line in queried:
+        if line.productId in prices:
+            line.unitPrice = prices[line.productId]
+
+
+def current_lines(session, lines):
+    '''
+    The rows of persistent product orders as the database has them, by ID,
+    locked until the end of the transaction where the database supports it.
+    The values loaded into the session may be stale, another transaction may
+    have changed or deleted the rows since. Deleted rows are missing.
+    '''
+    ids = {inspect(line).identity[0] for line in lines}
+    if not ids:
+        return {}
+    table = ProductOrder.__table__
+    rows = session.connection().execute(
+        select(table.c.id, table.c.orderId, table.c.productId, table.c.quantity,
+               table.c.unitPrice)
+        .where(table.c.id.in_(ids))
+        .with_for_update()
+    )
+    return {row.id: row for row in rows}
+
+
+@event.listens_for(Session, "before_flush")
+def _update_order_totals(session, flush_context, instances):
+    '''
+    Capture the unit prices of new product orders and update the total and
+    item count of their orders in the same transaction. Persistent orders are
+    changed with one relative UPDATE per order, so concurrent requests adding
+    lines to the same order can't lose each other's changes, and the orders
+    already in the session get the new values without a query. Orders
+    inserted by the same flush get their totals before they are inserted.
+    Changed and deleted lines are subtracted with the values the database
+    has, a line that is already gone changes nothing.
+    '''
+    session.info.pop("current_lines", None)
+    new = [obj for obj in session.new if isinstance(obj, ProductOrder)]
+    changed = [
+        obj for obj in session.dirty
+        if isinstance(obj, ProductOrder) and session.is_modified(obj)
+    ]
+    deleted = [obj for obj in session.deleted if isinstance(obj, ProductOrder)]
+    if not (new or changed or deleted):
+        return
+
+    # Lines moved to another product are priced again
+    _capture_prices(session, [
+        line for line in new if line.unitPrice is None
+    ] + [
+        line for line in changed
+        if _changed(line, "productId") and not _changed(line, "unitPrice")
+    ])
+
+    # Deltas by the ID of a persistent order or by a pending order object
+    deltas = {}
+
+    def add(order, price, quantity, sign):
+        total, items = deltas.get(order, (0.0, 0))
+        deltas[order] = (total + sign * (price or 0.0) * quantity, items + sign * quantity)
+
+    def order_of(line):
+        # The foreign key of a line added to its order is set only by the flush
+        order = line.__dict__.get("order")
+        if order is None:
+            return line.orderId
+        return order if inspect(order).pending else order.id
+
+    for line in new:
+        add(order_of(line), line.unitPrice, line.quantity, 1)
+    # Read once for the summary tables of the reports too
+    current = session.info["current_lines"] = current_lines(session, changed + deleted)
+    for line in changed:
+        row = current.get(inspect(line).identity[0])
+        # Updating a deleted line fails the flush
+        if row is not None:
+            add(row.orderId, row.unitPrice, row.quantity, -1)
+            add(order_of(line), line.unitPrice, line.quantity, 1)
+    # Lines deleted with their order don't need to be subtracted
+    deleted_orders = {obj.id for obj in session.deleted if isinstance(obj, Order)}
+    for line in deleted:
+        row = current.get(inspect(line).identity[0])
+        if row is not None and row.orderId not in deleted_orders:
+            add(row.orderId, row.unitPrice, row.quantity, -1)
+
+    table = Order.__table__
+    connection = session.connection()
+    updated = []
+    for order, (total, items) in deltas.items():
+        if isinstance(order, Order):
+            order.total = round((order.total or 0.0) + total, 2)
+            order.itemCount = (order.itemCount or 0) + items
+        elif order is not None and (total or items):
+            updated.append((order, total, items))
+
+    # Orders are updated in a fixed order so concurrent transactions lock rows the same way
+    for order_id, total, items in sorted(updated, key=lambda delta: delta[0]):
+        where = table.c.id == order_id
+        row = update_returning(
+            connection,
+            update(table).where(where).values(
+                total=round_money(table.c.total + total),
+                itemCount=table.c.itemCount + items,
+            ),
+            where, table.c.total, table.c.itemCount
+        )
+        invalidate_on_commit(Order, order_id)
+        key = inspect(Order).identity_key_from_primary_key((order_id,))
+        order = session.identity_map.get(key)
+        if row is not None and order is not None:
+            set_committed_value(order, "total", row.total)
+            set_committed_value(order, "itemCount", row.itemCount)
+    if updated:
+        Revision.touch(session, {table.name})
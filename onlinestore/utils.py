@@ -1,13 +1,79 @@
 '''
 Utility methods for onlinestore API
 '''
+import base64
+import functools
+import hashlib
 import json
-from flask import Response, request, url_for
+import operator
+from collections import namedtuple
+from datetime import date, datetime, timezone
+from flask import Response, current_app, has_request_context, request, stream_with_context, url_for
+from sqlalchemy import tuple_
 from werkzeug.routing import BaseConverter
 from werkzeug.exceptions import NotFound
-
-from onlinestore.models import Product, Customer, Order, ProductOrder, Stock
-from onlinestore.constants import ERROR_PROFILE, MASON
+from jsonschema.exceptions import best_match
+
+from onlinestore.models import (
+    Product, Customer, Order, ProductOrder, Stock, Revision, format_datetime
+)
+from onlinestore.cache import LOOKUP_COLUMNS, lookup
+from onlinestore.encoding import dumps, encode, get_dumps
+from onlinestore.validation import get_validator
+from onlinestore.constants import (
+    ERROR_PROFILE, JSON, MASON, NDJSON, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, STREAM_BATCH_SIZE,
+    MAX_BATCH_SIZE
+)
+
+# One page of a keyset paginated query, next and prev are cursors or None
+Page = namedtuple("Page", ["items", "next", "prev"])
+
+# Filters, sort order and projected fields of a collection request
+CollectionQuery = namedtuple("CollectionQuery", ["query", "sort", "descending", "fields"])
+
+# Query parameters that are not filters
+RESERVED_PARAMETERS = {
+    "limit", "after", "before", "stream", "embed", "fields", "sort", "from", "to"
+}
+
+# Operators of range filters, e.g. ?price[lt]=10
+RANGE_OPERATORS = {
+    "gt": operator.gt,
+    "gte": operator.ge,
+    "lt": operator.lt,
+    "lte": operator.le,
+}
+
+# Stands for the key of an item when building the URL template of a collection
+_URL_KEY = "{key}"
+
+
+def cached_controls(method):
+    '''
+    Decorator for builder methods that add the same controls or namespaces to
+    every response. The first call in an app builds them on an empty builder
+    and caches their encoding, later calls add the cached fragments.
+    '''
+    @functools.wraps(method)
+    def wrapper(self, *args):
+        fragments = current_app.extensions.get("json_fragments")
+        if fragments is None:
+            return method(self, *args)
+        # URLs depend on where the app is mounted
+        script_root = request.script_root if has_request_context() else ""
+        key = (method.__name__, args, script_root)
+        cached = fragments.get(key)
+        if cached is None:
+            scratch = type(self)()
+            method(scratch, *args)
+            cached = fragments[key] = {
+                member: {name: dumps(value) for name, value in values.items()}
+                for member, values in scratch.items()
+            }
+        for member, values in cached.items():
+            self.setdefault(member, {}).update(values)
+        return None
+    return wrapper
 
 
 class MasonBuilder(dict):
@@ -140,6 +206,22 @@ class InventoryBuilder(MasonBuilder):
     implementation details.
     """
 
+    @cached_controls
+    def add_namespace(self, ns, uri):
+        ''' Add a namespace, the encoded namespace is cached '''
+        super().add_namespace(ns, uri)
+
+    @cached_controls
+    def add_control_profile(self, profile):
+        ''' Add control to the profile of the resource '''
+        self.add_control("profile", href=profile)
+
+    @cached_controls
+    def add_control_collection(self, endpoint):
+        ''' Add control to the collection of the resource '''
+        self.add_control("collection", href=url_for(endpoint))
+
+    @cached_controls
     def add_control_all_products(self):
         ''' Add control to get all products '''
         self.add_control(
@@ -149,6 +231,25 @@ class InventoryBuilder(MasonBuilder):
             title="Get all products",
         )
 
+    @cached_controls
+    def add_control_search_products(self):
+        ''' Add control to search products, the query goes to the q parameter '''
+        self.add_control(
+            "product:search-products",
+            url_for("api.productsearch") + "?q={q}",
+            method="GET",
+            title="Search products by name and description",
+            isHrefTemplate=True,
+            schema={
+                "type": "object",
+                "properties": {
+                    "q": {"type": "string", "description": "Words to search, prefixes match"}
+                },
+                "required": ["q"]
+            }
+        )
+
+    @cached_controls
     def add_control_all_customers(self):
         ''' Add control to get all customers '''
         self.add_control(
@@ -158,6 +259,7 @@ class InventoryBuilder(MasonBuilder):
             title="Get all customers",
         )
 
+    @cached_controls
     def add_control_all_orders(self):
         ''' Add control to get all orders '''
         self.add_control(
@@ -167,6 +269,7 @@ class InventoryBuilder(MasonBuilder):
             title="Get all orders",
         )
 
+    @cached_controls
     def add_control_all_productorders(self):
         ''' Add control to get all product orders '''
         self.add_control(
@@ -176,6 +279,7 @@ class InventoryBuilder(MasonBuilder):
             title="Get all product orders",
         )
 
+    @cached_controls
     def add_control_all_stock(self):
         ''' Add control to get all stock '''
         self.add_control(
@@ -185,6 +289,29 @@ class InventoryBuilder(MasonBuilder):
             title="Get all stocks",
         )
 
+    def add_control_pagination(self, endpoint, page, **values):
+        '''
+        Add controls to get the next and previous pages of a collection. The
+        keyword arguments are the URL variables of the endpoint.
+        '''
+        # Keep the other query parameters (e.g. limit) when moving between pages
+        args = {k: v for k, v in request.args.items() if k not in ("after", "before")}
+        args.update(values)
+        if page.next is not None:
+            self.add_control(
+                "next",
+                url_for(endpoint, after=page.next, **args),
+                method="GET",
+                title="Get the next page",
+            )
+        if page.prev is not None:
+            self.add_control(
+                "prev",
+                url_for(endpoint, before=page.prev, **args),
+                method="GET",
+                title="Get the previous page",
+            )
+
     def add_control_customer_to_order(self, order):
         ''' Add control to get customer to order '''
         if order.customer is None:
@@ -200,18 +327,18 @@ class InventoryBuilder(MasonBuilder):
         ''' Add control to get customer orders '''
         self.add_control(
             "customer:customer-orders",
-            url_for("api.orderitem", order=customer.uuid),
+            url_for("api.customerordercollection", customer=customer.uuid),
             method="GET",
             title="Get customer orders",
         )
 
     def add_control_get_productorder(self, product):
-        ''' Add control to get product order '''
+        ''' Add control to get the product orders of a product '''
         self.add_control(
             "product:get-productorder",
-            url_for("api.productorderitem", productorder=product.id),
+            url_for("api.productproductordercollection", product=product.id),
             method="GET",
-            title="Get product order for the product",
+            title="Get product orders for the product",
         )
 
     def add_control_get_stock(self, product):
@@ -223,11 +350,13 @@ class InventoryBuilder(MasonBuilder):
             title="Get stock for the product",
         )
 
-    def add_control_get_product(self, product):
+    def add_control_get_product(self, stock):
         ''' Add control to get product '''
+        # The foreign keys are used instead of the relationships, which would
+        # load the product or order with another query
         self.add_control(
             "stock:get-product",
-            url_for("api.productitem", product=product.stockProduct.name),
+            url_for("api.productitem", product=stock.productId),
             method="GET",
             title="Get product for the stock",
         )
@@ -236,20 +365,23 @@ class InventoryBuilder(MasonBuilder):
         ''' Add control to get order '''
         self.add_control(
             "productorder:get-order",
-            url_for("api.orderitem", order=productorder.order.id),
+            url_for("api.orderitem", order=productorder.orderId),
             method="GET",
             title="Get order for the productorder",
         )
 
     def add_control_product(self, productorder):
-        ''' Add control to get product '''
+        ''' Add control to get product, if the product hasn't been deleted '''
+        if productorder.productId is None:
+            return
         self.add_control(
             "productorder:get-product",
-            url_for("api.productitem", product=productorder.product.id),
+            url_for("api.productitem", product=productorder.productId),
             method="GET",
             title="Get product for the productorder",
         )
 
+    @cached_controls
     def add_control_add_product(self):
         ''' Add control to add product '''
         self.add_control_post(
@@ -259,6 +391,7 @@ class InventoryBuilder(MasonBuilder):
             Product.json_schema()
         )
 
+    @cached_controls
     def add_control_add_customer(self):
         ''' Add control to add customer '''
         self.add_control_post(
@@ -268,6 +401,7 @@ class InventoryBuilder(MasonBuilder):
             Customer.json_schema()
         )
 
+    @cached_controls
     def add_control_add_order(self):
         ''' Add control to add order '''
         self.add_control_post(
@@ -277,6 +411,17 @@ class InventoryBuilder(MasonBuilder):
             Order.json_schema()
         )
 
+    @cached_controls
+    def add_control_place_order(self):
+        ''' Add control to place an order with its product orders '''
+        self.add_control_post(
+            "order:place-order",
+            "Place a new order with its product orders",
+            url_for("api.orderplacement"),
+            Order.place_schema()
+        )
+
+    @cached_controls
     def add_control_add_productorder(self):
         ''' Add control to add product order '''
         self.add_control_post(
@@ -326,6 +471,17 @@ class InventoryBuilder(MasonBuilder):
             Stock.json_schema()
         )
 
+    def add_control_adjust_stock(self, product):
+        ''' Add control to adjust stock relative to the current quantity '''
+        self.add_control(
+            "stock:adjust-stock",
+            url_for("api.stockitem", product=product.productId),
+            method="PATCH",
+            encoding="json",
+            title="Increase or decrease stock",
+            schema=Stock.adjust_schema()
+        )
+
     def add_control_delete_product(self, product):
         ''' Add control to delete product '''
         href = url_for("api.productitem", product=product.id)
@@ -358,7 +514,496 @@ def create_error_response(status_code, title, message=None):
     body = MasonBuilder(resource_url=resource_url)
     body.add_error(title, message)
     body.add_control("profile", href=ERROR_PROFILE)
-    return Response(json.dumps(body), status_code, mimetype=MASON)
+    return Response(encode(body), status_code, mimetype=MASON)
+
+
+def create_etag(data):
+    ''' Create a strong ETag from the JSON serializable data of a representation '''
+    raw = json.dumps(data, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+def get_not_modified_response(etag, last_modified=None):
+    '''
+    Check the If-None-Match and If-Modified-Since headers of a GET request.
+    Returns a 304 response if the client has the current representation
+    already, otherwise None.
+    '''
+    if request.if_none_match:
+        # If-Modified-Since is ignored when If-None-Match is present
+        if not request.if_none_match.contains_weak(etag):
+            return None
+    elif last_modified is None or request.if_modified_since is None:
+        return None
+    elif last_modified.replace(microsecond=0) > request.if_modified_since:
+        return None
+
+    response = Response(status=304)
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
+
+
+def conditional_item(etag_function):
+    '''
+    Decorator for the methods of item resources. GET requests get an ETag
+    computed by *etag_function* from the item and a 304 response if the
+    client's If-None-Match matches it, before the document is built. PUT and
+    DELETE requests with an If-Match header that doesn't match the current
+    ETag are rejected with 412, so clients can do optimistic concurrency.
+    '''
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, **kwargs):
+            (item,) = kwargs.values()
+            if request.method in ("GET", "HEAD"):
+                etag = etag_function(item)
+                response = get_not_modified_response(etag)
+                if response is not None:
+                    return response
+                response = method(self, **kwargs)
+                if response.status_code == 200:
+                    response.set_etag(etag)
+                return response
+
+            if request.if_match and not request.if_match.contains(etag_function(item)):
+                return create_error_response(
+                    412, "Precondition failed",
+                    "The resource has been modified since it was retrieved"
+                )
+            return method(self, **kwargs)
+        return wrapper
+    return decorator
+
+
+def conditional_collection(*models, embeds=None):
+    '''
+    Decorator for the GET methods of collection resources. The ETag and
+    Last-Modified of the response come from the revisions of the tables of
+    *models* and the request URL, so a 304 response can be returned with one
+    primary key lookup instead of querying and building the collection.
+    *embeds* maps the names accepted by the embed query parameter to the
+    models whose tables the embedded resources come from.
+    '''
+    names = [model.__tablename__ for model in models]
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, **kwargs):
+            tables = list(names)
+            if embeds:
+                try:
+                    tables += [embeds[name].__tablename__ for name in get_embed(embeds)]
+                except ValueError:
+                    # The method responds to invalid parameters
+                    pass
+            revisions = Revision.query.filter(Revision.name.in_(tables)).all()
+            etag = create_etag([
+                request.full_path,
+                request.headers.get("Accept"),
+                sorted((r.name, r.version, r.modifiedAt.isoformat()) for r in revisions)
+            ])
+            last_modified = None
+            if revisions:
+                last_modified = max(r.modifiedAt for r in revisions).replace(tzinfo=timezone.utc)
+
+            response = get_not_modified_response(etag, last_modified)
+            if response is not None:
+                return response
+            response = method(self, **kwargs)
+            if response.status_code == 200:
+                response.set_etag(etag)
+                if last_modified is not None:
+                    response.last_modified = last_modified
+            return response
+        return wrapper
+    return decorator
+
+
+def validate_batch(items, model):
+    '''
+    Validate each item of a batch create request against the schema of a
+    single item of the model. Returns a list with an error item for every invalid item and
+    None for the valid ones. Raises ValueError if the batch itself is invalid.
+    '''
+    if not items:
+        raise ValueError("Batch must contain at least one item")
+    if len(items) > MAX_BATCH_SIZE:
+        raise ValueError(f"Batch can contain at most {MAX_BATCH_SIZE} items")
+    validator = get_validator(model)
+    results = []
+    for item in items:
+        error = best_match(validator.iter_errors(item))
+        if error is not None:
+            results.append(create_batch_error(400, "Invalid JSON document", error.message))
+        else:
+            results.append(None)
+    return results
+
+
+def create_batch_item(href):
+    ''' Create the result of a batch item that was created '''
+    item = InventoryBuilder(status=201)
+    item.add_control("self", href=href)
+    return item
+
+
+def create_batch_error(status_code, title, message):
+    ''' Create the result of a batch item that could not be created '''
+    item = MasonBuilder(status=status_code)
+    item.add_error(title, message)
+    return item
+
+
+def create_batch_response(results):
+    '''
+    Create the response of a batch create request. The results are in the
+    same order as the items of the request. The status is 201 if every item
+    was created and 207 (Multi-Status) otherwise.
+    '''
+    body = MasonBuilder(items=results)
+    status_code = 201 if all(item["status"] == 201 for item in results) else 207
+    return Response(encode(body), status_code, mimetype=MASON)
+
+
+def encode_cursor(value):
+    ''' Encode a key value, or a list of them, into an opaque pagination cursor '''
+    if isinstance(value, (list, tuple)):
+        value = [v.isoformat() if isinstance(v, date) else v for v in value]
+    elif isinstance(value, date):
+        value = value.isoformat()
+    raw = json.dumps(value, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor, size=None):
+    '''
+    Decode a pagination cursor created by encode_cursor. *size* is the length
+    of the list of values in cursors of composite keys.
+    '''
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        value = json.loads(raw)
+    except ValueError as e:
+        raise ValueError(f"Invalid cursor '{cursor}'") from e
+    values = value if size is not None else [value]
+    if not isinstance(values, list) or len(values) != (size or 1):
+        raise ValueError(f"Invalid cursor '{cursor}'")
+    for item in values:
+        if isinstance(item, bool) or not isinstance(item, (int, float, str)):
+            raise ValueError(f"Invalid cursor '{cursor}'")
+    return value
+
+
+def parse_datetime(value):
+    '''
+    Parse an ISO 8601 date or time to a naive UTC datetime, the way times are
+    stored. Times without an offset are UTC. Raises ValueError if the value is
+    invalid.
+    '''
+    try:
+        moment = datetime.fromisoformat(value)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid time '{value}'") from e
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+
+def get_page_limit():
+    '''
+    Read the page size from the limit query parameter. The value is capped to
+    the MAX_PAGE_SIZE setting of the app. Raises ValueError if it is invalid.
+    '''
+    max_size = current_app.config.get("MAX_PAGE_SIZE", MAX_PAGE_SIZE)
+    limit = request.args.get("limit")
+    if limit is None:
+        return min(DEFAULT_PAGE_SIZE, max_size)
+    try:
+        limit = int(limit)
+    except ValueError as e:
+        raise ValueError(f"Invalid limit '{limit}'") from e
+    if limit < 1:
+        raise ValueError("Limit must be a positive integer")
+    return min(limit, max_size)
+
+
+def _cursor_value(column, value, cursor):
+    ''' Convert a value of a cursor back to the type of its column '''
+    python_type = column.type.python_type
+    try:
+        if python_type is datetime:
+            return parse_datetime(value)
+        if python_type is date:
+            return date.fromisoformat(value)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor '{cursor}'") from e
+    return value
+
+
+def _order_by(columns, descending):
+    return [column.desc() for column in columns] if descending else list(columns)
+
+
+def paginate(query, key, sort=None, descending=False):
+    '''
+    Get one page of query results using keyset pagination over the unique
+    column *key* (usually the primary key). The page is selected with the
+    after and before cursors of the current request, so every page is a single
+    range scan over the key's index instead of an OFFSET over the whole table.
+
+    If *sort* is given the page is ordered by that column and then by the
+    key, and the cursors hold the values of both. An index on the sort column
+    makes the pages range scans of that index. With *descending* the pages go
+    from the largest values to the smallest.
+    Raises ValueError if the query parameters are invalid.
+    '''
+    limit = get_page_limit()
+    after = request.args.get("after")
+    before = request.args.get("before")
+    if after is not None and before is not None:
+        raise ValueError("Use either 'after' or 'before', not both")
+
+    columns = [key] if sort is None else [sort, key]
+    position = key if sort is None else tuple_(sort, key)
+
+    def decode(cursor):
+        if sort is None:
+            return _cursor_value(key, decode_cursor(cursor), cursor)
+        value, key_value = decode_cursor(cursor, 2)
+        return tuple_(_cursor_value(sort, value, cursor), _cursor_value(key, key_value, cursor))
+
+    # Going forward in a descending order is going backward in the index
+    forward, backward = (operator.lt, operator.gt) if descending else (operator.gt, operator.lt)
+    if before is not None:
+        query = query.filter(backward(position, decode(before)))
+        items = query.order_by(*_order_by(columns, not descending)).limit(limit + 1).all()
+        has_prev, has_next = len(items) > limit, True
+        items = items[:limit][::-1]
+    else:
+        if after is not None:
+            query = query.filter(forward(position, decode(after)))
+        items = query.order_by(*_order_by(columns, descending)).limit(limit + 1).all()
+        has_prev, has_next = after is not None, len(items) > limit
+        items = items[:limit]
+
+    def cursor(item):
+        values = [getattr(item, column.key) for column in columns]
+        return encode_cursor(values[0] if sort is None else values)
+
+    next_cursor = prev_cursor = None
+    if items and has_next:
+        next_cursor = cursor(items[-1])
+    if items and has_prev:
+        prev_cursor = cursor(items[0])
+    return Page(items, next_cursor, prev_cursor)
+
+
+def _parse_value(column, value):
+    ''' Convert the value of a filter to the type of its column '''
+    python_type = column.type.python_type
+    if python_type is datetime:
+        return parse_datetime(value)
+    try:
+        if python_type is date:
+            return date.fromisoformat(value)
+        return python_type(value)
+    except ValueError as e:
+        raise ValueError(f"Invalid value '{value}' for '{column.key}'") from e
+
+
+@functools.lru_cache(maxsize=None)
+def _serialized_fields(model):
+    ''' Names of the fields in the serialized items of a model '''
+    return tuple(model().serialize())
+
+
+def query_collection(model, query, key, projection=True, default_sort=None):
+    '''
+    Apply the filter, sort and fields query parameters of the request to the
+    query of a collection of *model*. The columns listed in model.FILTERS can
+    be filtered by equality (?name=Umbrella) or by range (?price[gte]=10 with
+    gt, gte, lt or lte). The collection can be sorted by one of model.SORTS
+    with ?sort=column, or ?sort=-column for a descending order. The columns
+    allowed there are indexed, so sorted pages stay range scans. Without
+    ?sort the collection is sorted by *default_sort*, or by the key if None.
+
+    ?fields=a,b limits the items to some of their fields. With *projection*
+    only those columns are selected, the rows of the query are then tuples
+    that have the fields, the key, the sort column and the URL key of the
+    model as attributes.
+    Raises ValueError if a parameter is invalid.
+    '''
+    for name, value in request.args.items(multi=True):
+        if name in RESERVED_PARAMETERS:
+            continue
+        column_name, bracket, op = name.partition("[")
+        if column_name not in model.FILTERS:
+            raise ValueError(f"Unknown query parameter '{name}'")
+        column = getattr(model, column_name)
+        if not bracket:
+            query = query.filter(column == _parse_value(column, value))
+            continue
+        if not op.endswith("]") or op[:-1] not in RANGE_OPERATORS:
+            raise ValueError(f"Unknown query parameter '{name}'")
+        query = query.filter(RANGE_OPERATORS[op[:-1]](column, _parse_value(column, value)))
+
+    sort, descending = default_sort, False
+    value = request.args.get("sort")
+    if value:
+        sort = None
+        descending = value.startswith("-")
+        name = value[1:] if descending else value
+        if name not in model.SORTS:
+            raise ValueError(f"Can't sort by '{name}'")
+        if name != key.key:
+            sort = getattr(model, name)
+
+    fields = None
+    value = request.args.get("fields")
+    if value:
+        fields = [name.strip() for name in value.split(",") if name.strip()]
+        for name in fields:
+            if name not in _serialized_fields(model):
+                raise ValueError(f"Unknown field '{name}'")
+        if projection:
+            names = [*fields, key.key, LOOKUP_COLUMNS[model]]
+            if sort is not None:
+                names.append(sort.key)
+            query = query.with_entities(*[getattr(model, name) for name in dict.fromkeys(names)])
+
+    return CollectionQuery(query, sort, descending, fields)
+
+
+def get_embed(allowed):
+    '''
+    Read the names of the resources to embed in the document from the comma
+    separated embed query parameter. Raises ValueError if a name is not one
+    of *allowed*.
+    '''
+    value = request.args.get("embed")
+    if not value:
+        return set()
+    embed = {name.strip() for name in value.split(",") if name.strip()}
+    for name in sorted(embed):
+        if name not in allowed:
+            raise ValueError(f"Unknown embedded resource '{name}'")
+    return embed
+
+
+def wants_stream():
+    '''
+    Check if the client asked for a streamed collection, either with the
+    stream=1 query parameter or by accepting NDJSON.
+    '''
+    if request.args.get("stream") in ("1", "true"):
+        return True
+    return _accepts_ndjson()
+
+
+def _accepts_ndjson():
+    ''' Check if NDJSON is the best match for the Accept header of the request '''
+    return request.accept_mimetypes.best_match([MASON, JSON, NDJSON]) == NDJSON
+
+
+class ItemEncoder:
+    """
+    Encodes the items of a collection with their self and profile controls.
+    The controls of the items differ only by the key in the self URL, so they
+    are encoded once per response around a URL template instead of building
+    them and calling url_for for every item.
+
+    : param str endpoint: the endpoint of the item resource
+    : param str arg: the URL argument of the endpoint
+    : param str key: the attribute of the model that is used in the URL
+    : param str profile: the profile of the items
+    : param embed: optional function returning the resources embedded in the
+        item of a model instance as a dictionary of members
+    : param list fields: optional fields the items are limited to, the items
+        can then be rows that have only those attributes
+    """
+
+    def __init__(self, endpoint, arg, key, profile, embed=None, fields=None):
+        # The encoded controls are split around the key of the self URL
+        self.key = key
+        self.embed = embed
+        self.fields = fields
+        self.dumps = get_dumps()
+        controls = self.dumps({
+            "self": {"href": url_for(endpoint, **{arg: _URL_KEY})},
+            "profile": {"href": profile},
+        })
+        head, self.tail = controls.split(_URL_KEY.encode())
+        self.tail += b"}"
+        self.head = b', "@controls": ' + head
+
+    def __call__(self, obj):
+        ''' Encode the collection item of a model instance '''
+        if self.fields is None:
+            data = obj.serialize()
+        else:
+            data = {name: getattr(obj, name) for name in self.fields}
+            for name, value in data.items():
+                if isinstance(value, datetime):
+                    data[name] = format_datetime(value)
+        if self.embed is not None:
+            data.update(self.embed(obj))
+        return self.encode(data, getattr(obj, self.key))
+
+    def encode(self, data, key):
+        ''' Encode the collection item from serialized data and its URL key '''
+        # Embedded items are already encoded and have to be spliced in
+        raw = encode(data) if self.embed is not None else self.dumps(data)
+        if raw == b"{}":
+            return b"{" + self.head[2:] + str(key).encode() + self.tail
+        return raw[:-1] + self.head + str(key).encode() + self.tail
+
+
+def stream_collection(body, name, query, key, encode_item, sort=None, descending=False):
+    '''
+    Stream every row of *query* ordered by *key* instead of building the
+    whole collection in memory. Rows are fetched in batches of
+    STREAM_BATCH_SIZE with yield_per and each batch is encoded and sent
+    before the next one is loaded, so peak memory does not depend on the size
+    of the table. Pagination parameters are ignored, the whole collection is
+    exported.
+
+    Clients accepting NDJSON get one item per line. Otherwise the response is
+    the usual Mason document with the items under *name*.
+
+    : param InventoryBuilder body: the collection document without items
+    : param str name: the name of the item list in the document
+    : param encode_item: function that encodes the item of a row, e.g. an ItemEncoder
+    : param sort: optional column the rows are ordered by before the key
+    : param bool descending: order the rows from the largest values to the smallest
+    '''
+    batch_size = current_app.config.get("STREAM_BATCH_SIZE", STREAM_BATCH_SIZE)
+    columns = [key] if sort is None else [sort, key]
+    rows = query.order_by(*_order_by(columns, descending)).yield_per(batch_size)
+    ndjson = _accepts_ndjson()
+
+    def encode_batch(batch, first):
+        if ndjson:
+            return b"".join(item + b"\n" for item in batch)
+        return (b"" if first else b", ") + b", ".join(batch)
+
+    def generate():
+        if not ndjson:
+            yield encode(body)[:-1] + b", " + json.dumps(name).encode() + b": ["
+        batch, first = [], True
+        for row in rows:
+            batch.append(encode_item(row))
+            if len(batch) == batch_size:
+                yield encode_batch(batch, first)
+                batch, first = [], False
+        if batch:
+            yield encode_batch(batch, first)
+        if not ndjson:
+            yield b"]}"
+
+    mimetype = NDJSON if ndjson else MASON
+    return Response(stream_with_context(generate()), 200, mimetype=mimetype)
 
 
 class ProductConverter(BaseConverter):
@@ -370,7 +1015,7 @@ class ProductConverter(BaseConverter):
 
     def to_python(self, value):  # used in routing
         ''' Convert product name to Product object '''
-        db_product = Product.query.filter_by(id=value).first()
+        db_product = lookup(Product, value)
         if db_product is None:
             raise NotFound
         return db_product
@@ -391,7 +1036,7 @@ class CustomerConverter(BaseConverter):
 
     def to_python(self, value):  # used in routing
         ''' Convert customer UUID to Customer object '''
-        db_customer = Customer.query.filter_by(uuid=value).first()
+        db_customer = lookup(Customer, value)
         if db_customer is None:
             raise NotFound
         return db_customer
@@ -410,7 +1055,7 @@ class OrderConverter(BaseConverter):
 
     def to_python(self, value):  # used in routing
         ''' Convert order ID to Order object '''
-        db_order = Order.query.filter_by(id=value).first()
+        db_order = lookup(Order, value)
         if db_order is None:
             raise NotFound
         return db_order
@@ -429,8 +1074,7 @@ class ProductOrderConverter(BaseConverter):
 
     def to_python(self, value):  # used in routing
         ''' Convert product order ID to ProductOrder object '''
-        db_product_order = ProductOrder.query.filter_by(
-            id=value).first()
+        db_product_order = lookup(ProductOrder, value)
         if db_product_order is None:
             raise NotFound
         return db_product_order
@@ -449,7 +1093,7 @@ class StockConverter(BaseConverter):
 
     def to_python(self, value):  # used in routing
         ''' Convert product ID to Stock object '''
-        db_stock = Stock.query.filter_by(productId=value).first()
+        db_stock = lookup(Stock, value)
         if db_stock is None:
             raise NotFound
         return db_stock
@@ -0,0 +1,55 @@
+'''
+Registry of compiled JSON schema validators for request bodies
+'''
+from jsonschema.exceptions import best_match
+from jsonschema.validators import validator_for
+
+from onlinestore.models import Product, Customer, Order, ProductOrder, Stock
+
+# Request body schemas as (model, name of the schema method)
+SCHEMAS = [
+    (Product, "json_schema"),
+    (Customer, "json_schema"),
+    (Order, "json_schema"),
+    (Order, "place_schema"),
+    (ProductOrder, "json_schema"),
+    (Stock, "json_schema"),
+    (Stock, "adjust_schema"),
+]
+
+_validators = {}
+
+
+def init_app(app):
+    ''' Build the validators of every request body schema when the app is created '''
+    for model, schema in SCHEMAS:
+        get_validator(model, schema)
+
+
+def get_validator(model, schema="json_schema"):
+    '''
+    Get the validator for a schema of a model. The schema is built and checked
+    and the validator created only the first time, jsonschema.validate does
+    all of it on every call.
+    '''
+    validator = _validators.get((model, schema))
+    if validator is None:
+        schema_dict = getattr(model, schema)()
+        cls = validator_for(schema_dict)
+        cls.check_schema(schema_dict)
+        validator = _validators[(model, schema)] = cls(schema_dict)
+    return validator
+
+
+def validate_json(instance, model, schema="json_schema"):
+    '''
+    Validate a request body against a schema of a model. Raises the same
+    ValidationError as jsonschema.validate if the body is invalid.
+
+    : param instance: the request body
+    : param model: the model class that defines the schema
+    : param str schema: name of the schema method of the model
+    '''
+    error = best_match(get_validator(model, schema).iter_errors(instance))
+    if error is not None:
+        raise error
@@ -20,4 +20,11 @@ setup(
         "pytest-coverage",
         "jsonschema",
     ],
+    extras_require={
+        # Faster encoding of the responses
+        "fast": ["orjson"],
+        # Client/server databases
+        "postgresql": ["psycopg2-binary"],
+        "mysql": ["pymysql"],
+    },
 )
@@ -1,6 +1,5 @@
 import sys
 import os
-from datetime import datetime
 from onlinestore import db
 from onlinestore.models import Customer, Order, Product, Stock, ProductOrder
 
@@ -73,8 +72,7 @@ def _populate_db():
     )
 
     antin_tilaus = Order(
-        customer=antti,
-        createdAt=datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        customer=antti
     )
 
     antin_tuote_1 = ProductOrder(
@@ -1,27 +1,25 @@
 """ Tests for the database models of onlinestore """
+import os
 import pytest
 from datetime import datetime
-from sqlalchemy.engine import Engine
 from sqlalchemy import event
 
 from onlinestore import create_app, db
 from onlinestore.models import Customer, Order, Product, ProductOrder, Stock
 
-@event.listens_for(Engine, "connect")
-def set_sqlite_pragma(dbapi_connection, connection_record):
-    ''' This function is called when a connection to the database is made '''
-    cursor = dbapi_connection.cursor()
-    cursor.execute("PRAGMA foreign_keys=ON")
-    cursor.close()
+# The tests run against SQLite and the databases in TEST_DATABASE_URLS
+# (space separated, e.g. postgresql://localhost/onlinestore_test)
+DATABASE_URLS = ['sqlite:///database_test.db'] + os.environ.get("TEST_DATABASE_URLS", "").split()
+
 
 # based on http://flask.pocoo.org/docs/1.0/testing/
 # we don't need a client for database testing, just the db handle
-@pytest.fixture(scope="function")
-def app():
+@pytest.fixture(scope="function", params=DATABASE_URLS, ids=lambda url: url.split(":")[0])
+def app(request):
     ''' Create and configure a new app instance for each test '''
     # Create a temporary database file for testing purposes
     test_config = {
-        "SQLALCHEMY_DATABASE_URI": 'sqlite:///database_test.db',
+        "SQLALCHEMY_DATABASE_URI": request.param,
         "TESTING": True
     }
 
@@ -37,6 +35,11 @@ def app():
         db.session.remove()
         db.drop_all()  # drop all tables in the database
 
+def _require_sqlite():
+    ''' Skip a test that checks the behaviour of SQLite itself '''
+    if db.engine.dialect.name != "sqlite":
+        pytest.skip("SQLite only")
+
 def _get_customer(number=1):
     ''' Helper function to create a customer instance '''
     return Customer(
@@ -58,8 +61,7 @@ def _get_product(number=1):
 def _get_order(customer):
     ''' Helper function to create an order instance '''
     return Order(
-        customerId=customer,
-        createdAt=datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        customerId=customer
     )
 
 def _get_product_order(order, product, quantity=1):
@@ -126,3 +128,577 @@ def test_create_instances(app):
         #assert db_product.products == db_product_order
         #assert db_product.stock == db_stock
         #assert db_stock.stockProduct == db_product
+
+def _query_plans(statements):
+    ''' Return the EXPLAIN QUERY PLAN details of each SELECT statement '''
+    plans = []
+    with db.engine.connect() as connection:
+        for statement, parameters in statements:
+            if not statement.lstrip().upper().startswith("SELECT"):
+                continue
+            rows = connection.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters)
+            plans.append((statement, [row[-1] for row in rows]))
+    return plans
+
+def test_relationship_loads_use_indexes(app):
+    """
+    Tests that every relationship load used by the resources looks the rows up
+    with an index instead of scanning the table.
+    """
+    from sqlalchemy.orm import joinedload, selectinload
+
+    with app.app_context():
+        _require_sqlite()
+        customer = _get_customer(1)
+        db.session.add(customer)
+        db.session.commit()
+        order = _get_order(customer.uuid)
+        product = _get_product(1)
+        db.session.add_all([order, _get_product_order(order, product, 1), _get_stock(product, 1)])
+        db.session.commit()
+
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            statements.append((statement, parameters))
+
+        event.listen(db.engine, "before_cursor_execute", capture)
+        try:
+            loads = [
+                lambda: Customer.query.first().orders,
+                lambda: Order.query.first().customer,
+                lambda: Order.query.first().productOrders,
+                lambda: Product.query.first().productOrder,
+                lambda: Product.query.first().stock,
+                lambda: ProductOrder.query.first().order,
+                lambda: ProductOrder.query.first().product,
+                lambda: Stock.query.first().stockProduct,
+                # The collections of one customer and of one product
+                lambda: Order.query.filter(Order.customerId == customer.uuid)
+                .order_by(Order.id).limit(10).all(),
+                lambda: ProductOrder.query.filter(ProductOrder.productId == product.id)
+                .order_by(ProductOrder.id).limit(10).all(),
+                lambda: Order.query.options(
+                    selectinload(Order.productOrders).joinedload(ProductOrder.product),
+                    joinedload(Order.customer)
+                ).filter(Order.id == order.id).all(),
+            ]
+            for load in loads:
+                db.session.expire_all()
+                load()
+        finally:
+            event.remove(db.engine, "before_cursor_execute", capture)
+
+        plans = _query_plans(statements)
+        assert plans
+        for statement, details in plans:
+            # The .first() queries read one row of the whole table on purpose
+            if "LIMIT" in statement and "WHERE" not in statement:
+                continue
+            for detail in details:
+                # Sorting the lines of one order is fine, scanning a table isn't
+                if detail.startswith("USE TEMP B-TREE FOR ORDER BY"):
+                    continue
+                assert detail.startswith("SEARCH"), f"{detail} in {statement}"
+
+def test_migrate_db(app):
+    """
+    Tests that migrating an older database adds the missing indexes and that
+    migrating again does nothing.
+    """
+    from onlinestore.models import migrate_db
+
+    with app.app_context():
+        _require_sqlite()
+        with db.engine.begin() as connection:
+            connection.exec_driver_sql('DROP INDEX "ix_order_customerId"')
+            connection.exec_driver_sql('DROP INDEX "ix_product_order_orderId_productId"')
+            # Databases of older versions have neither the index nor its triggers
+            connection.exec_driver_sql('DROP TABLE "product_search"')
+            for action in ("insert", "update", "delete"):
+                connection.exec_driver_sql(f'DROP TRIGGER "product_search_{action}"')
+
+        db.session.add(_get_product())
+        db.session.commit()
+        created = migrate_db()
+        assert "ix_order_customerId" in created
+        assert "ix_product_order_orderId_productId" in created
+        # The full-text index is created with the existing products
+        assert "product_search" in created
+        with db.engine.connect() as connection:
+            rows = connection.exec_driver_sql(
+                "SELECT rowid FROM product_search WHERE product_search MATCH 'prod*'"
+            ).all()
+        assert len(rows) == 1
+        assert migrate_db() == []
+
+def test_migrate_foreign_keys(app):
+    """
+    Tests that migrating a database whose foreign keys differ from the models
+    rebuilds the tables with their rows and repairs the references to rows
+    that don't exist, so the foreign keys hold.
+    """
+    from onlinestore.models import migrate_db
+
+    with app.app_context():
+        _require_sqlite()
+        customer = _get_customer()
+        product = _get_product()
+        db.session.add_all([customer, product])
+        db.session.commit()
+        with db.engine.connect() as connection:
+            # Older versions wrote rows that break their foreign keys
+            connection.exec_driver_sql("PRAGMA foreign_keys=OFF")
+            connection.exec_driver_sql('DROP TABLE "order"')
+            connection.exec_driver_sql(
+                'CREATE TABLE "order" (id INTEGER NOT NULL, "customerId" INTEGER, '
+                '"createdAt" VARCHAR(50) NOT NULL, PRIMARY KEY (id), '
+                'FOREIGN KEY("customerId") REFERENCES customer (id) ON DELETE SET NULL)'
+            )
+            connection.exec_driver_sql(
+                'INSERT INTO "order" VALUES (1, ?, \'2024-05-06 21:25:40\'), '
+                '(2, \'missing\', \'2024-05-07 09:38:13\')', (customer.uuid,)
+            )
+            connection.exec_driver_sql(
+                'INSERT INTO product_order (id, "orderId", "productId", quantity) '
+                'VALUES (1, 1, ?, 2), (2, 3, ?, 1)', (product.id, product.id)
+            )
+            connection.commit()
+            connection.exec_driver_sql("PRAGMA foreign_keys=ON")
+
+        created = migrate_db()
+        assert {"order", "order.total", "order.customerId", "product_order.orderId"} <= set(created)
+        db.session.expire_all()
+        assert db.session.get(Order, 1).customerId == customer.uuid
+        assert db.session.get(Order, 1).total == 20.0
+        assert db.session.get(Order, 2).customerId is None
+        assert [line.id for line in ProductOrder.query.all()] == [1]
+        with db.engine.connect() as connection:
+            assert connection.exec_driver_sql("PRAGMA foreign_key_check").all() == []
+
+        db.session.add(Order(customerId=customer.uuid))
+        db.session.commit()
+        assert migrate_db() == []
+
+def test_migrate_order_times(app, caplog):
+    """
+    Tests that migrating converts the creation times stored as strings by
+    older versions to UTC datetimes, leaves the ones that can't be parsed
+    unchanged and reports their orders, and that the time range of orders
+    is read with an index range scan.
+    """
+    from onlinestore.models import migrate_db
+
+    with app.app_context():
+        _require_sqlite()
+        customer = _get_customer(1)
+        db.session.add(customer)
+        db.session.commit()
+        with db.engine.begin() as connection:
+            for value in ("2024-02-27 16:44:47+02:00", "2024-04-01T12:00:00Z", "garbage"):
+                connection.exec_driver_sql(
+                    'INSERT INTO "order" ("customerId", "createdAt") VALUES (?, ?)',
+                    (customer.uuid, value)
+                )
+
+        assert migrate_db() == ["order.createdAt"]
+        assert "unconverted: 3" in caplog.text
+        caplog.clear()
+        assert migrate_db() == []
+        assert "unconverted: 3" in caplog.text
+        with db.engine.connect() as connection:
+            assert connection.exec_driver_sql(
+                'SELECT "createdAt" FROM "order" WHERE id = 3'
+            ).scalar() == "garbage"
+            connection.exec_driver_sql('DELETE FROM "order" WHERE id = 3')
+            connection.commit()
+        orders = Order.query.order_by(Order.id).all()
+        assert orders[0].createdAt == datetime(2024, 2, 27, 14, 44, 47)
+        assert orders[1].serialize()["createdAt"] == "2024-04-01T12:00:00+00:00"
+
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            statements.append((statement, parameters))
+
+        event.listen(db.engine, "before_cursor_execute", capture)
+        try:
+            orders = Order.query.filter(
+                Order.createdAt >= datetime(2024, 1, 1), Order.createdAt < datetime(2024, 3, 1)
+            ).order_by(Order.createdAt, Order.id).all()
+        finally:
+            event.remove(db.engine, "before_cursor_execute", capture)
+        assert len(orders) == 1
+        [(statement, details)] = _query_plans(statements)
+        assert details == ['SEARCH order USING INDEX ix_order_createdAt (createdAt>? AND createdAt<?)']
+
+
+def test_order_totals(app):
+    """
+    Tests that the totals of orders are maintained when product orders are
+    added, changed and deleted through the ORM.
+    """
+    with app.app_context():
+        customer = _get_customer()
+        product_1 = _get_product(1)
+        product_2 = _get_product(2)
+        order = _get_order(customer.uuid)
+        # Lines added with a new order and their products
+        _get_product_order(order, product_1, 2)
+        _get_product_order(order, product_2, 1)
+        db.session.add_all([customer, order])
+        db.session.commit()
+        assert (order.total, order.itemCount) == (40.0, 3)
+
+        # Lines added to an existing order by ID update the loaded order too
+        line = ProductOrder(orderId=order.id, productId=product_2.id, quantity=3)
+        db.session.add(line)
+        db.session.flush()
+        assert line.unitPrice == 20.0
+        assert (order.total, order.itemCount) == (100.0, 6)
+
+        line.quantity = 1
+        line.productId = product_1.id
+        db.session.commit()
+        assert line.unitPrice == 10.0
+        assert (order.total, order.itemCount) == (50.0, 4)
+
+        # Price changes don't affect the placed order
+        product_1.price = 1000.0
+        db.session.delete(line)
+        db.session.commit()
+        assert (order.total, order.itemCount) == (40.0, 3)
+
+        # Lines deleted with their order
+        db.session.delete(order)
+        db.session.commit()
+        assert ProductOrder.query.count() == 0
+
+
+def test_stale_product_orders(app):
+    """
+    Tests that changing or deleting product orders another transaction has
+    already changed or deleted keeps the totals and reports right.
+    """
+    from sqlalchemy.exc import SAWarning
+    from sqlalchemy.orm import Session
+    from onlinestore.models import rebuild_reports
+
+    with app.app_context():
+        customer = _get_customer()
+        order = _get_order(customer.uuid)
+        line_1 = _get_product_order(order, _get_product(1), 2)
+        line_2 = _get_product_order(order, _get_product(2), 1)
+        db.session.add_all([customer, order])
+        db.session.commit()
+        # Loaded before the other transaction
+        assert (line_1.quantity, line_2.quantity) == (2, 1)
+
+        with Session(db.engine) as other:
+            other.get(ProductOrder, line_1.id).quantity = 5
+            other.delete(other.get(ProductOrder, line_2.id))
+            other.commit()
+
+        line_1.quantity = 3
+        db.session.delete(line_2)
+        with pytest.warns(SAWarning, match="0 were matched"):
+            db.session.commit()
+        assert (order.total, order.itemCount) == (30.0, 3)
+
+        maintained = _report_rows()
+        with db.engine.begin() as connection:
+            rebuild_reports(connection)
+        db.session.expire_all()
+        assert _report_rows() == maintained
+
+
+def test_migrate_order_totals(app):
+    """
+    Tests that migrating a database without totals prices the product
+    orders and computes the totals of the orders.
+    """
+    from onlinestore.models import migrate_db
+
+    with app.app_context():
+        order = _get_order(None)
+        _get_product_order(order, _get_product(1), 2)
+        _get_product_order(order, _get_product(2), 1)
+        db.session.add(order)
+        db.session.commit()
+        with db.engine.begin() as connection:
+            connection.exec_driver_sql('ALTER TABLE "product_order" DROP COLUMN "unitPrice"')
+            connection.exec_driver_sql('ALTER TABLE "order" DROP COLUMN "total"')
+            connection.exec_driver_sql('ALTER TABLE "order" DROP COLUMN "itemCount"')
+
+        created = migrate_db()
+        assert {"product_order.unitPrice", "order.total", "order.itemCount"} <= set(created)
+        db.session.expire_all()
+        assert (order.total, order.itemCount) == (40.0, 3)
+        assert [line.unitPrice for line in order.productOrders] == [10.0, 20.0]
+
+
+def _report_rows():
+    ''' Helper function to read the summary tables of the reports '''
+    from onlinestore.models import REPORTS
+
+    return {
+        model.__tablename__: sorted(row.serialize().items() for row in model.query.all())
+        for model in REPORTS
+    }
+
+
+def test_reports(app):
+    """
+    Tests that the summary tables of the reports maintained from the changes
+    of product orders and orders equal the tables rebuilt from scratch, and
+    that migrating a database with orders builds them.
+    """
+    from onlinestore.models import CustomerSales, ProductSales, migrate_db, rebuild_reports
+
+    with app.app_context():
+        customer_1 = _get_customer(1)
+        customer_2 = _get_customer(2)
+        db.session.add_all([customer_1, customer_2])
+        db.session.commit()
+        product_1 = _get_product(1)
+        product_2 = _get_product(2)
+        order_1 = _get_order(customer_1.uuid)
+        order_2 = _get_order(customer_1.uuid)
+        _get_product_order(order_1, product_1, 2)
+        _get_product_order(order_1, product_2, 1)
+        line = _get_product_order(order_2, product_2, 3)
+        db.session.add_all([order_1, order_2])
+        db.session.commit()
+        assert db.session.get(ProductSales, product_2.id).serialize()["quantity"] == 4
+        assert db.session.get(CustomerSales, customer_1.uuid).revenue == 100.0
+
+        # Changing lines and moving an order to another customer
+        line.quantity = 1
+        line.productId = product_1.id
+        order_1.customerId = customer_2.uuid
+        db.session.add(ProductOrder(orderId=order_1.id, productId=product_1.id, quantity=1))
+        db.session.commit()
+        assert db.session.get(CustomerSales, customer_1.uuid).revenue == 10.0
+        assert db.session.get(CustomerSales, customer_2.uuid).revenue == 50.0
+
+        # Deleting a line, an order and a customer
+        db.session.delete(order_1.productOrders[0])
+        db.session.commit()
+        db.session.delete(order_2)
+        db.session.delete(customer_2)
+        db.session.commit()
+
+        maintained = _report_rows()
+        with db.engine.begin() as connection:
+            rebuild_reports(connection)
+        db.session.expire_all()
+        assert _report_rows() == maintained
+
+        # Databases of older versions have orders but no reports
+        with db.engine.begin() as connection:
+            for table in ("product_sales", "daily_sales", "customer_sales"):
+                connection.exec_driver_sql(f'DROP TABLE "{table}"')
+        assert "reports" in migrate_db()
+        assert _report_rows() == maintained
+        assert migrate_db() == []
+
+
+def test_sqlite_profile():
+    """
+    Tests that the production profile sets the pragmas on every connection
+    and pools the connections of a database file.
+    """
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": 'sqlite:///profile_test.db',
+        "TESTING": True,
+        "SQLITE_PROFILE": "production",
+        "SQLITE_BUSY_TIMEOUT": 2000,
+    })
+    with app.app_context():
+        try:
+            with db.engine.connect() as connection:
+                pragma = lambda name: connection.exec_driver_sql(f"PRAGMA {name}").scalar()
+                assert pragma("journal_mode") == "wal"
+                assert pragma("synchronous") == 1  # NORMAL
+                assert pragma("foreign_keys") == 1
+                assert pragma("busy_timeout") == 2000
+                assert pragma("cache_size") == -16 * 1024
+            assert db.engine.pool.size() == 8
+        finally:
+            db.engine.dispose()
+            os.remove(db.engine.url.database)
+
+    with pytest.raises(ValueError):
+        create_app({"SQLALCHEMY_DATABASE_URI": "sqlite://", "SQLITE_PROFILE": "fast"})
+
+
+def test_passive_deletes(app):
+    """
+    Tests that the database deletes and nulls the children of deleted rows
+    without loading them, and that the totals, reports and revisions still
+    follow.
+    """
+    from onlinestore.models import CustomerSales, ProductSales, Revision, rebuild_reports
+
+    with app.app_context():
+        customer = _get_customer()
+        db.session.add(customer)
+        db.session.commit()
+        products = [_get_product(i) for i in range(1, 4)]
+        order = _get_order(customer.uuid)
+        for i in range(300):
+            _get_product_order(order, products[i % 3], 1)
+        other = _get_order(customer.uuid)
+        _get_product_order(other, products[0], 2)
+        db.session.add_all([order, other, _get_stock(products[1], 5)])
+        db.session.commit()
+        assert db.session.get(CustomerSales, customer.uuid).quantity == 302
+        versions = dict(db.session.query(Revision.name, Revision.version))
+
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        db.session.expire_all()
+        event.listen(db.engine, "before_cursor_execute", capture)
+        try:
+            db.session.delete(db.session.get(Order, order.id))
+            db.session.commit()
+        finally:
+            event.remove(db.engine, "before_cursor_execute", capture)
+        # One DELETE for the order, the lines are only summed
+        assert len([s for s in statements if s.startswith('DELETE FROM "order"')]) == 1
+        assert not [s for s in statements if "FROM product_order" in s and "sum(" not in s]
+        assert ProductOrder.query.count() == 1
+        assert db.session.get(CustomerSales, customer.uuid).quantity == 2
+        versions_after = dict(db.session.query(Revision.name, Revision.version))
+        assert versions_after["product_order"] > versions["product_order"]
+
+        # The stock is deleted and the lines lose their product
+        db.session.delete(products[1])
+        db.session.delete(products[0])
+        db.session.commit()
+        assert Stock.query.count() == 0
+        assert [line.productId for line in ProductOrder.query] == [None]
+        assert ProductSales.query.count() == 0
+
+        # The orders lose their customer
+        db.session.delete(customer)
+        db.session.commit()
+        assert db.session.get(Order, other.id).customerId is None
+        assert CustomerSales.query.count() == 0
+
+        maintained = _report_rows()
+        with db.engine.begin() as connection:
+            rebuild_reports(connection)
+        db.session.expire_all()
+        assert _report_rows() == maintained
+
+
+def test_update_without_returning(app, monkeypatch):
+    """
+    Tests the stock adjustments, totals and reports of backends without
+    UPDATE ... RETURNING, which lock the stock row with SELECT ... FOR UPDATE
+    and read the updated rows back.
+    """
+    from onlinestore.models import ProductSales
+
+    with app.app_context():
+        product = _get_product(1)
+        order = _get_order(None)
+        db.session.add_all([_get_stock(product, 5), order])
+        db.session.commit()
+        monkeypatch.setattr(db.engine.dialect, "update_returning", False)
+
+        assert Stock.adjust(product.id, -3) == 2
+        assert Stock.adjust(product.id, -3) is None
+        assert Stock.adjust(999, 1) is None
+        assert Stock.adjust(product.id, 2 ** 31 - 2) is None
+        db.session.add(ProductOrder(orderId=order.id, productId=product.id, quantity=2))
+        db.session.commit()
+        db.session.add(ProductOrder(orderId=order.id, productId=product.id, quantity=1))
+        db.session.commit()
+        assert db.session.get(Stock, product.id).quantity == 2
+        assert (order.total, order.itemCount) == (30.0, 3)
+        assert db.session.get(ProductSales, product.id).revenue == 30.0
+
+
+def test_engine_options():
+    """
+    Tests that a client/server database URL gets a pool checked before use
+    and the configured isolation level, and that SQLite keeps its own options.
+    """
+    from flask import Flask
+    from onlinestore import engine
+
+    app = Flask(__name__)
+    app.config.update(
+        DATABASE_URL="postgres://store@localhost/onlinestore",
+        DATABASE_ISOLATION_LEVEL="REPEATABLE READ",
+        SQLALCHEMY_ENGINE_OPTIONS={"pool_size": 4},
+    )
+    engine.configure(app)
+    assert app.config["SQLALCHEMY_DATABASE_URI"] == "postgresql://store@localhost/onlinestore"
+    options = app.config["SQLALCHEMY_ENGINE_OPTIONS"]
+    assert options["pool_pre_ping"] is True
+    assert options["isolation_level"] == "REPEATABLE READ"
+    assert options["pool_size"] == 4
+
+    app = Flask(__name__)
+    app.config.update(SQLALCHEMY_DATABASE_URI="sqlite://")
+    engine.configure(app)
+    assert app.config["SQLALCHEMY_ENGINE_OPTIONS"] == {}
+
+
+def test_generate_data(app, monkeypatch):
+    """
+    Tests that the generated orders are consistent with their product orders
+    and the reports, that the same seed generates the same rows and that the
+    indexes dropped for the first orders are built again.
+    """
+    from sqlalchemy import create_engine, func, inspect, select
+    from onlinestore import datagen
+    from onlinestore.models import rebuild_reports
+
+    end = datetime(2024, 6, 1)
+    monkeypatch.setattr(datagen, "TRANSACTION_SIZE", 20)
+    with app.app_context():
+        lines = datagen.generate(db.engine, 10, 5, 50, seed=3, end=end)
+        assert (Customer.query.count(), Product.query.count(), Stock.query.count()) == (10, 5, 5)
+        assert Order.query.count() == 50
+        assert ProductOrder.query.count() == lines
+        assert {index.name for index in ProductOrder.__table__.indexes} <= {
+            index["name"] for index in inspect(db.engine).get_indexes("product_order")
+        }
+        for order in Order.query:
+            assert order.createdAt < end
+            assert order.itemCount == sum(line.quantity for line in order.productOrders)
+            assert order.total == round(
+                sum(line.quantity * line.unitPrice for line in order.productOrders), 2
+            )
+
+        generated = _report_rows()
+        with db.engine.begin() as connection:
+            rebuild_reports(connection)
+        assert _report_rows() == generated
+
+        # The same seed, the same rows
+        engine = create_engine("sqlite://")
+        db.metadata.create_all(engine)
+        datagen.generate(engine, 10, 5, 50, seed=3, end=end)
+        query = select(ProductOrder.__table__).order_by(ProductOrder.id)
+        with engine.connect() as connection:
+            assert connection.execute(query).all() == db.session.execute(query).all()
+
+        # More data is added after the existing rows
+        result = app.test_cli_runner().invoke(args=[
+            "generate-data", "--customers", "2", "--products", "2", "--orders", "5"
+        ])
+        assert result.exit_code == 0
+        assert Order.query.count() == 55
+        assert db.session.scalar(select(func.count()).select_from(Stock)) == 7
+        added = _report_rows()
+        with db.engine.begin() as connection:
+            rebuild_reports(connection)
+        assert _report_rows() == added
@@ -1,6 +1,6 @@
 """ Tests for the REST API resources. """
 import json
-# import os
+import os
 # import uuid
 # from flask_sqlalchemy import SQLAlchemy
 from jsonschema import validate
@@ -10,7 +10,6 @@ import pytest
 import createdatabase
 # from datetime import datetime
 # from flask.testing import FlaskClient
-from sqlalchemy.engine import Engine
 from sqlalchemy import event
 # from sqlalchemy.exc import IntegrityError, StatementError
 from werkzeug.datastructures import Headers
@@ -18,23 +17,23 @@ from onlinestore import create_app, db
 from onlinestore.models import Customer  # , Product, Order, ProductOrder, Stock
 
 
-@event.listens_for(Engine, "connect")
-def set_sqlite_pragma(dbapi_connection, connection_record):
-    ''' Enable foreign key support for SQLite '''
-    cursor = dbapi_connection.cursor()
-    cursor.execute("PRAGMA foreign_keys=ON")
-    cursor.close()
+# The tests run against SQLite and the databases in TEST_DATABASE_URLS
+# (space separated, e.g. postgresql://localhost/onlinestore_test)
+DATABASE_URLS = ['sqlite:///temp.db'] + os.environ.get("TEST_DATABASE_URLS", "").split()
 
 
-# based on http://flask.pocoo.org/docs/1.0/testing/
-# The fixture is invoked once for each test function that uses it
-@pytest.fixture(scope="function")
-def client():
-    ''' Create a Flask test client for testing the API '''
+def _backend(url):
+    ''' Test ID of a database URL '''
+    return url.split(":")[0]
+
+
+def _create_client(**config):
+    ''' Create a Flask test client, extra app settings are given as keywords '''
     # Create a temporary database file for testing purposes
     test_config = {
         "SQLALCHEMY_DATABASE_URI": 'sqlite:///temp.db',
-        "TESTING": True
+        "TESTING": True,
+        **config
     }
     app = create_app(test_config)
 
@@ -50,6 +49,39 @@ def client():
         db.drop_all()  # drop all tables in the database
 
 
+# based on http://flask.pocoo.org/docs/1.0/testing/
+# The fixture is invoked once for each test function that uses it
+@pytest.fixture(scope="function", params=DATABASE_URLS, ids=_backend)
+def client(request):
+    ''' Create a Flask test client for testing the API '''
+    yield from _create_client(SQLALCHEMY_DATABASE_URI=request.param)
+
+
+@pytest.fixture(scope="function", params=DATABASE_URLS, ids=_backend)
+def cached_client(request):
+    ''' Create a Flask test client with the entity cache enabled '''
+    yield from _create_client(
+        SQLALCHEMY_DATABASE_URI=request.param, ENTITY_CACHE_SIZE=16, ENTITY_CACHE_TTL=60
+    )
+
+
+def _count_queries(client, method, url, **kwargs):
+    ''' Send a request and return the response and the number of SQL statements it ran '''
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with client.application.app_context():
+        engine = db.engine
+    event.listen(engine, "before_cursor_execute", count)
+    try:
+        resp = client.open(url, method=method, **kwargs)
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+    return resp, len(statements)
+
+
 # def _populate_db():
 #     ''' Populate the database with test data '''
 #     for i in range(1, 4):
@@ -263,6 +295,50 @@ class TestCustomerCollection(object):
         assert resp.status_code == 400  # Invalid request body
 
 
+    def test_post_batch(self, client):
+        ''' Test batch POST method for the CustomerCollection resource. '''
+        batch = [_get_customer_json(), _get_customer_json(), _get_customer_json()]
+        batch[1]["email"] = "another@luukku.com"
+        batch[2]["email"] = "a.heikkinen@luukku.com"  # Existing email
+        resp = client.post(self.RESOURCE_URL, json=batch)
+        assert resp.status_code == 207
+        items = resp.json["items"]
+        assert [item["status"] for item in items] == [201, 201, 409]
+        for item, customer in zip(items[:2], batch):
+            assert client.get(item["@controls"]["self"]["href"]).json["email"] == customer["email"]
+
+    def test_get_paginated(self, client):
+        ''' Test keyset pagination of the CustomerCollection resource. '''
+        resp = client.get(self.RESOURCE_URL + "?limit=2")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert len(body["customers"]) == 2
+        assert "prev" not in body["@controls"]
+        first_page = [item["uuid"] for item in body["customers"]]
+
+        # Follow the next control to the last page
+        resp = client.get(body["@controls"]["next"]["href"])
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert len(body["customers"]) == 1
+        assert body["customers"][0]["uuid"] not in first_page
+        assert "next" not in body["@controls"]
+
+        # And back again with the prev control, limit is kept
+        resp = client.get(body["@controls"]["prev"]["href"])
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert [item["uuid"] for item in body["customers"]] == first_page
+
+        # Invalid limit and cursor
+        resp = client.get(self.RESOURCE_URL + "?limit=0")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?limit=x")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?after=notacursor")
+        assert resp.status_code == 400
+
+
 class TestCustomerItem(object):
     """
     Tests for the CustomerItem resource.
@@ -295,6 +371,37 @@ class TestCustomerItem(object):
         resp = client.get(self.INVALID_URL)
         assert resp.status_code == 404
 
+    def test_get_orders(self, client):
+        ''' Test the orders of a customer with one query per page. '''
+        customers = client.get(self.ALL_CUSTOMERS_URL).json["customers"]
+        uuid = customers[0]["uuid"]
+        for _ in range(2):
+            resp = client.post("/api/orders/", json={"customerId": uuid})
+            assert resp.status_code == 201
+        client.post("/api/orders/", json={"customerId": customers[1]["uuid"]})
+
+        body = client.get(customers[0]["@controls"]["self"]["href"]).json
+        _check_control_get_method("customer:customer-orders", client, body)
+        url = body["@controls"]["customer:customer-orders"]["href"]
+        assert url == f"/api/customers/{uuid}/orders/"
+
+        resp, queries = _count_queries(client, "GET", url + "?limit=2")
+        assert resp.status_code == 200
+        body = resp.json
+        _check_namespace(client, body)
+        _check_control_get_method("up", client, body)
+        assert [order["customerId"] for order in body["orders"]] == [uuid, uuid]
+        # Revisions, customer lookup and the page
+        assert queries <= 3
+
+        # The next page keeps the customer
+        body = client.get(body["@controls"]["next"]["href"]).json
+        assert [order["customerId"] for order in body["orders"]] == [uuid]
+        body = client.get(url + "?sort=-id&fields=id").json
+        assert [order["id"] for order in body["orders"]] == [3, 2, 1]
+        assert client.get(url + "?color=red").status_code == 400
+        assert client.get("/api/customers/non-customer-x/orders/").status_code == 404
+
     def test_put(self, client):
         ''' Test PUT method for the CustomerItem resource. '''
         valid_json = _get_customer_json()
@@ -369,6 +476,39 @@ class TestProductCollection(object):
             _check_control_get_method("self", client, item)
             _check_control_get_method("profile", client, item)
 
+    def test_query(self, client):
+        ''' Test filtering, sorting and sparse fieldsets of the ProductCollection resource. '''
+        resp = client.get(self.RESOURCE_URL + "?name=Kumpparit")
+        assert resp.status_code == 200
+        assert [item["name"] for item in resp.json["products"]] == ["Kumpparit"]
+
+        resp = client.get(self.RESOURCE_URL + "?price[gte]=15&price[lt]=30")
+        assert [item["name"] for item in resp.json["products"]] == ["Sateenvarjo"]
+
+        # Descending pages follow the sort order in both directions
+        url = self.RESOURCE_URL + "?sort=-name&limit=1"
+        names = []
+        while url:
+            body = client.get(url).json
+            names += [item["name"] for item in body["products"]]
+            url = body["@controls"].get("next", {}).get("href")
+        assert names == ["Sateenvarjo", "Kumpparit"]
+        body = client.get(body["@controls"]["prev"]["href"]).json
+        assert [item["name"] for item in body["products"]] == ["Sateenvarjo"]
+
+        # Only the requested fields are selected and returned
+        resp = client.get(self.RESOURCE_URL + "?fields=name&sort=name")
+        items = resp.json["products"]
+        assert [item["name"] for item in items] == ["Kumpparit", "Sateenvarjo"]
+        assert set(items[0]) == {"name", "@controls"}
+        _check_control_get_method("self", client, items[0])
+        resp = client.get(self.RESOURCE_URL + "?fields=name&stream=1")
+        assert [set(item) for item in resp.json["products"]] == [{"name", "@controls"}] * 2
+
+        for query in ("desc=x", "price[ne]=10", "price=cheap", "sort=price", "fields=id"):
+            resp = client.get(self.RESOURCE_URL + "?" + query)
+            assert resp.status_code == 400
+
     def test_post(self, client):
         ''' Test POST method for the ProductCollection resource. '''
         valid_json = _get_product_json(2)
@@ -396,6 +536,88 @@ class TestProductCollection(object):
         resp = client.post(self.RESOURCE_URL, json=valid_json)
         assert resp.status_code == 400  # Invalid request body
 
+    def test_post_batch(self, client):
+        ''' Test batch POST method for the ProductCollection resource. '''
+        batch = [_get_product_json(i) for i in range(2, 5)]
+        resp = client.post(self.RESOURCE_URL, json=batch)
+        assert resp.status_code == 201
+        items = resp.json["items"]
+        assert [item["status"] for item in items] == [201, 201, 201]
+        for item, product in zip(items, batch):
+            assert client.get(item["@controls"]["self"]["href"]).json["name"] == product["name"]
+
+        # Existing name, name repeated in the batch and an invalid product
+        invalid = _get_product_json(6)
+        invalid.pop("price")
+        batch = [_get_product_json(2), _get_product_json(5), _get_product_json(5), invalid]
+        resp = client.post(self.RESOURCE_URL, json=batch)
+        assert resp.status_code == 207
+        assert [item["status"] for item in resp.json["items"]] == [409, 201, 409, 400]
+        assert "@error" in resp.json["items"][0]
+        assert len(client.get(self.RESOURCE_URL).json["products"]) == 6
+
+        resp = client.post(self.RESOURCE_URL, json=[])
+        assert resp.status_code == 400
+
+
+class TestProductSearch(object):
+    """
+    Tests for the ProductSearch resource.
+    """
+
+    RESOURCE_URL = "/api/products/search/"
+
+    def _names(self, client, query):
+        resp = client.get(self.RESOURCE_URL + "?" + query)
+        assert resp.status_code == 200
+        return [item["name"] for item in resp.json["products"]]
+
+    def test_get(self, client):
+        ''' Test ranked prefix search and paging through the results. '''
+        assert self._names(client, "q=sate") == ["Sateenvarjo"]
+        assert self._names(client, "q=saappaat") == ["Kumpparit"]
+        assert self._names(client, "q=varpaasi kuiv") == ["Kumpparit"]
+        assert self._names(client, "q=sateenvarjo saappaat") == []
+
+        # Matches in the name rank above matches in the description
+        product = {"name": "Kumisaappaat", "desc": "Vihreät", "price": 30.0}
+        assert client.post("/api/products/", json=product).status_code == 201
+        assert self._names(client, "q=kumi") == ["Kumisaappaat", "Kumpparit"]
+
+        body = client.get(self.RESOURCE_URL + "?q=kumi&limit=1").json
+        assert [item["name"] for item in body["products"]] == ["Kumisaappaat"]
+        _check_control_get_method("self", client, body["products"][0])
+        body = client.get(body["@controls"]["next"]["href"]).json
+        assert [item["name"] for item in body["products"]] == ["Kumpparit"]
+        assert "next" not in body["@controls"]
+
+        for query in ("", "q=", "q=*%22"):
+            assert client.get(self.RESOURCE_URL + "?" + query).status_code == 400
+
+    def test_sync(self, client):
+        ''' Test that the index follows inserts, updates and deletes of products. '''
+        batch = [_get_product_json(i) for i in range(2, 4)]
+        assert client.post("/api/products/", json=batch).status_code == 201
+        assert self._names(client, "q=sateenvarjo2") == ["Sateenvarjo2"]
+
+        product = _get_product_json()
+        product["name"] = "Sadetakki"
+        product["desc"] = "Pitää kuivana"
+        assert client.put("/api/products/1/", json=product).status_code == 204
+        assert self._names(client, "q=sadet") == ["Sadetakki"]
+        assert self._names(client, "q=sateenvarjo") == ["Sateenvarjo2", "Sateenvarjo3"]
+
+        assert client.delete("/api/products/1/").status_code == 204
+        assert self._names(client, "q=sadet") == []
+
+    def test_fallback(self, client):
+        ''' Test the LIKE search used without the full-text index. '''
+        client.application.extensions["product_search"] = False
+        assert self._names(client, "q=sate") == ["Sateenvarjo"]
+        assert self._names(client, "q=KUMI saa") == ["Kumpparit"]
+        # LIKE wildcards are searched literally
+        assert self._names(client, "q=S_teen") == []
+
 
 class TestProductItem(object):
 
@@ -422,6 +644,25 @@ class TestProductItem(object):
         resp = client.get(self.INVALID_URL)
         assert resp.status_code == 404
 
+    def test_get_productorders(self, client):
+        ''' Test the product orders of a product. '''
+        body = client.get("/api/products/2/").json
+        _check_control_get_method("product:get-productorder", client, body)
+        url = body["@controls"]["product:get-productorder"]["href"]
+        assert url == "/api/products/2/productorders/"
+
+        line = {"orderId": 1, "productId": 2, "quantity": 3}
+        assert client.post("/api/productorders/", json=line).status_code == 201
+        body = client.get(url).json
+        _check_control_get_method("up", client, body)
+        assert [(po["productId"], po["quantity"]) for po in body["productorders"]] == [
+            (2, 1), (2, 3)
+        ]
+        body = client.get(url + "?quantity[gt]=1&limit=1").json
+        assert [po["quantity"] for po in body["productorders"]] == [3]
+        assert "next" not in body["@controls"]
+        assert client.get("/api/products/999/productorders/").status_code == 404
+
     def test_put(self, client):
         valid_json = _get_product_json()
 
@@ -483,6 +724,109 @@ class TestOrderCollection(object):
             _check_control_get_method("self", client, item)
             _check_control_get_method("profile", client, item)
 
+    def test_get_streamed(self, client):
+        ''' Test streamed export of the OrderCollection resource. '''
+        valid_json = _get_order_json()
+        valid_json["customerId"] = client.get("/api/customers/").json["customers"][0]["uuid"]
+        for _ in range(2):
+            resp = client.post(self.RESOURCE_URL, json=valid_json)
+            assert resp.status_code == 201
+
+        # Batch size smaller than the collection to stream it in several chunks
+        client.application.config["STREAM_BATCH_SIZE"] = 2
+        paged = json.loads(client.get(self.RESOURCE_URL).data)
+
+        resp = client.get(self.RESOURCE_URL + "?stream=1")
+        assert resp.status_code == 200
+        assert resp.is_streamed
+        body = json.loads(resp.data)
+        assert body["orders"] == paged["orders"]
+        assert body["@controls"] == paged["@controls"]
+
+        resp = client.get(self.RESOURCE_URL, headers={"Accept": "application/x-ndjson"})
+        assert resp.status_code == 200
+        assert resp.mimetype == "application/x-ndjson"
+        lines = resp.data.decode().splitlines()
+        assert [json.loads(line) for line in lines] == paged["orders"]
+
+    def test_time_range(self, client):
+        ''' Test filtering orders by creation time and paging through the range. '''
+        from datetime import datetime
+        from onlinestore.models import Order
+
+        uuid = client.get("/api/customers/").json["customers"][0]["uuid"]
+        place = {"customerId": uuid, "productOrders": [{"productId": 2, "quantity": 1}]}
+        for _ in range(3):
+            assert client.post("/api/orders/place/", json=place).status_code == 201
+        with client.application.app_context():
+            for order in Order.query.all():
+                order.createdAt = datetime(2024, 1, 1, order.id - 1)
+            db.session.commit()
+
+        resp = client.get(self.RESOURCE_URL + "?from=2024-01-01T01:00:00Z&to=2024-01-01T03:00:00Z")
+        assert resp.status_code == 200
+        orders = resp.json["orders"]
+        assert [order["id"] for order in orders] == [2, 3]
+        assert orders[0]["createdAt"] == "2024-01-01T01:00:00+00:00"
+
+        # Offsets are converted to UTC, pages follow the creation times
+        url = self.RESOURCE_URL + "?from=2024-01-01T03:30:00%2B02:00&limit=1"
+        ids = []
+        while url:
+            body = client.get(url).json
+            ids += [order["id"] for order in body["orders"]]
+            url = body["@controls"].get("next", {}).get("href")
+        assert ids == [3, 4]
+        body = client.get(body["@controls"]["prev"]["href"]).json
+        assert [order["id"] for order in body["orders"]] == [3]
+
+        resp = client.get(self.RESOURCE_URL + "?from=yesterday")
+        assert resp.status_code == 400
+
+        # An explicit sort order replaces the creation time
+        resp = client.get(self.RESOURCE_URL + "?from=2024-01-01T01:00:00Z&sort=-id&fields=id")
+        orders = resp.json["orders"]
+        assert [order["id"] for order in orders] == [4, 3, 2]
+        assert set(orders[0]) == {"id", "@controls"}
+        resp = client.get(self.RESOURCE_URL + "?createdAt[lt]=2024-01-01T01:00:00Z")
+        assert [order["id"] for order in resp.json["orders"]] == [1]
+
+        # Selected fields are paged by the creation time too
+        url = self.RESOURCE_URL + (
+            "?from=2024-01-01T01:00:00Z&to=2024-01-01T03:00:00Z&fields=total&limit=1"
+        )
+        resp = client.get(url)
+        assert resp.status_code == 200
+        assert [set(order) for order in resp.json["orders"]] == [{"total", "@controls"}]
+        resp = client.get(resp.json["@controls"]["next"]["href"])
+        assert resp.status_code == 200
+        assert len(resp.json["orders"]) == 1
+
+    def test_embed(self, client):
+        ''' Test the embedded order collection and its number of queries. '''
+        uuid = client.get("/api/customers/").json["customers"][0]["uuid"]
+        place = {"customerId": uuid, "productOrders": [{"productId": 2, "quantity": 1}] * 3}
+        for _ in range(3):
+            assert client.post("/api/orders/place/", json=place).status_code == 201
+
+        url = self.RESOURCE_URL + "?embed=productorders,products,customer"
+        resp, queries = _count_queries(client, "GET", url)
+        assert resp.status_code == 200
+        # Revisions, orders with customers and product orders with products
+        assert queries <= 3
+        orders = resp.json["orders"]
+        assert len(orders) == 4
+        assert [len(order["productorders"]) for order in orders] == [2, 3, 3, 3]
+        assert orders[1]["productorders"][0]["product"]["name"] == "Kumpparit"
+        assert orders[1]["customer"]["uuid"] == uuid
+        assert "product" not in client.get(
+            self.RESOURCE_URL + "?embed=productorders").json["orders"][0]["productorders"][0]
+
+        resp = client.get(url + "&stream=1")
+        assert resp.json["orders"] == orders
+        resp = client.get(self.RESOURCE_URL + "?embed=invoices")
+        assert resp.status_code == 400
+
     def test_post(self, client):
         ''' Test POST method for the OrderCollection resource. '''
         valid_json = _get_order_json()
@@ -512,8 +856,15 @@ class TestOrderCollection(object):
         assert resp.status_code == 404  # Not found
         valid_json["customerId"] = temp  # Reset customerId
 
-        # remove required "createdAt" field and try to post again, error 400 expected
-        valid_json.pop("createdAt")
+        # createdAt is assigned by the server, the value in the request is ignored
+        resp = client.post(self.RESOURCE_URL, json=valid_json)
+        assert resp.status_code == 201
+        body = client.get(resp.headers["Location"]).json
+        assert body["createdAt"] != valid_json["createdAt"]
+        assert body["createdAt"].endswith("+00:00")
+
+        # remove required "customerId" field and try to post again, error 400 expected
+        valid_json.pop("customerId")
         resp = client.post(self.RESOURCE_URL, json=valid_json)
         assert resp.status_code == 400  # Invalid request body
 
@@ -563,8 +914,12 @@ class TestOrderItem(object):
         resp = client.put(self.INVALID_URL, json=valid_json)
         assert resp.status_code == 404  # Not found
 
-        # remove "createdAt" field for 400
-        valid_json.pop("createdAt")
+        # Test with a customer that doesn't exist
+        resp = client.put(ORDER_URL, json=valid_json)
+        assert resp.status_code == 404
+
+        # remove "customerId" field for 400
+        valid_json.pop("customerId")
         resp = client.put(ORDER_URL, json=valid_json)
         assert resp.status_code == 400
 
@@ -583,6 +938,164 @@ class TestOrderItem(object):
         resp = client.delete(self.INVALID_URL)
         assert resp.status_code == 404
 
+    def test_embed(self, client):
+        ''' Test that the embedded order is loaded with the same number of queries for any number of lines. '''
+        ORDER_URL = client.get(self.ALL_ORDERS_URL).json["orders"][0]["@controls"]["self"]["href"]
+        url = ORDER_URL + "?embed=products,customer"
+        resp, queries = _count_queries(client, "GET", url)
+        assert resp.status_code == 200
+        assert queries <= 3
+        body = resp.json
+        assert len(body["productorders"]) == 2
+        product = body["productorders"][0]["product"]
+        assert product["name"] == "Sateenvarjo"
+        assert product["@controls"]["self"]["href"] == "/api/products/1/"
+        assert body["customer"]["uuid"] == body["customerId"]
+        _check_control_get_method("self", client, body["customer"])
+
+        lines = [{"orderId": body["id"], "productId": 2, "quantity": 1} for _ in range(5)]
+        assert client.post("/api/productorders/", json=lines).status_code == 201
+        resp, queries = _count_queries(client, "GET", url)
+        assert len(resp.json["productorders"]) == 7
+        assert queries <= 3
+
+        # Changing an embedded product changes the ETag
+        etag = resp.headers["ETag"]
+        product = _get_product_json(1)
+        product["name"] = "Sadetakki"
+        product["desc"] = "Pitää kuivana"
+        assert client.put("/api/products/1/", json=product).status_code == 204
+        resp = client.get(url, headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        assert resp.json["productorders"][0]["product"]["name"] == "Sadetakki"
+
+        resp = client.get(ORDER_URL + "?embed=invoices")
+        assert resp.status_code == 400
+
+
+class TestOrderPlacement(object):
+    """
+    Tests for the OrderPlacement resource.
+    """
+
+    RESOURCE_URL = "/api/orders/place/"
+
+    def _get_json(self, client):
+        ''' Valid order placement for the first customer '''
+        return {
+            "customerId": client.get("/api/customers/").json["customers"][0]["uuid"],
+            "productOrders": [
+                {"productId": 1, "quantity": 2},
+                {"productId": 2, "quantity": 5},
+                {"productId": 1, "quantity": 1}
+            ]
+        }
+
+    def test_post(self, client):
+        ''' Test placing an order with its product orders. '''
+        valid_json = self._get_json(client)
+
+        # test with wrong content type
+        resp = client.post(self.RESOURCE_URL, data="notjson")
+        assert resp.status_code in (400, 415)
+
+        # the control is found from the order collection
+        body = client.get("/api/orders/").json
+        _check_control_post_method("order:place-order", client, body, valid_json)
+
+        resp = client.post(self.RESOURCE_URL, json=valid_json)
+        assert resp.status_code == 201
+        body = client.get(resp.headers["Location"]).json
+        assert body["customerId"] == valid_json["customerId"]
+        assert [(po["productId"], po["quantity"]) for po in body["productorders"]] == [
+            (1, 2), (2, 5), (1, 1)
+        ]
+        assert [po["unitPrice"] for po in body["productorders"]] == [20.0, 10.0, 20.0]
+        assert (body["total"], body["itemCount"]) == (110.0, 8)
+
+        # Stock was 8 and 20, two orders placed
+        assert client.get("/api/stock/1/").json["quantity"] == 2
+        assert client.get("/api/stock/2/").json["quantity"] == 10
+
+    def test_totals(self, client):
+        ''' Test that order totals follow the product orders but not later price changes. '''
+        resp = client.post(self.RESOURCE_URL, json=self._get_json(client))
+        order_url = resp.headers["Location"]
+        order_id = int(order_url.rstrip("/").split("/")[-1])
+
+        def totals():
+            body = client.get(order_url).json
+            return body["total"], body["itemCount"]
+
+        product = client.get("/api/products/1/").json
+        product = {"name": product["name"], "desc": product["desc"], "price": 99.0}
+        assert client.put("/api/products/1/", json=product).status_code == 204
+        assert totals() == (110.0, 8)
+
+        # New lines are priced when they are added
+        line = {"orderId": order_id, "productId": 1, "quantity": 1}
+        resp = client.post("/api/productorders/", json=line)
+        assert client.get(resp.headers["Location"]).json["unitPrice"] == 99.0
+        assert totals() == (209.0, 9)
+        batch = [{"orderId": order_id, "productId": 2, "quantity": 2}] * 2
+        assert client.post("/api/productorders/", json=batch).status_code == 201
+        assert totals() == (249.0, 13)
+
+        # Editing and deleting lines
+        line_url = resp.headers["Location"]
+        line["quantity"] = 3
+        assert client.put(line_url, json=line).status_code == 204
+        assert totals() == (447.0, 15)
+        line["productId"] = 2
+        assert client.put(line_url, json=line).status_code == 204
+        assert totals() == (180.0, 15)
+        assert client.delete(line_url).status_code == 204
+        assert totals() == (150.0, 12)
+
+        orders = client.get("/api/orders/?fields=id,total").json["orders"]
+        assert orders[-1] == {"id": order_id, "total": 150.0, "@controls": orders[-1]["@controls"]}
+
+    def test_post_insufficient_stock(self, client):
+        ''' Test that an order is not placed at all if any product runs out. '''
+        valid_json = self._get_json(client)
+        valid_json["productOrders"][1]["quantity"] = 21
+        orders = len(client.get("/api/orders/").json["orders"])
+
+        resp = client.post(self.RESOURCE_URL, json=valid_json)
+        assert resp.status_code == 409
+        assert len(client.get("/api/orders/").json["orders"]) == orders
+        assert client.get("/api/stock/1/").json["quantity"] == 8
+        assert client.get("/api/stock/2/").json["quantity"] == 20
+
+    def test_post_invalid(self, client):
+        ''' Test placing an order with invalid references and documents. '''
+        valid_json = self._get_json(client)
+
+        valid_json["productOrders"][0]["productId"] = 999
+        resp = client.post(self.RESOURCE_URL, json=valid_json)
+        assert resp.status_code == 404  # Product not found
+        valid_json["productOrders"][0]["productId"] = 1
+
+        temp = valid_json["customerId"]
+        valid_json["customerId"] = "-5"
+        resp = client.post(self.RESOURCE_URL, json=valid_json)
+        assert resp.status_code == 404  # Customer not found
+        valid_json["customerId"] = temp
+
+        # Quantities stay in the range of the integer columns
+        valid_json["productOrders"][0]["quantity"] = 10 ** 30
+        resp = client.post(self.RESOURCE_URL, json=valid_json)
+        assert resp.status_code == 400
+        valid_json["productOrders"][0]["quantity"] = 2 ** 31 - 1
+        valid_json["productOrders"][2]["quantity"] = 2 ** 31 - 1
+        resp = client.post(self.RESOURCE_URL, json=valid_json)
+        assert resp.status_code == 409  # More than the stock of product 1
+        assert client.get("/api/stock/1/").json["quantity"] == 8
+
+        valid_json["productOrders"] = []
+        resp = client.post(self.RESOURCE_URL, json=valid_json)
+        assert resp.status_code == 400  # At least one product order is required
+
 
 class TestProductOrderCollection(object):
     """
@@ -639,6 +1152,23 @@ class TestProductOrderCollection(object):
         assert resp.status_code == 400  # Invalid request body
 
 
+    def test_post_batch(self, client):
+        ''' Test batch POST method for the ProductOrderCollection resource. '''
+        batch = [
+            {"orderId": 1, "productId": 1, "quantity": 1},
+            {"orderId": -5, "productId": 1, "quantity": 1},
+            {"orderId": 1, "productId": -5, "quantity": 1},
+            {"orderId": 1, "productId": 2, "quantity": 4}
+        ]
+        resp = client.post(self.RESOURCE_URL, json=batch)
+        assert resp.status_code == 207
+        items = resp.json["items"]
+        assert [item["status"] for item in items] == [201, 404, 404, 201]
+        body = client.get(items[3]["@controls"]["self"]["href"]).json
+        assert (body["productId"], body["quantity"]) == (2, 4)
+        assert len(client.get(self.RESOURCE_URL).json["productorders"]) == 4
+
+
 class TestProductOrderItem(object):
 
     ALL_PRODUCTORDERS_URL = "/api/productorders/"
@@ -658,6 +1188,8 @@ class TestProductOrderItem(object):
         _check_control_get_method("self", client, body)
         _check_control_get_method("profile", client, body)
         _check_control_get_method("collection", client, body)
+        _check_control_get_method("productorder:get-order", client, body)
+        _check_control_get_method("productorder:get-product", client, body)
         valid_json = _get_productorder_json()
         _check_control_put_method("edit", client, body, valid_json)
         _check_control_delete_method("delete", client, body)
@@ -683,6 +1215,11 @@ class TestProductOrderItem(object):
         resp = client.put(self.INVALID_URL, json=valid_json)
         assert resp.status_code == 404  # Not found
 
+        # Test with an order and a product that don't exist
+        for field in ("orderId", "productId"):
+            resp = client.put(PRODUCTORDER_URL, json=dict(valid_json, **{field: 9999}))
+            assert resp.status_code == 404
+
         # remove "quantity" field for 400
         valid_json.pop("quantity")
         resp = client.put(PRODUCTORDER_URL, json=valid_json)
@@ -724,6 +1261,21 @@ class TestStockCollection(object):
             _check_control_get_method("self", client, item)
             _check_control_get_method("profile", client, item)
 
+    def test_get_paginated(self, client):
+        ''' Test keyset pagination of the StockCollection resource. '''
+        resp = client.get(self.RESOURCE_URL + "?limit=1")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert len(body["items"]) == 1
+        first_id = body["items"][0]["productId"]
+
+        resp = client.get(body["@controls"]["next"]["href"])
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert len(body["items"]) == 1
+        assert body["items"][0]["productId"] > first_id
+        assert "next" not in body["@controls"]
+
     def test_post(self, client):
         ''' Test POST method for the StockCollection resource. '''
 
@@ -758,6 +1310,22 @@ class TestStockCollection(object):
         resp = client.post(self.RESOURCE_URL, json=valid_json)
         assert resp.status_code == 400  # Invalid request body
 
+    def test_post_batch(self, client):
+        ''' Test batch POST method for the StockCollection resource. '''
+        product = client.post("/api/products/", json=_get_product_json(2))
+        product_id = int(product.headers["Location"].split("/")[-2])
+        batch = [
+            {"productId": product_id, "quantity": 3},
+            {"productId": 1, "quantity": 3},  # Stock exists already
+            {"productId": 999, "quantity": 3},  # No such product
+            {"productId": product_id, "quantity": -1}  # Invalid quantity
+        ]
+        resp = client.post(self.RESOURCE_URL, json=batch)
+        assert resp.status_code == 207
+        items = resp.json["items"]
+        assert [item["status"] for item in items] == [201, 409, 404, 400]
+        assert client.get(items[0]["@controls"]["self"]["href"]).json["quantity"] == 3
+
     def _delete(self, client):
         ''' Helper function to delete stock entry '''
         resp = client.get(self.RESOURCE_URL)
@@ -791,6 +1359,7 @@ class TestStockItem(object):
         _check_control_get_method("self", client, body)
         _check_control_get_method("profile", client, body)
         _check_control_get_method("collection", client, body)
+        _check_control_get_method("stock:get-product", client, body)
 
         # Insert productId of the body to the valid_json because it needs to be the same
         valid_json = _get_stock_json()
@@ -839,6 +1408,57 @@ class TestStockItem(object):
         resp = client.put(STOCK_URL, json=valid_json)
         assert resp.status_code == 400
 
+    def test_patch(self, client):
+        ''' Test PATCH method for the StockItem resource. '''
+        resp = client.get(self.ALL_STOCK_URL)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+
+        # Get url of first stock item from the list
+        STOCK_URL = body["items"][0]["@controls"]["self"]["href"]
+        quantity = body["items"][0]["quantity"]
+        ctrl = client.get(STOCK_URL).json["@controls"]["stock:adjust-stock"]
+        assert ctrl["method"] == "PATCH"
+        validate({"delta": -1}, ctrl["schema"])
+
+        # Test with wrong content type
+        resp = client.patch(STOCK_URL, data="notjson",
+                            headers=Headers({"Content-Type": "text"}))
+        assert resp.status_code in (400, 415)
+
+        # Test with invalid stock URL
+        resp = client.patch(self.INVALID_URL, json={"delta": 1})
+        assert resp.status_code == 404
+
+        resp = client.patch(STOCK_URL, json={"delta": -3})
+        assert resp.status_code == 200
+        assert resp.json["quantity"] == quantity - 3
+        resp = client.patch(STOCK_URL, json={"delta": 5})
+        assert resp.status_code == 200
+        assert resp.json["quantity"] == quantity + 2
+        assert client.get(STOCK_URL).json["quantity"] == quantity + 2
+
+        # Stock can't go below zero
+        resp = client.patch(STOCK_URL, json={"delta": -(quantity + 3)})
+        assert resp.status_code == 409
+        assert client.get(STOCK_URL).json["quantity"] == quantity + 2
+
+        # Delta is required
+        resp = client.patch(STOCK_URL, json={"quantity": 1})
+        assert resp.status_code == 400
+
+        # Delta and quantity stay in the range of the integer column
+        resp = client.patch(STOCK_URL, json={"delta": 10 ** 30})
+        assert resp.status_code == 400
+        resp = client.patch(STOCK_URL, json={"delta": 2 ** 31 - 1})
+        assert resp.status_code == 409
+        resp = client.patch(STOCK_URL, json={"delta": 2 ** 31 - 1 - (quantity + 2)})
+        assert resp.status_code == 200
+        assert client.get(STOCK_URL).json["quantity"] == 2 ** 31 - 1
+        resp = client.patch(STOCK_URL, json={"delta": 1})
+        assert resp.status_code == 409
+        assert client.get(STOCK_URL).json["quantity"] == 2 ** 31 - 1
+
     def test_delete(self, client):
         ''' Test DELETE method for the StockItem resource. '''
         resp = client.get(self.ALL_STOCK_URL)
@@ -854,3 +1474,506 @@ class TestStockItem(object):
         assert resp.status_code == 404
         resp = client.delete(self.INVALID_URL)
         assert resp.status_code == 404
+
+
+class TestReports(object):
+    """
+    Tests for the report resources.
+    """
+
+    RESOURCE_URL = "/api/reports/"
+
+    def test_get(self, client):
+        ''' Test the controls of the reports and the reports of the test data. '''
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        body = resp.json
+        _check_namespace(client, body)
+        for ctrl in ("store:product-sales", "store:daily-sales", "store:customer-sales",
+                     "store:stock-turnover"):
+            _check_control_get_method(ctrl, client, body)
+
+        body = client.get(self.RESOURCE_URL + "products/").json
+        assert [(i["productId"], i["quantity"], i["revenue"]) for i in body["items"]] == [
+            (1, 2, 40.0), (2, 1, 10.0)
+        ]
+        _check_control_get_method("product", client, body["items"][0])
+
+        body = client.get(self.RESOURCE_URL + "daily/").json
+        assert [(i["quantity"], i["revenue"]) for i in body["items"]] == [(3, 50.0)]
+        orders = client.get(body["items"][0]["@controls"]["orders"]["href"]).json
+        assert len(orders["orders"]) == 1
+
+        body = client.get(self.RESOURCE_URL + "stock-turnover/").json
+        assert [(i["sold"], i["inStock"], i["turnover"]) for i in body["items"]] == [
+            (2, 8, 0.25), (1, 20, 0.05)
+        ]
+
+    def test_updates(self, client):
+        ''' Test that the reports follow orders placed and product orders changed. '''
+        customers = client.get("/api/customers/").json["customers"]
+        order = {
+            "customerId": customers[1]["uuid"],
+            "productOrders": [{"productId": 2, "quantity": 4}]
+        }
+        resp = client.post("/api/orders/place/", json=order)
+        assert resp.status_code == 201
+        line_url = client.get(resp.headers["Location"]).json["productorders"][0]["@controls"]
+        line_url = line_url["self"]["href"]
+
+        def sales(report):
+            return [
+                (i["quantity"], i["revenue"])
+                for i in client.get(self.RESOURCE_URL + report).json["items"]
+            ]
+
+        # Top customers first
+        body = client.get(self.RESOURCE_URL + "customers/").json
+        assert [i["customerId"] for i in body["items"]] == [
+            customers[0]["uuid"], customers[1]["uuid"]
+        ]
+        assert sales("customers/?sort=quantity") == [(3, 50.0), (4, 40.0)]
+        assert sales("products/?sort=-quantity&revenue[gte]=40") == [(5, 50.0), (2, 40.0)]
+        assert sales("daily/") == [(7, 90.0)]
+
+        line = client.get(line_url).json
+        line = {"orderId": line["orderId"], "productId": 1, "quantity": 1}
+        assert client.put(line_url, json=line).status_code == 204
+        assert sales("products/") == [(3, 60.0), (1, 10.0)]
+        assert client.delete(line_url).status_code == 204
+        assert sales("products/") == [(2, 40.0), (1, 10.0)]
+        assert sales("customers/") == [(3, 50.0)]
+
+        resp = client.get(self.RESOURCE_URL + "customers/?sort=name")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "daily/?day[gte]=yesterday")
+        assert resp.status_code == 400
+
+
+class TestEntityCache(object):
+    """
+    Tests for the entity cache behind the URL converters.
+    """
+
+    def test_get_cached(self, cached_client):
+        ''' Test that repeated item GETs are served without the database. '''
+        resp, _ = _count_queries(cached_client, "GET", "/api/products/1/")
+        assert resp.status_code == 200
+        resp, queries = _count_queries(cached_client, "GET", "/api/products/1/")
+        assert resp.status_code == 200
+        assert resp.json["name"] == "Sateenvarjo"
+        assert queries == 0
+
+        # Relationships of cached rows are still loaded when used
+        resp = cached_client.get("/api/orders/1/")
+        resp = cached_client.get("/api/orders/1/")
+        assert len(resp.json["productorders"]) == 2
+
+    def test_invalidate(self, cached_client):
+        ''' Test that changes and deletes invalidate the cached rows. '''
+        product = _get_product_json()
+        product["price"] = 25.0
+        assert cached_client.get("/api/products/1/").status_code == 200
+        resp = cached_client.put("/api/products/1/", json=product)
+        assert resp.status_code == 204
+        assert cached_client.get("/api/products/1/").json["price"] == 25.0
+
+        # Stock adjustments bypass the session
+        quantity = cached_client.get("/api/stock/1/").json["quantity"]
+        resp = cached_client.patch("/api/stock/1/", json={"delta": -1})
+        assert resp.status_code == 200
+        assert cached_client.get("/api/stock/1/").json["quantity"] == quantity - 1
+
+        # Failed changes keep the cached row
+        resp = cached_client.patch("/api/stock/1/", json={"delta": -100})
+        assert resp.status_code == 409
+        assert cached_client.get("/api/stock/1/").json["quantity"] == quantity - 1
+
+        resp = cached_client.delete("/api/stock/1/")
+        assert resp.status_code == 204
+        assert cached_client.get("/api/stock/1/").status_code == 404
+
+    def test_invalidate_cascades(self, cached_client):
+        ''' Test that rows deleted or nulled by the database are invalidated. '''
+        uuid = cached_client.get("/api/orders/1/").json["customerId"]
+        for url in ("/api/productorders/1/", "/api/stock/2/"):
+            assert cached_client.get(url).status_code == 200
+
+        # The product orders are deleted with their order
+        assert cached_client.delete("/api/orders/1/").status_code == 204
+        assert cached_client.get("/api/productorders/1/").status_code == 404
+        # The stock is deleted with its product
+        assert cached_client.delete("/api/products/2/").status_code == 204
+        assert cached_client.get("/api/stock/2/").status_code == 404
+
+        # The orders of a deleted customer lose their customer
+        order = {"customerId": uuid}
+        order_url = cached_client.post("/api/orders/", json=order).headers["Location"]
+        assert cached_client.get(order_url).json["customerId"] == uuid
+        assert cached_client.delete(f"/api/customers/{uuid}/").status_code == 204
+        assert cached_client.get(order_url).json["customerId"] is None
+
+    def test_writes_bypass_cache(self, cached_client):
+        ''' Test that writes never act on a row deleted by another worker. '''
+        order = cached_client.get("/api/orders/1/").json
+        assert cached_client.get("/api/productorders/1/").status_code == 200
+
+        # Another worker deletes the row, this worker's cache still has it
+        with cached_client.application.app_context():
+            with db.engine.begin() as connection:
+                connection.exec_driver_sql("DELETE FROM product_order WHERE id = 1")
+        assert cached_client.get("/api/productorders/1/").status_code == 200
+        assert cached_client.delete("/api/productorders/1/").status_code == 404
+        resp = cached_client.put("/api/productorders/1/", json={
+            "orderId": 1, "productId": 1, "quantity": 1
+        })
+        assert resp.status_code == 404
+        assert cached_client.get("/api/orders/1/").json["total"] == order["total"]
+
+
+class TestQueryStats(object):
+
+    ITEM_URLS = ["/api/products/1/", "/api/productorders/1/", "/api/stock/1/"]
+
+    def test_headers(self, client):
+        ''' Test that the counts are sent in headers when QUERY_STATS_HEADERS is set '''
+        resp = client.get("/api/products/")
+        assert "X-Query-Count" not in resp.headers
+
+        client.application.config.update(QUERY_STATS_HEADERS=True, QUERY_REPEAT_THRESHOLD=1)
+        resp, queries = _count_queries(client, "GET", "/api/products/")
+        assert int(resp.headers["X-Query-Count"]) == queries
+        assert float(resp.headers["X-Query-Time"]) > 0
+        assert int(resp.headers["X-Query-Repeated"]) > 0
+        stats = client.application.extensions["query_stats"].snapshot()
+        assert stats["api.productcollection"]["requests"] == 2
+        assert stats["api.productcollection"]["max_queries"] == queries
+
+    def test_budget(self, client):
+        ''' Test that items don't load their related rows and that budgets are enforced '''
+        from onlinestore.querystats import QueryBudgetExceeded
+
+        client.application.config["QUERY_BUDGET"] = 1
+        for url in self.ITEM_URLS:
+            assert client.get(url).status_code == 200
+        client.application.config["QUERY_BUDGETS"] = {"api.productitem": 0}
+        with pytest.raises(QueryBudgetExceeded):
+            client.get("/api/products/1/")
+
+    def test_failed_statement(self, client):
+        ''' Test that statements that fail are counted and leave no start time behind '''
+        from flask import g
+        from sqlalchemy.exc import OperationalError
+
+        app = client.application
+        with app.test_request_context("/api/products/"):
+            with db.engine.connect() as connection:
+                with pytest.raises(OperationalError):
+                    connection.exec_driver_sql("SELECT * FROM missing")
+                connection.exec_driver_sql("SELECT 1")
+                assert connection.info["query_start"] == []
+            assert sum(g._queries["statements"].values()) == 2
+
+    def test_fingerprint(self):
+        ''' Test that statements with other values have the same fingerprint '''
+        from onlinestore.querystats import fingerprint
+
+        assert fingerprint("SELECT * FROM product WHERE id IN (?, ?, ?)") == \
+            fingerprint("SELECT * FROM product\n WHERE id IN (?)")
+        assert fingerprint("SELECT * FROM customer WHERE name = 'a' LIMIT 10") == \
+            "SELECT * FROM customer WHERE name = ? LIMIT ?"
+        assert fingerprint("SELECT * FROM \"order\" WHERE id = %(id_1)s") == \
+            "SELECT * FROM \"order\" WHERE id = ?"
+
+
+class TestMetrics(object):
+
+    METRICS_URL = "/metrics"
+
+    def test_get(self, client):
+        ''' Test that requests, response sizes and commits are counted '''
+        client.get("/api/products/")
+        client.get("/api/products/")
+        client.post("/api/customers/", json=_get_customer_json())
+        resp = client.get(self.METRICS_URL)
+        assert resp.status_code == 200
+        assert resp.content_type.startswith("text/plain; version=0.0.4")
+        lines = resp.data.decode().splitlines()
+        assert 'onlinestore_requests_total{endpoint="api.productcollection",' \
+            'method="GET",status="200"} 2' in lines
+        assert 'onlinestore_requests_total{endpoint="api.customercollection",' \
+            'method="POST",status="201"} 1' in lines
+        assert 'onlinestore_request_duration_seconds_count{endpoint="api.productcollection",' \
+            'method="GET"} 2' in lines
+        assert 'onlinestore_request_duration_seconds_bucket{endpoint="api.productcollection",' \
+            'method="GET",le="+Inf"} 2' in lines
+        assert 'onlinestore_response_size_bytes_count{endpoint="api.productcollection",' \
+            'method="GET"} 2' in lines
+        # The request for the metrics is in flight
+        assert "onlinestore_requests_in_flight 1" in lines
+        assert any(line.startswith("onlinestore_db_commit_duration_seconds_count") for line in lines)
+
+    def test_processes(self, client, tmp_path):
+        ''' Test that the metrics of the workers are added up '''
+        import subprocess
+        import sys
+        from onlinestore.metrics import Metrics
+
+        client.application.extensions["metrics"].directory = str(tmp_path)
+        labels = (("endpoint", "api.productcollection"), ("method", "GET"), ("status", "200"))
+        exited = subprocess.Popen([sys.executable, "-c", ""])
+        exited.wait()
+        for pid in (os.getppid(), exited.pid):
+            worker = Metrics(str(tmp_path), pid=pid)
+            worker.inc("onlinestore_requests_total", labels, 3)
+            worker.inc("onlinestore_requests_in_flight", value=2)
+            worker.flush()
+
+        client.get("/api/products/")
+        lines = client.get(self.METRICS_URL).data.decode().splitlines()
+        assert 'onlinestore_requests_total{endpoint="api.productcollection",' \
+            'method="GET",status="200"} 7' in lines
+        # The gauges of the process that exited are dropped
+        assert "onlinestore_requests_in_flight 3" in lines
+        assert (tmp_path / f"metrics-{os.getpid()}.json").exists()
+
+    def test_threads(self):
+        ''' Test that the counters of exited threads are kept without their stores '''
+        import threading
+        from onlinestore.metrics import Metrics
+
+        metrics = Metrics()
+        labels = (("endpoint", "api.productcollection"), ("method", "GET"))
+        for _ in range(300):
+            thread = threading.Thread(target=lambda: (
+                metrics.inc("onlinestore_requests_total", labels),
+                metrics.observe("onlinestore_request_duration_seconds", labels, 0.02),
+            ))
+            thread.start()
+            thread.join()
+        metrics.inc("onlinestore_requests_total", labels)
+        assert len(metrics._stores) == 1
+        values = metrics.snapshot()
+        assert values[("onlinestore_requests_total", labels)] == 301
+        assert values[("onlinestore_request_duration_seconds", labels)][2] == 300
+
+
+class TestProfiler(object):
+
+    PROFILE_URL = "/admin/profile/"
+    TOKEN = "secret-token"
+
+    def test_token(self, client):
+        ''' Test that the profile is served only with the admin token '''
+        assert client.get(self.PROFILE_URL).status_code == 404
+        client.application.config["PROFILER_TOKEN"] = self.TOKEN
+        assert client.get(self.PROFILE_URL).status_code == 403
+        resp = client.get(self.PROFILE_URL, headers={"X-Profile-Token": "wrong"})
+        assert resp.status_code == 403
+        resp = client.get(self.PROFILE_URL, headers={"X-Profile-Token": self.TOKEN})
+        assert resp.status_code == 200
+        assert resp.data == b""
+
+        # Requests with a wrong token are not profiled
+        resp = client.get("/api/products/", headers={"X-Profile-Token": "wrong"})
+        assert resp.status_code == 200
+        assert client.application.extensions["profiler"]._thread is None
+
+    def test_profile(self, client):
+        ''' Test that the stacks of the profiled requests are collapsed by endpoint '''
+        client.application.config.update(PROFILER_TOKEN=self.TOKEN)
+        profiler = client.application.extensions["profiler"]
+        profiler.interval = 0.0005
+        headers = {"X-Profile-Token": self.TOKEN}
+        for _ in range(500):
+            client.get("/api/products/", headers=headers)
+            client.get("/api/products/1/", headers=headers)
+            if "api.productitem;" in profiler.collapsed():
+                break
+
+        resp = client.get(self.PROFILE_URL, headers=headers)
+        assert resp.status_code == 200
+        lines = resp.data.decode().splitlines()
+        assert lines
+        for line in lines:
+            stack, count = line.rsplit(" ", 1)
+            assert stack.split(";")[0] in ("api.productcollection", "api.productitem")
+            assert int(count) > 0
+        assert any("flask.app:Flask.wsgi_app" in line for line in lines)
+        resp = client.get(self.PROFILE_URL + "?endpoint=api.productitem", headers=headers)
+        assert all(line.startswith("api.productitem;") for line in resp.data.decode().splitlines())
+
+    def test_collapse(self):
+        ''' Test that a stack is collapsed from the outermost frame '''
+        import sys
+        from onlinestore.profiler import collapse
+
+        def inner():
+            return collapse(sys._getframe())
+
+        assert inner().endswith(
+            "resource_test:TestProfiler.test_collapse;"
+            "resource_test:TestProfiler.test_collapse.<locals>.inner"
+        )
+
+    def test_windows(self, monkeypatch):
+        ''' Test that the samples of windows before an idle period aren't served '''
+        import threading
+        from onlinestore import profiler
+
+        now = [1000.0]
+        monkeypatch.setattr(profiler.time, "monotonic", lambda: now[0])
+        p = profiler.Profiler(window=60)
+        p._active[threading.get_ident()] = "api.productitem"
+        p.sample()
+        now[0] += 70
+        p.sample()
+        assert sum(int(line.split()[-1]) for line in p.collapsed().splitlines()) == 2
+
+        now[0] += 60
+        assert sum(int(line.split()[-1]) for line in p.collapsed().splitlines()) == 1
+        now[0] += 61
+        assert p.collapsed() == ""
+        p.sample()
+        assert len(p._windows) == 1
+        assert sum(int(line.split()[-1]) for line in p.collapsed().splitlines()) == 1
+
+
+class TestConditionalRequests(object):
+    """
+    Tests for ETag and Last-Modified validators of the resources.
+    """
+
+    def test_item(self, client):
+        ''' Test conditional GET, PUT and DELETE of an item. '''
+        resp = client.get("/api/products/1/")
+        assert resp.status_code == 200
+        etag = resp.headers["ETag"]
+
+        resp = client.get("/api/products/1/", headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+        assert resp.headers["ETag"] == etag
+        assert not resp.data
+
+        # Stale If-Match is rejected, current one is accepted
+        valid_json = _get_product_json()
+        valid_json["price"] = 25.0
+        resp = client.put("/api/products/1/", json=valid_json, headers={"If-Match": '"stale"'})
+        assert resp.status_code == 412
+        resp = client.put("/api/products/1/", json=valid_json, headers={"If-Match": etag})
+        assert resp.status_code == 204
+
+        resp = client.get("/api/products/1/", headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        assert resp.headers["ETag"] != etag
+        resp = client.delete("/api/products/1/", headers={"If-Match": etag})
+        assert resp.status_code == 412
+        etag = client.get("/api/products/1/").headers["ETag"]
+        resp = client.delete("/api/products/1/", headers={"If-Match": etag})
+        assert resp.status_code == 204
+
+    def test_item_children(self, client):
+        ''' Test that an order's ETag changes with its product orders. '''
+        etag = client.get("/api/orders/1/").headers["ETag"]
+        resp = client.post("/api/productorders/", json=_get_productorder_json())
+        assert resp.status_code == 201
+        resp = client.get("/api/orders/1/", headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+
+    def test_collection(self, client):
+        ''' Test conditional GET of a collection. '''
+        resp = client.get("/api/products/")
+        assert resp.status_code == 200
+        etag = resp.headers["ETag"]
+        last_modified = resp.headers["Last-Modified"]
+
+        resp = client.get("/api/products/", headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+        resp = client.get("/api/products/", headers={"If-Modified-Since": last_modified})
+        assert resp.status_code == 304
+
+        # Other pages have their own ETags
+        resp = client.get("/api/products/?limit=1", headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+
+        # Changes to other tables don't affect the collection
+        resp = client.patch("/api/stock/1/", json={"delta": 1})
+        assert resp.status_code == 200
+        resp = client.get("/api/products/", headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+
+        resp = client.post("/api/products/", json=_get_product_json(2))
+        assert resp.status_code == 201
+        resp = client.get("/api/products/", headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        assert len(resp.json["products"]) == 3
+
+    def test_revisions_once(self, client):
+        ''' Test that a transaction bumps the revisions of its tables with one statement. '''
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        etags = {url: client.get(url).headers["ETag"] for url in (
+            "/api/orders/", "/api/productorders/", "/api/stock/", "/api/reports/products/"
+        )}
+        uuid = client.get("/api/customers/").json["customers"][0]["uuid"]
+        place = {"customerId": uuid, "productOrders": [
+            {"productId": 1, "quantity": 1}, {"productId": 2, "quantity": 1}
+        ]}
+        with client.application.app_context():
+            engine = db.engine
+        event.listen(engine, "before_cursor_execute", capture)
+        try:
+            assert client.post("/api/orders/place/", json=place).status_code == 201
+        finally:
+            event.remove(engine, "before_cursor_execute", capture)
+        assert len([s for s in statements if s.startswith("UPDATE revision")]) == 1
+        for url, etag in etags.items():
+            assert client.get(url, headers={"If-None-Match": etag}).status_code == 200
+
+
+def test_apispec(client):
+    ''' Test that the API documentation of every resource can be loaded. '''
+    resp = client.get("/apispec_1.json")
+    assert resp.status_code == 200
+    assert "/api/products/" in resp.json["paths"]
+
+
+def test_validation_registry(client):
+    ''' Test that the compiled validators report the same errors as jsonschema.validate. '''
+    from jsonschema import ValidationError
+    from onlinestore.models import Order
+    from onlinestore.validation import get_validator, validate_json
+
+    assert get_validator(Order, "place_schema") is get_validator(Order, "place_schema")
+    body = {"customerId": "x", "productOrders": [{"productId": 1, "quantity": 0}]}
+    with pytest.raises(ValidationError) as expected:
+        validate(body, Order.place_schema())
+    with pytest.raises(ValidationError) as actual:
+        validate_json(body, Order, "place_schema")
+    assert actual.value.message == expected.value.message
+    validate_json({"customerId": "x", "productOrders": [{"productId": 1, "quantity": 1}]},
+                  Order, "place_schema")
+
+
+def test_json_encoders(client):
+    ''' Test that the documents don't depend on the JSON encoder or the cached fragments. '''
+    from onlinestore.encoding import ENCODERS
+    pytest.importorskip("orjson")
+
+    urls = ["/api/products/", "/api/products/1/", "/api/orders/1/", "/api/stock/?stream=1"]
+    uuid = client.get("/api/customers/").json["customers"][0]["uuid"]
+    urls.append(f"/api/customers/{uuid}/")
+
+    bodies = {}
+    for name in ("orjson", "json"):
+        client.application.extensions["json_encoder"] = ENCODERS[name]
+        client.application.extensions["json_fragments"].clear()
+        # The second request uses the fragments cached by the first
+        bodies[name] = [json.loads(client.get(url).data) for url in urls for _ in range(2)]
+    assert bodies["orjson"] == bodies["json"]
+    assert bodies["json"][0] == bodies["json"][1]
+    assert bodies["json"][0]["@namespaces"]["store"]["name"] == "/onlinestore/link-relations/"
+    assert bodies["json"][0]["products"][0]["@controls"]["self"]["href"] == "/api/products/1/"